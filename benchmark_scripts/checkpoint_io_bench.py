@@ -0,0 +1,114 @@
+"""
+Checkpoint save/load with gloo CPU processes.
+
+Saves the model and AdamW state of a timm ViT with ``--world_size`` processes, once as a
+single file written by rank 0 and once sharded, then resumes the sharded checkpoint with
+each of ``--load_world_sizes`` processes (resharding) and checks it against the single file.
+The single file is also loaded with ``load_broadcast`` in every ``--ckpt_load_mode``,
+with nodes simulated as blocks of ``--ranks_per_node`` ranks.
+
+    python benchmark_scripts/checkpoint_io_bench.py --model vit_large_patch16_224 --world_size 4
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from timm.models import create_model
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import checkpoint_io
+
+
+def get_args():
+    parser = argparse.ArgumentParser('Checkpoint save/load benchmark', add_help=False)
+    parser.add_argument('--model', default='vit_base_patch16_224', type=str)
+    parser.add_argument('--world_size', default=4, type=int)
+    parser.add_argument('--load_world_sizes', default=[1, 2, 3], type=int, nargs='+')
+    parser.add_argument('--output_dir', default='', type=str,
+                        help='Directory for the checkpoints (default: a temporary directory)')
+    parser.add_argument('--ranks_per_node', default=2, type=int)
+    parser.add_argument('--bucket_mb', default=256, type=int)
+    parser.add_argument('--port', default=29533, type=int)
+    return parser.parse_args()
+
+
+def build_state(model_name):
+    torch.manual_seed(0)
+    model = create_model(model_name, pretrained=False)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    model(torch.randn(1, 3, 224, 224)).sum().backward()
+    optimizer.step()
+    return {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': 0}
+
+
+def init_process(rank, world_size, port):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+
+def timed(fn):
+    dist.barrier()
+    start = time.time()
+    result = fn()
+    dist.barrier()
+    return result, time.time() - start
+
+
+def save_worker(rank, args, output_dir):
+    init_process(rank, args.world_size, args.port)
+    state = build_state(args.model)
+    single_path = os.path.join(output_dir, 'checkpoint-0.pth')
+    _, single_time = timed(lambda: checkpoint_io.atomic_save(state, single_path) if rank == 0 else None)
+    sharded_dir = os.path.join(output_dir, 'checkpoint-0')
+    _, sharded_time = timed(lambda: checkpoint_io.save_sharded(state, sharded_dir, rank, args.world_size))
+    if rank == 0:
+        print("save, %d processes: single file %.2fs, sharded %.2fs (%.1f MB)" % (
+            args.world_size, single_time, sharded_time, os.path.getsize(single_path) / 2 ** 20))
+    dist.destroy_process_group()
+
+
+def load_worker(rank, world_size, args, output_dir):
+    init_process(rank, world_size, args.port + world_size)
+    single_path = os.path.join(output_dir, 'checkpoint-0.pth')
+    sharded_dir = os.path.join(output_dir, 'checkpoint-0')
+    _, single_time = timed(lambda: torch.load(single_path, map_location='cpu'))
+    loaded, sharded_time = timed(lambda: checkpoint_io.load_sharded(sharded_dir, rank, world_size))
+    reference = torch.load(single_path, map_location='cpu')
+    check_equal(loaded, reference)
+    if rank == 0:
+        print("load, %d processes: single file %.2fs, sharded %.2fs, state identical" % (
+            world_size, single_time, sharded_time))
+    for mode in ('all', 'node', 'rank0'):
+        loaded, mode_time = timed(lambda: checkpoint_io.load_broadcast(
+            single_path, mode, bucket_mb=args.bucket_mb, ranks_per_node=args.ranks_per_node))
+        check_equal(loaded, reference)
+        if rank == 0:
+            print("load_broadcast, %d processes, mode %s: %.2fs, state identical" % (world_size, mode, mode_time))
+    dist.destroy_process_group()
+
+
+def check_equal(loaded, reference):
+    assert loaded['epoch'] == reference['epoch']
+    assert loaded['optimizer']['param_groups'] == reference['optimizer']['param_groups']
+    for k, v in reference['model'].items():
+        assert torch.equal(loaded['model'][k], v), k
+    for i, state in reference['optimizer']['state'].items():
+        for k, v in state.items():
+            assert torch.equal(loaded['optimizer']['state'][i][k], v), (i, k)
+
+
+def main(args):
+    output_dir = args.output_dir if args.output_dir else tempfile.mkdtemp()
+    os.makedirs(output_dir, exist_ok=True)
+    mp.spawn(save_worker, args=(args, output_dir), nprocs=args.world_size)
+    for world_size in args.load_world_sizes:
+        mp.spawn(load_worker, args=(world_size, args, output_dir), nprocs=world_size)
+
+
+if __name__ == '__main__':
+    main(get_args())
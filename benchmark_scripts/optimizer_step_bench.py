@@ -0,0 +1,83 @@
+"""
+Optimizer step time on CPU.
+
+Builds the layer-decay param groups of a timm ViT as run_class_finetuning.py does and
+times the per-step work outside forward/backward: the gradient norm and
+``optimizer.step()``, for each ``--opt_impl``.
+
+    python benchmark_scripts/optimizer_step_bench.py --models vit_base_patch16_224 vit_large_patch16_224
+"""
+import os
+import sys
+import time
+import argparse
+import contextlib
+from types import SimpleNamespace
+import torch
+from timm.models import create_model
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+from optim_factory import create_optimizer, LayerDecayValueAssigner
+
+
+def get_args():
+    parser = argparse.ArgumentParser('Optimizer step benchmark', add_help=False)
+    parser.add_argument('--models', default=['vit_base_patch16_224', 'vit_large_patch16_224'], type=str, nargs='+')
+    parser.add_argument('--impls', default=['default', 'foreach', 'fused'], type=str, nargs='+')
+    parser.add_argument('--layer_decay', default=0.75, type=float)
+    parser.add_argument('--steps', default=10, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='torch threads (default: torch default)')
+    return parser.parse_args()
+
+
+def grad_norm_loop(parameters):
+    # utils.get_grad_norm_ before the multi-tensor version
+    return torch.norm(torch.stack([torch.norm(p.grad.detach(), 2.0) for p in parameters]), 2.0)
+
+
+def timed(fn, steps):
+    fn()
+    start = time.time()
+    for _ in range(steps):
+        fn()
+    return (time.time() - start) / steps * 1000
+
+
+def bench(model, args, impl):
+    num_layers = len(model.blocks) + 1
+    assigner = LayerDecayValueAssigner(list(args.layer_decay ** (num_layers + 1 - i) for i in range(num_layers + 2)))
+    opt_args = SimpleNamespace(opt='adamw', lr=1e-3, weight_decay=0.05, opt_eps=1e-8, opt_betas=[0.9, 0.999],
+                               momentum=0.9, opt_impl=impl)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        optimizer = create_optimizer(opt_args, model, skip_list=model.no_weight_decay(),
+                                     get_num_layer=assigner.get_layer_id, get_layer_scale=assigner.get_scale)
+    step_ms = timed(optimizer.step, args.steps)
+    del optimizer
+    return step_ms
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    for name in args.models:
+        torch.manual_seed(0)
+        model = create_model(name, pretrained=False)
+        for p in model.parameters():
+            p.grad = torch.randn_like(p)
+        params = list(model.parameters())
+        print("%s: %.1fM parameters in %d tensors" % (name, sum(p.numel() for p in params) / 1e6, len(params)))
+        print("  grad norm: loop %.2f ms, multi-tensor %.2f ms" % (
+            timed(lambda: grad_norm_loop(params), args.steps), timed(lambda: utils.get_grad_norm_(params), args.steps)))
+        for impl in args.impls:
+            try:
+                step_ms = bench(model, args, impl)
+            except RuntimeError as e:
+                print("  %s: not available (%s)" % (impl, str(e).splitlines()[0]))
+                continue
+            print("  opt_impl=%s: step %.1f ms" % (impl, step_ms))
+        del model, params
+
+
+if __name__ == '__main__':
+    main(get_args())
@@ -0,0 +1,85 @@
+"""
+Step time and accuracy drift of each ``--precision`` policy on CPU.
+
+Trains a timm ViT for ``--steps`` steps from the same initialization on the same random
+batches under each policy, then compares its evaluation logits and loss with the fp32
+run: max / mean absolute logit difference and top-1 agreement. fp16 steps skipped by the
+loss scaler (inf/nan gradients) are counted, they are part of the drift.
+
+    python benchmark_scripts/precision_bench.py --model vit_small_patch16_224 --steps 10
+"""
+import os
+import sys
+import time
+import copy
+import argparse
+import torch
+import torch.nn.functional as F
+from timm.models import create_model
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+from precision import PrecisionPolicy
+
+
+def get_args():
+    parser = argparse.ArgumentParser('Precision policy benchmark', add_help=False)
+    parser.add_argument('--model', default='vit_small_patch16_224', type=str)
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--num_classes', default=10, type=int)
+    parser.add_argument('--steps', default=10, type=int)
+    parser.add_argument('--warmup', default=2, type=int, help='Steps excluded from the timing')
+    parser.add_argument('--modes', default=['fp32', 'bf16', 'bf16:head', 'fp16'], type=str, nargs='+',
+                        help='precision[:comma separated fp32 modules]')
+    return parser.parse_args()
+
+
+def run(model, policy, batches, eval_batch, warmup):
+    model = policy.apply(copy.deepcopy(model))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    loss_scaler = utils.NativeScalerWithGradNormCount(enabled=policy.use_scaler, device='cpu')
+    model.train()
+    times = []
+    skipped = 0
+    for x, y in batches:
+        start = time.time()
+        with policy.autocast():
+            loss = F.cross_entropy(model(x), y)
+        scale = loss_scaler.state_dict().get("scale")
+        loss_scaler(loss, optimizer, parameters=model.parameters())
+        # the scaler lowers its scale when it skips a step with inf/nan gradients
+        skipped += int(scale is not None and loss_scaler.state_dict()["scale"] < scale)
+        optimizer.zero_grad()
+        times.append(time.time() - start)
+    model.eval()
+    with torch.no_grad(), policy.autocast():
+        logits = model(eval_batch[0]).float()
+    step_time = sum(times[warmup:]) / max(len(times) - warmup, 1)
+    return step_time, skipped, logits, F.cross_entropy(logits, eval_batch[1]).item()
+
+
+def main(args):
+    torch.manual_seed(0)
+    model = create_model(args.model, pretrained=False, num_classes=args.num_classes)
+    batches = [(torch.randn(args.batch_size, 3, 224, 224), torch.randint(0, args.num_classes, (args.batch_size,)))
+               for _ in range(args.steps)]
+    eval_batch = (torch.randn(4 * args.batch_size, 3, 224, 224), torch.randint(0, args.num_classes, (4 * args.batch_size,)))
+    reference = None
+    for mode in args.modes:
+        name, _, modules = mode.partition(':')
+        policy = PrecisionPolicy(name, 'cpu', [m for m in modules.split(',') if m])
+        try:
+            step_time, skipped, logits, loss = run(model, policy, batches, eval_batch, args.warmup)
+        except RuntimeError as e:
+            print("%-12s not available (%s)" % (mode, str(e).splitlines()[0]))
+            continue
+        if reference is None:
+            reference = logits
+        diff = (logits - reference).abs()
+        agree = (logits.argmax(-1) == reference.argmax(-1)).float().mean().item() * 100
+        print("%-12s step %.3fs  skipped steps %d  eval loss %.4f  logit diff max %.4f mean %.5f  "
+              "top-1 agreement %.1f%%" % (mode, step_time, skipped, loss, diff.max().item(), diff.mean().item(), agree))
+
+
+if __name__ == '__main__':
+    main(get_args())
@@ -0,0 +1,150 @@
+"""
+Per-block forward / backward timing and activation memory (``--block_profile``).
+
+Hooks are attached to the patch embedding, every transformer block, the head and, for
+pretraining, the encoder-to-decoder projection and decoder blocks; any module whose
+name matches ``BLOCK_PATTERN``. For each of them, in training mode only:
+    forward     time of the forward call
+    backward    time from the gradient of its output to the gradient of its input
+    recompute   forward calls that run during backward, i.e. reentrant activation
+                checkpointing; non-reentrant recompute is counted in backward
+    act         CUDA memory still allocated after the forward call, what the block
+                keeps alive for backward plus its output (not measured on CPU)
+CUDA is timed with events, so the hooks do not synchronize the device.
+
+After each epoch ``report`` writes ``block_profile_epoch{e}.txt`` on rank 0, headed
+by the ``num_frames`` / ``input_size`` / ``use_checkpoint`` of the run, and clears
+the measurements.
+"""
+import os
+import re
+import time
+from collections import OrderedDict
+import numpy as np
+import torch
+
+import utils
+
+BLOCK_PATTERN = re.compile(r'(^|\.)(patch_embed|blocks\.\d+|head|encoder_to_decoder)$')
+PHASES = ('forward', 'backward', 'recompute')
+
+
+def in_backward():
+    return torch._C._current_graph_task_id() != -1
+
+
+class BlockProfiler(object):
+    def __init__(self, model, device, config=None, max_pending=4096):
+        self.cuda = torch.device(device).type == 'cuda'
+        self.config = config or {}
+        self.max_pending = max_pending
+        self.times = OrderedDict()
+        self.act = OrderedDict()
+        self.pending = []
+        self.handles = []
+        for name, module in model.named_modules():
+            if not BLOCK_PATTERN.search(name) or isinstance(module, torch.nn.Identity):
+                continue
+            self.times[name] = {phase: [] for phase in PHASES}
+            self.act[name] = []
+            self.handles += [
+                module.register_forward_pre_hook(self._start('fwd', name)),
+                module.register_forward_hook(self._end('fwd', name)),
+                module.register_full_backward_pre_hook(self._start('bwd', name)),
+                module.register_full_backward_hook(self._end('bwd', name)),
+            ]
+        self.started = {}
+        print("Block profile hooks on %d modules" % len(self.times))
+
+    def _now(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _start(self, kind, name):
+        def hook(module, *args):
+            if not module.training:
+                return
+            # non-reentrant checkpointing may stop a recompute early, without the end hook
+            key = 'rec' if kind == 'fwd' and in_backward() else kind
+            mem = torch.cuda.memory_allocated() if self.cuda and key == 'fwd' else 0
+            self.started[(key, name)] = (self._now(), mem)
+        return hook
+
+    def _end(self, kind, name):
+        def hook(module, *args):
+            key = 'rec' if kind == 'fwd' and in_backward() else kind
+            start = self.started.pop((key, name), None)
+            if start is None:
+                return
+            phase = {'fwd': 'forward', 'bwd': 'backward', 'rec': 'recompute'}[key]
+            if self.cuda and phase == 'forward':
+                self.act[name].append(torch.cuda.memory_allocated() - start[1])
+            self.pending.append((name, phase, start[0], self._now()))
+            if len(self.pending) >= self.max_pending:
+                self._resolve()
+        return hook
+
+    def _resolve(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        for name, phase, start, end in self.pending:
+            ms = start.elapsed_time(end) if self.cuda else (end - start) * 1000.
+            self.times[name][phase].append(ms)
+        self.pending = []
+
+    def summary(self):
+        """
+        Per module: calls and mean ms per phase, mean activation MB.
+        """
+        self._resolve()
+        rows = OrderedDict()
+        for name, phases in self.times.items():
+            row = OrderedDict(calls=len(phases['forward']))
+            for phase in PHASES:
+                row[phase] = float(np.mean(phases[phase])) if phases[phase] else 0.
+                row[phase + '_total'] = float(np.sum(phases[phase]))
+            row['act_mb'] = float(np.mean(self.act[name])) / 2 ** 20 if self.act[name] else float('nan')
+            rows[name] = row
+        return rows
+
+    def clear(self):
+        self._resolve()
+        for name in self.times:
+            self.times[name] = {phase: [] for phase in PHASES}
+            self.act[name] = []
+
+    def report(self, output_dir, epoch):
+        rows = self.summary()
+        self.clear()
+        if not output_dir or not utils.is_main_process():
+            return rows
+        total = sum(row[phase + '_total'] for row in rows.values() for phase in PHASES) or 1.
+        path = os.path.join(output_dir, 'block_profile_epoch%d.txt' % epoch)
+        with open(path, mode="w", encoding="utf-8") as f:
+            f.write(" ".join("%s=%s" % (k, v) for k, v in self.config.items()) + "\n")
+            f.write("mean ms per call, act = CUDA memory kept after forward, share of all timed ms\n\n")
+            f.write("%-28s %7s %10s %10s %10s %10s %7s\n" % (
+                'module', 'calls', 'forward', 'backward', 'recompute', 'act MB', 'share'))
+            for name, row in rows.items():
+                share = sum(row[phase + '_total'] for phase in PHASES) / total
+                f.write("%-28s %7d %10.3f %10.3f %10.3f %10.1f %6.1f%%\n" % (
+                    name, row['calls'], row['forward'], row['backward'], row['recompute'],
+                    row['act_mb'], 100. * share))
+        print("Block profile written to %s" % path)
+        return rows
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+def create_block_profiler(args, model, device):
+    if not args.block_profile:
+        return None
+    config = OrderedDict(num_frames=args.num_frames, input_size=args.input_size,
+                         use_checkpoint=args.use_checkpoint, batch_size=args.batch_size)
+    return BlockProfiler(model, device, config)
@@ -0,0 +1,581 @@
+"""
+Checkpoint writing for ``utils.save_model``.
+
+Checkpoints are written to a temporary file, fsynced and renamed into place, so a crash
+never leaves a truncated ``checkpoint-*.pth``. Every completed write is recorded in
+``checkpoints.json`` in the output directory, which ``utils.auto_load_model`` reads to
+find the latest checkpoint. With ``--async_ckpt`` the state is copied to CPU memory on
+the training thread and written by a background thread, so training only waits for the
+copy. With ``--ckpt_keep_last N`` only the last N epoch checkpoints are kept, the best
+one (``checkpoint-best.pth``) is always kept.
+
+With ``--sharded_ckpt`` every rank writes a slice of the tensors of the checkpoint in
+parallel into a ``checkpoint-*`` directory:
+    checkpoint-{epoch}/metadata.pth         (written by rank 0: structure, owners, world size)
+    checkpoint-{epoch}/shard-{r}-of-{W}.pth (the tensors owned by rank r)
+On resume every rank reads its share of the shards and the ranks exchange them, which
+also works when the world size changed since the save. ``consolidate`` turns a sharded
+checkpoint into the single-file ``checkpoint-*.pth`` format for export:
+    python checkpoint_io.py output_dir/checkpoint-99 output_dir/checkpoint-99.pth
+
+When part of the model is frozen, checkpoints are deltas: they hold the trainable
+parameters and their optimizer state only, plus ``base_checkpoint``, the path and
+sha256 of the ``--finetune`` checkpoint the frozen weights come from. Loading a delta
+composes it with that base (``resolve_delta_base``).
+
+``load_broadcast`` loads a checkpoint on a distributed run with one memory-mapped read
+per node (``--ckpt_load_mode node``) or on rank 0 only (``rank0``); the tensors reach
+the other ranks through bucketed broadcasts instead of shared storage.
+"""
+import os
+import json
+import socket
+import hashlib
+import queue
+import atexit
+import shutil
+import argparse
+import threading
+import torch
+import torch.distributed as dist
+
+MANIFEST = 'checkpoints.json'
+
+_writers = {}
+_base_references = {}
+_reader_groups = {}
+
+
+def to_cpu(obj):
+    """
+    Copy of a (nested) state dict with every tensor copied to CPU memory.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_save(obj, path):
+    """
+    ``torch.save`` to ``path`` through a temporary file in the same directory.
+    """
+    path = str(path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _write_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(manifest, indent=2) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def latest_checkpoint(output_dir):
+    """
+    Path of the latest epoch checkpoint recorded in the manifest that still exists,
+    or None when there is no manifest (e.g. an output directory of an older run).
+    """
+    manifest = load_manifest(output_dir)
+    if manifest is None:
+        return None
+    for entry in sorted(manifest['checkpoints'], key=lambda e: e['epoch'], reverse=True):
+        path = os.path.join(output_dir, entry['name'])
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints of one output directory and maintains its manifest. Only the
+    main process should own a writer. With ``async_write`` at most one snapshot waits
+    for the background thread, so a second save blocks until the first one is written
+    instead of holding more copies of the state in memory.
+    """
+
+    def __init__(self, output_dir, keep_last=0, async_write=False):
+        self.output_dir = str(output_dir)
+        self.keep_last = keep_last
+        self.async_write = async_write
+        self.manifest = load_manifest(self.output_dir) or {'checkpoints': [], 'best': None}
+        self.error = None
+        self.thread = None
+        self.lock = threading.Lock()
+        if async_write:
+            self.queue = queue.Queue(maxsize=1)
+            self.thread = threading.Thread(target=self._worker, name='checkpoint-writer', daemon=True)
+            self.thread.start()
+
+    def save(self, to_save, name, epoch):
+        """
+        Write ``to_save`` as ``output_dir/name``. ``epoch`` is the epoch number, or
+        ``"best"`` for the best checkpoint.
+        """
+        self._check()
+        if self.async_write:
+            self.queue.put((to_cpu(to_save), name, epoch))
+        else:
+            self._write(to_save, name, epoch)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, to_save, name, epoch):
+        atomic_save(to_save, os.path.join(self.output_dir, name))
+        self.record(name, epoch)
+
+    def record(self, name, epoch):
+        """
+        Add a completed checkpoint (file or sharded directory) to the manifest and apply
+        the retention policy.
+        """
+        with self.lock:
+            if epoch == 'best':
+                self.manifest['best'] = name
+            else:
+                entries = [e for e in self.manifest['checkpoints'] if e['name'] != name]
+                entries.append({'name': name, 'epoch': int(epoch)})
+                self.manifest['checkpoints'] = sorted(entries, key=lambda e: e['epoch'])
+            removed = []
+            if self.keep_last > 0:
+                removed = self.manifest['checkpoints'][:-self.keep_last]
+                self.manifest['checkpoints'] = self.manifest['checkpoints'][-self.keep_last:]
+            # the manifest never points to a deleted file
+            _write_manifest(self.output_dir, self.manifest)
+            for entry in removed:
+                path = os.path.join(self.output_dir, entry['name'])
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def wait(self):
+        """
+        Block until all submitted checkpoints are on disk.
+        """
+        if self.async_write:
+            self.queue.join()
+        self._check()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check()
+
+
+class _TensorRef(object):
+    """
+    Placeholder of a tensor in the structure of a sharded checkpoint.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+
+def _flatten(obj, tensors, prefix=()):
+    if torch.is_tensor(obj):
+        tensors[prefix] = obj
+        return _TensorRef(prefix)
+    elif isinstance(obj, dict):
+        return type(obj)((k, _flatten(v, tensors, prefix + (k,))) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_flatten(v, tensors, prefix + (i,)) for i, v in enumerate(obj))
+    return obj
+
+
+def _unflatten(obj, tensors):
+    if isinstance(obj, _TensorRef):
+        return tensors[obj.key]
+    elif isinstance(obj, dict):
+        return type(obj)((k, _unflatten(v, tensors)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_unflatten(v, tensors) for v in obj)
+    return obj
+
+
+def _assign_owners(tensors, world_size):
+    """
+    Balance the tensors over the ranks by size, largest first. Every rank holds the
+    same replicated state, so every rank computes the same assignment.
+    """
+    loads = [0] * world_size
+    owners = {}
+    for key in sorted(tensors, key=lambda k: (-tensors[k].numel() * tensors[k].element_size(), str(k))):
+        rank = loads.index(min(loads))
+        owners[key] = rank
+        loads[rank] += tensors[key].numel() * tensors[key].element_size()
+    return owners
+
+
+def _shard_name(rank, world_size):
+    return 'shard-%d-of-%d.pth' % (rank, world_size)
+
+
+def save_sharded(to_save, checkpoint_dir, rank, world_size):
+    """
+    Collective save of a checkpoint replicated on all ranks, each rank writing the
+    tensors it owns. The directory is complete once it has its final name.
+    """
+    checkpoint_dir = str(checkpoint_dir)
+    tmp_dir = checkpoint_dir + '.tmp'
+    if rank == 0 and os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    tensors = {}
+    skeleton = _flatten(to_save, tensors)
+    owners = _assign_owners(tensors, world_size)
+    shard = {key: t for key, t in tensors.items() if owners[key] == rank}
+    atomic_save(to_cpu(shard), os.path.join(tmp_dir, _shard_name(rank, world_size)))
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+    if rank == 0:
+        atomic_save({'world_size': world_size, 'skeleton': skeleton, 'owners': owners,
+                     'specs': _tensor_specs(tensors)},
+                    os.path.join(tmp_dir, 'metadata.pth'))
+        if os.path.isdir(checkpoint_dir):
+            shutil.rmtree(checkpoint_dir)
+        os.replace(tmp_dir, checkpoint_dir)
+        _fsync_dir(os.path.dirname(os.path.abspath(checkpoint_dir)))
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+
+
+def is_sharded(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'metadata.pth'))
+
+
+def load_sharded(checkpoint_dir, rank=0, world_size=1):
+    """
+    Collective load of a sharded checkpoint. Rank ``r`` reads the shards ``r``,
+    ``r + world_size``, ... of the saved world size and broadcasts their tensors, so each
+    rank returns the full checkpoint whatever the saved world size was.
+    """
+    checkpoint_dir = str(checkpoint_dir)
+    metadata = torch.load(os.path.join(checkpoint_dir, 'metadata.pth'), map_location='cpu')
+    saved_world_size = metadata['world_size']
+    tensors = {}
+    for shard_rank in range(saved_world_size):
+        shard_path = os.path.join(checkpoint_dir, _shard_name(shard_rank, saved_world_size))
+        reader = shard_rank % world_size
+        shard = load_mmap(shard_path) if rank == reader else None
+        if world_size > 1:
+            specs = [spec for spec in metadata['specs'] if metadata['owners'][spec[0]] == shard_rank]
+            shard = _broadcast_tensors(shard, specs, reader, None)
+        tensors.update(shard)
+    missing = [key for key in metadata['owners'] if key not in tensors]
+    assert len(missing) == 0, "Sharded checkpoint %s is missing tensors %s" % (checkpoint_dir, missing[:5])
+    return _unflatten(metadata['skeleton'], tensors)
+
+
+def consolidate(checkpoint_dir, path):
+    """
+    Write a sharded checkpoint as a single ``checkpoint-*.pth`` file.
+    """
+    atomic_save(load_sharded(checkpoint_dir), path)
+
+
+def file_sha256(path):
+    """
+    sha256 of a file. It is cached in a ``.sha256`` sidecar file keyed by the size and
+    mtime of the file, so a large backbone checkpoint is hashed once.
+    """
+    stat = os.stat(path)
+    sidecar = path + '.sha256'
+    try:
+        with open(sidecar, 'r') as f:
+            cached = json.load(f)
+        if cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['sha256']
+    except (OSError, ValueError, KeyError):
+        pass
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(16 * 2 ** 20), b''):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    try:
+        with open(sidecar + '.tmp', 'w') as f:
+            json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}, f)
+        os.replace(sidecar + '.tmp', sidecar)
+    except OSError:
+        # e.g. a read-only directory of pre-trained weights
+        pass
+    return digest
+
+
+def base_reference(path):
+    """
+    Reference to the base checkpoint of a delta checkpoint.
+    """
+    if path not in _base_references:
+        if path.startswith('https'):
+            # downloaded with check_hash=True, the URL identifies the content
+            _base_references[path] = {'path': path, 'sha256': None}
+        else:
+            _base_references[path] = {'path': os.path.abspath(path), 'sha256': file_sha256(path)}
+    return _base_references[path]
+
+
+def read_field(path, key):
+    """
+    A non-tensor entry of a checkpoint file or sharded checkpoint directory, or None.
+    """
+    if is_sharded(path):
+        checkpoint = load_mmap(os.path.join(path, 'metadata.pth'))['skeleton']
+    else:
+        checkpoint = load_mmap(path)
+    return checkpoint.get(key) if isinstance(checkpoint, dict) else None
+
+
+def resolve_delta_base(args, verify=True):
+    """
+    If ``args.resume`` is a delta checkpoint, make sure its frozen weights are loaded:
+    without ``--finetune`` the base checkpoint it references is used, otherwise
+    ``--finetune`` has to be that checkpoint. Call this before ``--finetune`` is loaded,
+    on every rank; only rank 0 reads ``args.resume`` and broadcasts the reference.
+    """
+    if not args.resume or args.resume.startswith('https'):
+        return
+    distributed = dist.is_available() and dist.is_initialized()
+    base = [None]
+    if (not distributed or dist.get_rank() == 0) and os.path.exists(args.resume):
+        base[0] = read_field(args.resume, 'base_checkpoint')
+    if distributed:
+        dist.broadcast_object_list(base, src=0)
+    base = base[0]
+    if base is None:
+        return
+    if not args.finetune:
+        assert base['path'].startswith('https') or os.path.exists(base['path']), \
+            "Base checkpoint %s of %s not found, pass it with --finetune" % (base['path'], args.resume)
+        args.finetune = base['path']
+        print("Delta checkpoint %s, load base checkpoint %s" % (args.resume, args.finetune))
+    elif verify and base['sha256'] is not None and not args.finetune.startswith('https'):
+        assert file_sha256(args.finetune) == base['sha256'], \
+            "--finetune %s is not the base checkpoint %s of %s" % (args.finetune, base['path'], args.resume)
+
+
+def load_mmap(path):
+    """
+    ``torch.load`` of a file written by ``torch.save``, with the tensor data memory-mapped
+    instead of read into private memory where torch supports it.
+    """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except TypeError:
+        # torch < 2.1
+        return torch.load(path, map_location='cpu')
+
+
+def _get_reader_group(mode, ranks_per_node=None):
+    """
+    Process group and source rank of this rank for ``load_broadcast``. Nodes are told
+    apart by hostname, or by consecutive blocks of ``ranks_per_node`` ranks if given.
+    Every rank has to create every group, so the groups are built once and cached.
+    """
+    key = (mode, ranks_per_node)
+    if key not in _reader_groups:
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        if mode == 'rank0':
+            nodes = [list(range(world_size))]
+        elif ranks_per_node:
+            nodes = [list(range(i, min(i + ranks_per_node, world_size))) for i in range(0, world_size, ranks_per_node)]
+        else:
+            hosts = [None] * world_size
+            dist.all_gather_object(hosts, socket.gethostname())
+            nodes = [[r for r in range(world_size) if hosts[r] == host] for host in sorted(set(hosts), key=hosts.index)]
+        if len(nodes) == 1:
+            _reader_groups[key] = (None, 0)
+        else:
+            for ranks in nodes:
+                group = dist.new_group(ranks)
+                if rank in ranks:
+                    _reader_groups[key] = (group, ranks[0])
+    return _reader_groups[key]
+
+
+def _buckets(specs, bucket_bytes, align=64):
+    """
+    Split (key, shape, dtype, nbytes) specs into buckets of at most ``bucket_bytes``,
+    with the byte offset of every tensor in its bucket.
+    """
+    buckets, bucket, size = [], [], 0
+    for spec in specs:
+        nbytes = spec[3]
+        if bucket and size + nbytes > bucket_bytes:
+            buckets.append((bucket, size))
+            bucket, size = [], 0
+        bucket.append((spec, size))
+        size += (nbytes + align - 1) // align * align
+    if bucket:
+        buckets.append((bucket, size))
+    return buckets
+
+
+def _tensor_specs(tensors):
+    return [(k, tuple(t.shape), t.dtype, t.numel() * t.element_size()) for k, t in tensors.items()]
+
+
+def _broadcast_tensors(tensors, specs, src, group, bucket_mb=256):
+    """
+    Broadcast the tensors ``src`` holds (``None`` on the other ranks) as byte buckets.
+    Returns them on every rank, on CPU.
+    """
+    is_src = dist.get_rank() == src
+    device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+    received = {}
+    for bucket, size in _buckets(specs, bucket_mb * 2 ** 20):
+        if is_src:
+            buffer = torch.empty(size, dtype=torch.uint8)
+            for (k, _, _, nbytes), offset in bucket:
+                buffer[offset:offset + nbytes] = tensors[k].contiguous().view(-1).view(torch.uint8)
+            buffer = buffer.to(device)
+        else:
+            buffer = torch.empty(size, dtype=torch.uint8, device=device)
+        dist.broadcast(buffer, src=src, group=group)
+        if not is_src:
+            buffer = buffer.cpu()
+            for (k, shape, dtype, nbytes), offset in bucket:
+                received[k] = buffer[offset:offset + nbytes].view(dtype).view(shape)
+    return tensors if is_src else received
+
+
+def load_broadcast(path, mode='node', bucket_mb=256, ranks_per_node=None):
+    """
+    Collective ``torch.load`` of ``path`` to CPU. With ``mode`` ``node`` the first rank of
+    every node, with ``rank0`` only rank 0, memory-maps the file and broadcasts its
+    tensors as byte buckets of ``bucket_mb`` MB; ``all`` memory-maps it on every rank.
+    """
+    if mode == 'all' or not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return load_mmap(path)
+    group, src = _get_reader_group(mode, ranks_per_node)
+    is_reader = dist.get_rank() == src
+    tensors = {}
+    if is_reader:
+        checkpoint = load_mmap(path)
+        meta = [_flatten(checkpoint, tensors), _tensor_specs(tensors)]
+    else:
+        meta = [None, None]
+    dist.broadcast_object_list(meta, src=src, group=group)
+    skeleton, specs = meta
+    received = _broadcast_tensors(tensors, specs, src, group, bucket_mb)
+    if is_reader:
+        return checkpoint
+    return _unflatten(skeleton, received)
+
+
+def cached_conversion(source, config, cache_dir, convert, load=load_mmap):
+    """
+    The state dict ``convert()`` computes from the checkpoint ``source`` for a model
+    described by ``config``, cached in ``cache_dir`` under the sha256 of the source and
+    the config. Rank 0 converts and writes the cache, the other ranks wait for it and
+    every rank loads the cached file with ``load``. Without a writable cache directory
+    every rank converts by itself. Rank 0 decides which of the two it is, so a
+    collective ``load`` is entered by all ranks or none.
+    """
+    distributed = dist.is_available() and dist.is_initialized()
+    name = os.path.splitext(os.path.basename(source))[0]
+    # cache file name and whether rank 0 has it
+    state = [None, False]
+    if not distributed or dist.get_rank() == 0:
+        config = dict(config, format=1, source_sha256=file_sha256(source))
+        key = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+        path = os.path.join(cache_dir, '%s-%s.pth' % (name, key))
+        if not os.path.exists(path):
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                atomic_save(convert(), path)
+                print("Converted %s into %s" % (source, path))
+            except OSError as e:
+                print("Cannot cache the converted checkpoint in %s: %s" % (cache_dir, e))
+        state = [path, os.path.exists(path)]
+    if distributed:
+        dist.broadcast_object_list(state, src=0)
+    path, cached = state
+    if cached:
+        print("Load converted checkpoint %s" % path)
+        return load(path)
+    return convert()
+
+
+def get_writer(args):
+    """
+    The checkpoint writer of ``args.output_dir``, created on first use from
+    ``args.async_ckpt`` and ``args.ckpt_keep_last``.
+    """
+    output_dir = str(args.output_dir)
+    if output_dir not in _writers:
+        _writers[output_dir] = CheckpointWriter(
+            output_dir, keep_last=getattr(args, 'ckpt_keep_last', 0),
+            async_write=getattr(args, 'async_ckpt', False))
+    return _writers[output_dir]
+
+
+@atexit.register
+def close_writers():
+    """
+    Finish all pending checkpoint writes, called at the end of training and at exit.
+    """
+    for writer in list(_writers.values()):
+        writer.close()
+    _writers.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Consolidate a sharded checkpoint into a single file')
+    parser.add_argument('checkpoint_dir', type=str)
+    parser.add_argument('output', type=str)
+    opts = parser.parse_args()
+    consolidate(opts.checkpoint_dir, opts.output)
@@ -0,0 +1,162 @@
+"""
+Per-clip load time of the training set (``--clip_timing``).
+
+``TimedDataset`` wraps the training set; every DataLoader worker appends
+``clip path <tab> seconds`` for each ``__getitem__`` (decode + augmentation) to its
+own file ``output_dir/clip_times/run{id}_epoch{e}_rank{r}_worker{w}.tsv``, where ``id``
+is set when the run starts, so a rerun or resume in the same output directory does not
+count the clips of an earlier run. After the epoch, ``report`` reads the files of the
+run and rank, gathers them on all ranks and rank 0 writes
+    slow_clips_epoch{e}.txt   histogram of the load times and the ``--clip_timing_topk``
+                              slowest clips
+    retranscode.txt           clips slower than ``--retranscode_threshold`` seconds,
+                              accumulated over epochs, one path per line
+and returns mean / p50 / p99 / max for ``log.txt``.
+"""
+import os
+import time
+import glob
+import numpy as np
+import torch
+import torch.distributed as dist
+
+import utils
+
+HIST_BINS = np.concatenate([[0.], np.logspace(-3, 2, 21), [np.inf]])
+
+
+class TimedDataset(object):
+    def __init__(self, dataset, out_dir):
+        self.dataset = dataset
+        self.out_dir = out_dir
+        self.rank = utils.get_rank()  # the process group is not there in the workers
+        self.run = '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        self.epoch = 0
+        self.file = None
+        self.file_key = None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, attr):
+        if attr == 'dataset':
+            raise AttributeError(attr)
+        return getattr(self.dataset, attr)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _file(self):
+        info = torch.utils.data.get_worker_info()
+        worker = 'main' if info is None else str(info.id)
+        key = (self.epoch, worker, os.getpid())
+        if self.file_key != key:
+            # workers are forked with the parent's state, open their own file
+            self.file = open(os.path.join(self.out_dir, 'run%s_epoch%d_rank%d_worker%s.tsv' % (
+                self.run, self.epoch, self.rank, worker)), 'a')
+            self.file_key = key
+        return self.file
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        sample = self.dataset[index]
+        elapsed = time.perf_counter() - start
+        samples = getattr(self.dataset, 'dataset_samples', None)
+        name = str(samples[index]) if samples is not None else str(index)
+        f = self._file()
+        f.write('%s\t%.6f\n' % (name, elapsed))
+        f.flush()
+        return sample
+
+    def read_epoch(self, epoch):
+        names, times = [], []
+        pattern = 'run%s_epoch%d_rank%d_worker*.tsv' % (self.run, epoch, self.rank)
+        for path in glob.glob(os.path.join(self.out_dir, pattern)):
+            with open(path, 'r') as f:
+                for line in f:
+                    name, _, seconds = line.rstrip('\n').rpartition('\t')
+                    if name:
+                        names.append(name)
+                        times.append(float(seconds))
+        return names, np.asarray(times, dtype=np.float64)
+
+
+class ClipTimer(object):
+    def __init__(self, dataset, output_dir, topk=20, retranscode_threshold=0.):
+        self.output_dir = output_dir
+        self.topk = topk
+        self.retranscode_threshold = retranscode_threshold
+        self.dataset = dataset
+
+    def set_epoch(self, epoch):
+        self.dataset.set_epoch(epoch)
+
+    def report(self, epoch, log_writer=None):
+        """
+        Collective over all ranks; returns the summary stats on every rank.
+        """
+        names, times = self.dataset.read_epoch(epoch)
+        order = np.argsort(-times)
+        keep = set(order[:self.topk].tolist())
+        if self.retranscode_threshold > 0:
+            keep.update(np.nonzero(times > self.retranscode_threshold)[0].tolist())
+        # every time for the histogram, but only the names that can make the report
+        local = (times, [(names[i], float(times[i])) for i in keep])
+        if utils.is_dist_avail_and_initialized():
+            gathered = [None] * utils.get_world_size()
+            dist.all_gather_object(gathered, local)
+        else:
+            gathered = [local]
+        times = np.concatenate([g[0] for g in gathered])
+        slow = sorted([c for g in gathered for c in g[1]], key=lambda c: -c[1])
+        if len(times) == 0:
+            return {}
+        stats = {'clip_time_mean': float(times.mean()), 'clip_time_p50': float(np.percentile(times, 50)),
+                 'clip_time_p99': float(np.percentile(times, 99)), 'clip_time_max': float(times.max())}
+        if utils.is_main_process():
+            self.write_report(epoch, times, slow, stats)
+            if log_writer is not None:
+                log_writer.update(head="clip_time", step=epoch, **stats)
+                if hasattr(log_writer, 'histogram'):
+                    log_writer.histogram("clip_time/seconds", times, epoch)
+        return stats
+
+    def write_report(self, epoch, times, slow, stats):
+        counts, _ = np.histogram(times, HIST_BINS)
+        path = os.path.join(self.output_dir, 'slow_clips_epoch%d.txt' % epoch)
+        with open(path, mode="w", encoding="utf-8") as f:
+            f.write("%d clips, " % len(times) + ", ".join("%s %.3fs" % (k[10:], v) for k, v in stats.items()) + "\n\n")
+            f.write("load time histogram\n")
+            for lo, hi, n in zip(HIST_BINS[:-1], HIST_BINS[1:], counts):
+                if n > 0:
+                    f.write("  %8.3fs - %8.3fs  %8d  %s\n" % (lo, hi, n, '#' * int(np.ceil(50. * n / counts.max()))))
+            f.write("\nslowest %d clips\n" % self.topk)
+            for name, seconds in slow[:self.topk]:
+                f.write("  %8.3fs  %s\n" % (seconds, name))
+        print("Slowest clips of epoch %d in %s" % (epoch, path))
+        if self.retranscode_threshold > 0:
+            path = os.path.join(self.output_dir, 'retranscode.txt')
+            listed = set()
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    listed = set(line.strip() for line in f)
+            new = sorted(set(name for name, seconds in slow if seconds > self.retranscode_threshold) - listed)
+            with open(path, 'a') as f:
+                for name in new:
+                    f.write(name + "\n")
+            if new:
+                print("%d clips slower than %.1fs added to %s" % (len(new), self.retranscode_threshold, path))
+
+
+def create_clip_timer(args, dataset):
+    """
+    Wrap ``dataset`` if ``--clip_timing`` is set, returns ``(dataset, clip_timer)``;
+    the timer is None otherwise.
+    """
+    if not args.clip_timing:
+        return dataset, None
+    assert args.output_dir, "--clip_timing needs --output_dir"
+    out_dir = os.path.join(args.output_dir, 'clip_times')
+    os.makedirs(out_dir, exist_ok=True)
+    dataset = TimedDataset(dataset, out_dir)
+    return dataset, ClipTimer(dataset, args.output_dir, args.clip_timing_topk, args.retranscode_threshold)
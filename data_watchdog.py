@@ -0,0 +1,193 @@
+"""
+Watchdog for training loops that stop receiving batches.
+
+``MonitoredDataset`` wraps the training set. Every ``__getitem__`` records, in shared
+memory, which index each DataLoader worker is loading, since when, and the worker's pid
+and last heartbeat. The training loop calls ``DataWatchdog.heartbeat`` for every batch;
+a thread in the main process fires when no batch arrived for ``--watchdog_timeout``
+seconds. It then
+    - dumps the Python stacks of the main process and of every worker (faulthandler,
+      workers on SIGUSR2) into ``output_dir/watchdog_rank{r}*.txt``,
+    - prints the clips in flight, how long they have been loading and how long ago
+      their worker last finished a clip: a worker that finished one recently is slow,
+      one that has not for much longer than the timeout is wedged,
+    - with ``--watchdog_action skip`` adds them to ``output_dir/watchdog_skip.txt``;
+      listed clips are replaced by another random clip from the next epoch (and in
+      later runs) on,
+    - with ``--watchdog_action abort`` also writes the skip list, then exits the
+      process so the job can be restarted with ``--auto_resume``.
+"""
+import os
+import sys
+import time
+import signal
+import random
+import threading
+import faulthandler
+import multiprocessing as mp
+
+import utils
+
+WORKER_DUMP_SIGNAL = signal.SIGUSR2
+
+
+def clip_name(dataset, index):
+    samples = getattr(dataset, 'dataset_samples', None)
+    if samples is not None and 0 <= index < len(samples):
+        return str(samples[index])
+    return 'index %d' % index
+
+
+def read_skip_list(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+class MonitoredDataset(object):
+    def __init__(self, dataset, num_workers, dump_prefix, skip_path=None):
+        self.dataset = dataset
+        slots = max(num_workers, 1)
+        self.index = mp.Array('q', [-1] * slots, lock=False)
+        self.started = mp.Array('d', slots, lock=False)
+        self.heartbeat = mp.Array('d', slots, lock=False)
+        self.pid = mp.Array('q', slots, lock=False)
+        self.dump_prefix = dump_prefix
+        self.skip_path = skip_path
+        self.skip = read_skip_list(skip_path) if skip_path else set()
+        self.dump_file = None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, attr):
+        # everything else (dataset_samples, label_array, ...) is the wrapped dataset's
+        if attr == 'dataset':
+            raise AttributeError(attr)
+        return getattr(self.dataset, attr)
+
+    def _slot(self):
+        import torch.utils.data
+        info = torch.utils.data.get_worker_info()
+        if info is None:
+            return 0
+        if self.dump_file is None:
+            # opened once per worker, the main process dumps the worker stacks with a signal
+            self.dump_file = open('%s_worker%d.txt' % (self.dump_prefix, info.id), 'a')
+            faulthandler.register(WORKER_DUMP_SIGNAL, file=self.dump_file, all_threads=True)
+        return info.id
+
+    def __getitem__(self, index):
+        slot = self._slot()
+        if self.skip and clip_name(self.dataset, index) in self.skip:
+            index = random.randrange(len(self.dataset))
+        self.pid[slot] = os.getpid()
+        self.index[slot] = index
+        self.started[slot] = time.time()
+        try:
+            return self.dataset[index]
+        finally:
+            self.index[slot] = -1
+            self.heartbeat[slot] = time.time()
+
+    def in_flight(self):
+        now = time.time()
+        return [(slot, self.pid[slot], self.index[slot], now - self.started[slot], now - self.heartbeat[slot])
+                for slot in range(len(self.index)) if self.index[slot] >= 0]
+
+    def add_skips(self, names):
+        self.skip.update(names)
+        if self.skip_path:
+            with open(self.skip_path, 'a') as f:
+                for name in names:
+                    f.write(name + "\n")
+
+
+class DataWatchdog(object):
+    def __init__(self, dataset, timeout, action='log', dump_prefix='watchdog', poll=5.):
+        assert action in ('log', 'skip', 'abort'), "Unknown watchdog action %s" % action
+        self.dataset = dataset
+        self.timeout = timeout
+        self.action = action
+        self.dump_prefix = dump_prefix
+        self.poll = poll
+        self.last_batch = time.time()
+        self.armed = False
+        self.fired = False
+        self.thread = threading.Thread(target=self._run, name='data-watchdog', daemon=True)
+        self.thread.start()
+
+    def arm(self):
+        self.last_batch = time.time()
+        self.fired = False
+        self.armed = True
+
+    def disarm(self):
+        self.armed = False
+
+    def heartbeat(self):
+        self.last_batch = time.time()
+        self.fired = False
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll)
+            if self.armed and not self.fired and time.time() - self.last_batch > self.timeout:
+                self.fired = True
+                try:
+                    self.fire()
+                except Exception as e:
+                    print("Watchdog failed: %s" % e)
+
+    def fire(self):
+        waited = time.time() - self.last_batch
+        path = '%s_%d.txt' % (self.dump_prefix, int(time.time()))
+        in_flight = self.dataset.in_flight()
+        with open(path, 'w') as f:
+            f.write("No batch for %.0fs\n" % waited)
+            for slot, pid, index, loading, idle in in_flight:
+                f.write("worker %d (pid %d) loading %s for %.0fs, last clip done %s\n" % (
+                    slot, pid, clip_name(self.dataset.dataset, index), loading, _ago(idle)))
+            f.write("\nMain process stacks:\n")
+            f.flush()
+            faulthandler.dump_traceback(file=f, all_threads=True)
+        for slot, pid, index, loading, idle in in_flight:
+            if pid > 0 and pid != os.getpid():
+                try:
+                    os.kill(pid, WORKER_DUMP_SIGNAL)
+                except OSError:
+                    pass
+        print("Watchdog [rank %d]: no batch for %.0fs, %d clip(s) in flight, stacks in %s and %s_worker*.txt" % (
+            utils.get_rank(), waited, len(in_flight), path, self.dump_prefix), file=sys.stderr, flush=True)
+        names = [clip_name(self.dataset.dataset, index) for _, _, index, _, _ in in_flight]
+        for name, (slot, _, _, loading, idle) in zip(names, in_flight):
+            print("    in flight: %s, worker %d loading for %.0fs, last clip done %s" % (
+                name, slot, loading, _ago(idle)), file=sys.stderr, flush=True)
+        if self.action in ('skip', 'abort') and names:
+            self.dataset.add_skips(names)
+        if self.action == 'abort':
+            time.sleep(1.)  # let the workers write their stacks
+            print("Watchdog: aborting", file=sys.stderr, flush=True)
+            os._exit(1)
+
+
+def _ago(seconds):
+    # the heartbeat is 0 until the worker has finished its first clip
+    if seconds > time.time() - 1.:
+        return "never"
+    return "%.0fs ago" % seconds
+
+
+def create_watchdog(args, dataset):
+    """
+    Wrap ``dataset`` and start the watchdog if ``--watchdog_timeout`` is set,
+    returns ``(dataset, watchdog)``; the watchdog is None otherwise.
+    """
+    if args.watchdog_timeout <= 0:
+        return dataset, None
+    out_dir = args.output_dir if args.output_dir else '.'
+    os.makedirs(out_dir, exist_ok=True)
+    prefix = os.path.join(out_dir, 'watchdog_rank%d' % utils.get_rank())
+    dataset = MonitoredDataset(dataset, args.num_workers, prefix, os.path.join(out_dir, 'watchdog_skip.txt'))
+    return dataset, DataWatchdog(dataset, args.watchdog_timeout, args.watchdog_action, prefix)
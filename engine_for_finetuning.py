@@ -6,16 +6,30 @@ from typing import Iterable, Optional
 import torch
 from mixup import Mixup
 from timm.utils import accuracy, ModelEma
+from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 import utils
 from scipy.special import softmax
 import torch.distributed as dist
 import time
+import multitask
+from optim_factory import set_lr_and_wd
+from precision import PrecisionPolicy
+from step_timing import create_timer
 def train_class_batch(model, samples, target, criterion):
     outputs = model(samples)
     loss = criterion(outputs, target)
     return loss, outputs
 
 
+def normalize_uint8(samples, mean=IMAGENET_DEFAULT_MEAN, std=IMAGENET_DEFAULT_STD):
+    """
+    Normalize a uint8 (B, C, T, H, W) batch, as collated by VideoCollateMixup, on its device.
+    """
+    mean = torch.tensor(mean, device=samples.device).view(1, -1, 1, 1, 1) * 255.
+    std = torch.tensor(std, device=samples.device).view(1, -1, 1, 1, 1) * 255.
+    return (samples.float() - mean) / std
+
+
 def get_loss_scale_for_deepspeed(model):
     optimizer = model.optimizer
     return optimizer.loss_scale if hasattr(optimizer, "loss_scale") else optimizer.cur_scale
@@ -26,48 +40,62 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     device: torch.device, epoch: int, loss_scaler, max_norm: float = 0,
                     model_ema: Optional[ModelEma] = None, mixup_fn: Optional[Mixup] = None, log_writer=None,
                     start_steps=None, lr_schedule_values=None, wd_schedule_values=None,
-                    num_training_steps_per_epoch=None, update_freq=None):
+                    num_training_steps_per_epoch=None, update_freq=None, task_spec=None, precision=None,
+                    step_timing=False, profiler=None, watchdog=None, flops=None):
     model.train(True)
+    if precision is None:
+        precision = PrecisionPolicy('auto', device)
+    timer = create_timer(step_timing, device, (
+        'data', 'h2d', 'mixup', 'forward', 'backward', 'grad_norm', 'optimizer', 'logging'))
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     metric_logger.add_meter('min_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 10
+    if flops is not None:
+        metric_logger.set_flops(flops.train_per_sample, flops.peak_tflops)
+    if task_spec is not None:
+        task_loss = multitask.TaskMeter(task_spec, device)
 
     if loss_scaler is None:
         model.zero_grad()
         model.micro_steps = 0
     else:
         optimizer.zero_grad()
-    # 这里卡住了
+    if watchdog is not None:
+        watchdog.arm()
     for data_iter_step, (samples, targets, _, _) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
-        # time1 = time.time()
-        if data_iter_step == 268:
-            print("stuck here")
+        timer.mark('data')
+        if watchdog is not None:
+            watchdog.heartbeat()
         step = data_iter_step // update_freq
         if step >= num_training_steps_per_epoch:
             continue
         it = start_steps + step  # global training iteration
         # Update LR & WD for the first acc
         if lr_schedule_values is not None or wd_schedule_values is not None and data_iter_step % update_freq == 0:
-            for i, param_group in enumerate(optimizer.param_groups):
-                if lr_schedule_values is not None:
-                    param_group["lr"] = lr_schedule_values[it] * param_group["lr_scale"]
-                if wd_schedule_values is not None and param_group["weight_decay"] > 0:
-                    param_group["weight_decay"] = wd_schedule_values[it]
+            set_lr_and_wd(optimizer,
+                          lr_schedule_values[it] if lr_schedule_values is not None else None,
+                          wd_schedule_values[it] if wd_schedule_values is not None else None)
 
+        metric_logger.add_samples(samples.shape[0])
         samples = samples.to(device, non_blocking=True)
         targets = targets.to(device, non_blocking=True)
+        if samples.dtype == torch.uint8:
+            samples = normalize_uint8(samples)
+        timer.mark('h2d')
 
         if mixup_fn is not None:
             samples, targets = mixup_fn(samples, targets)
+            timer.mark('mixup')
 
         if loss_scaler is None:
-            samples = samples.half()
+            # DeepSpeed casts the weights to its half type itself
+            samples = samples.to(next(model.parameters()).dtype)
             loss, output = train_class_batch(
                 model, samples, targets, criterion)
         else:
-            with torch.cuda.amp.autocast():
+            with precision.autocast():
                 loss, output = train_class_batch(
                     model, samples, targets, criterion)
 
@@ -76,10 +104,12 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
         if not math.isfinite(loss_value):
             print("Loss is {}, stopping training".format(loss_value))
             sys.exit(1)
+        timer.mark('forward')
 
         if loss_scaler is None:
             loss /= update_freq
             model.backward(loss)
+            timer.mark('backward')
             model.step()
 
             if (data_iter_step + 1) % update_freq == 0:
@@ -87,6 +117,7 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                 # Deepspeed will call step() & model.zero_grad() automatic
                 if model_ema is not None:
                     model_ema.update(model)
+                timer.mark('optimizer')
             grad_norm = None
             loss_scale_value = get_loss_scale_for_deepspeed(model)
         else:
@@ -97,18 +128,22 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             # grad_norm = None
             grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
                                     parameters=model.parameters(), create_graph=is_second_order,
-                                    update_grad=(data_iter_step + 1) % update_freq == 0)
+                                    update_grad=(data_iter_step + 1) % update_freq == 0, timer=timer)
             
             if (data_iter_step + 1) % update_freq == 0:
                 optimizer.zero_grad()
                 if model_ema is not None:
                     model_ema.update(model)
-            loss_scale_value = loss_scaler.state_dict()["scale"]
-        # time2 = time.time()
-        # print("Time taken: ", time2 -time1)
-        torch.cuda.synchronize()
+                timer.mark('optimizer')
+            loss_scale_value = loss_scaler.state_dict().get("scale")
+        utils.synchronize(device)
+
+        if task_spec is not None:
+            with torch.no_grad():
+                task_loss.update(criterion.per_sample(output, targets), targets)
+                output = task_spec.mask_logits(output, targets)
 
-        if mixup_fn is None:
+        if targets.ndim == 1:
             class_acc = (output.max(-1)[-1] == targets).float().mean()
         else:
             class_acc = None
@@ -140,19 +175,38 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             log_writer.update(grad_norm=grad_norm, head="opt")
 
             log_writer.set_step()
-
+        timer.mark('logging')
+        if profiler is not None:
+            profiler.step()
+    if watchdog is not None:
+        watchdog.disarm()
+
+    if model_ema is not None and hasattr(model_ema, 'synchronize'):
+        model_ema.synchronize()
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    if task_spec is not None:
+        task_loss.synchronize_between_processes()
+        stats.update(task_loss.summary('loss_'))
+    stats.update(metric_logger.throughput)
+    stats.update(timer.summary())
+    timer.log(log_writer, epoch)
+    return stats
 
 
 @torch.no_grad()
-def validation_one_epoch(data_loader, model, device, epoch, output_dir):
+def validation_one_epoch(data_loader, model, device, epoch, output_dir, task_spec=None, precision=None):
     criterion = torch.nn.CrossEntropyLoss()
 
     metric_logger = utils.MetricLogger(delimiter="  ")
     header = 'Val:'
+    if task_spec is not None:
+        task_acc = multitask.TaskMeter(task_spec, device)
+
+    if precision is None:
+        precision = PrecisionPolicy('auto', device)
 
     # switch to evaluation mode
     model.eval()
@@ -165,11 +219,15 @@ def validation_one_epoch(data_loader, model, device, epoch, output_dir):
         target = target.to(device, non_blocking=True)
 
         # compute output
-        with torch.cuda.amp.autocast():
+        with precision.autocast():
             output = model(videos)
+            if task_spec is not None:
+                output = task_spec.mask_logits(output, target)
             loss = criterion(output, target)
 
         acc1, acc5 = accuracy(output, target, topk=(1, 1))
+        if task_spec is not None:
+            task_acc.update((output.argmax(-1) == target).float(), target)
 
         batch_size = videos.shape[0]
         metric_logger.update(loss=loss.item())
@@ -178,11 +236,14 @@ def validation_one_epoch(data_loader, model, device, epoch, output_dir):
 
         # 新增：收集当前批次的所有进程数据 ----------------------------
         # 将 outputs 和 targets 从当前进程收集到所有进程
-        gathered_outputs = [torch.zeros_like(output) for _ in range(dist.get_world_size())]
-        gathered_targets = [torch.zeros_like(target) for _ in range(dist.get_world_size())]
+        gathered_outputs = [torch.zeros_like(output) for _ in range(utils.get_world_size())]
+        gathered_targets = [torch.zeros_like(target) for _ in range(utils.get_world_size())]
         
-        dist.all_gather(gathered_outputs, output)    # 同步 outputs
-        dist.all_gather(gathered_targets, target)    # 同步 targets
+        if utils.is_dist_avail_and_initialized():
+            dist.all_gather(gathered_outputs, output)    # 同步 outputs
+            dist.all_gather(gathered_targets, target)    # 同步 targets
+        else:
+            gathered_outputs, gathered_targets = [output], [target]
         
         # 合并数据并保存到全局列表（注意：所有进程都会保存完整数据）
         all_outputs.extend([o.cpu() for o in gathered_outputs])
@@ -192,7 +253,7 @@ def validation_one_epoch(data_loader, model, device, epoch, output_dir):
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     # newlly added
-    if dist.get_rank() == 0:
+    if utils.is_main_process():
         # 合并所有数据
         final_outputs = torch.cat(all_outputs, dim=0)
         final_targets = torch.cat(all_targets, dim=0)
@@ -204,22 +265,37 @@ def validation_one_epoch(data_loader, model, device, epoch, output_dir):
     print('* Acc@1 {top1.global_avg:.3f} Acc@5 {top5.global_avg:.3f} loss {losses.global_avg:.3f}'
           .format(top1=metric_logger.acc1, top5=metric_logger.acc5, losses=metric_logger.loss))
 
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    if task_spec is not None:
+        task_acc.synchronize_between_processes()
+        task_stats = task_acc.summary('acc1_', scale=100.)
+        if utils.is_main_process():
+            multitask.save_task_results(task_stats, os.path.join(output_dir, f"{epoch}_task_results.json"))
+        stats.update(task_stats)
+    return stats
 
 
 
 @torch.no_grad()
-def final_test(data_loader, model, device, file, output_dir):
+def final_test(data_loader, model, device, file, output_dir, task_spec=None, precision=None):
     criterion = torch.nn.CrossEntropyLoss()
 
     metric_logger = utils.MetricLogger(delimiter="  ")
     header = 'Test:'
 
+    if precision is None:
+        precision = PrecisionPolicy('auto', device)
+
     # switch to evaluation mode
     model.eval()
     all_outputs = []
     all_targets = []
-    final_result = []
+    # per-rank predictions, kept as arrays and written once as a binary file
+    pred_logits = []
+    pred_labels = []
+    pred_ids = []
+    pred_chunks = []
+    pred_splits = []
     
     for batch in metric_logger.log_every(data_loader, 1, header):
         videos = batch[0]
@@ -231,17 +307,18 @@ def final_test(data_loader, model, device, file, output_dir):
         target = target.to(device, non_blocking=True)
 
         # compute output
-        with torch.cuda.amp.autocast():
+        with precision.autocast():
             output = model(videos)
+            if task_spec is not None:
+                output = task_spec.mask_logits(output, target)
             loss = criterion(output, target)
 
-        for i in range(output.size(0)):
-            string = "{} {} {} {} {}\n".format(ids[i], \
-                                                str(output.data[i].cpu().numpy().tolist()), \
-                                                str(int(target[i].cpu().numpy())), \
-                                                str(int(chunk_nb[i].cpu().numpy())), \
-                                                str(int(split_nb[i].cpu().numpy())))
-            final_result.append(string)
+        # one device-to-host transfer per batch instead of one per sample
+        pred_logits.append(output.detach().float().cpu().numpy())
+        pred_labels.append(target.cpu().numpy())
+        pred_ids.extend(str(i) for i in (ids.tolist() if torch.is_tensor(ids) else ids))
+        pred_chunks.append(np.asarray(chunk_nb))
+        pred_splits.append(np.asarray(split_nb))
 
         acc1, acc5 = accuracy(output, target, topk=(1, 1))
         # 取消注释
@@ -251,25 +328,23 @@ def final_test(data_loader, model, device, file, output_dir):
         metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
         # 新增：收集当前批次的所有进程数据 ----------------------------
         # 将 outputs 和 targets 从当前进程收集到所有进程
-        gathered_outputs = [torch.zeros_like(output) for _ in range(dist.get_world_size())]
-        gathered_targets = [torch.zeros_like(target) for _ in range(dist.get_world_size())]
+        gathered_outputs = [torch.zeros_like(output) for _ in range(utils.get_world_size())]
+        gathered_targets = [torch.zeros_like(target) for _ in range(utils.get_world_size())]
         
-        dist.all_gather(gathered_outputs, output)    # 同步 outputs
-        dist.all_gather(gathered_targets, target)    # 同步 targets
+        if utils.is_dist_avail_and_initialized():
+            dist.all_gather(gathered_outputs, output)    # 同步 outputs
+            dist.all_gather(gathered_targets, target)    # 同步 targets
+        else:
+            gathered_outputs, gathered_targets = [output], [target]
         
         # 合并数据并保存到全局列表（注意：所有进程都会保存完整数据）
         all_outputs.extend([o.cpu() for o in gathered_outputs])
         all_targets.extend([t.cpu() for t in gathered_targets])
-    if not os.path.exists(file):
-        os.mknod(file)
-    with open(file, 'w') as f:
-        f.write("{}, {}\n".format(acc1, acc5))
-        for line in final_result:
-            f.write(line)
+    save_predictions(file, pred_logits, pred_labels, pred_ids, pred_chunks, pred_splits)
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     # 取消注释
-    if dist.get_rank() == 0:
+    if utils.is_main_process():
         # 合并所有数据
         final_outputs = torch.cat(all_outputs, dim=0)
         final_targets = torch.cat(all_targets, dim=0)
@@ -284,53 +359,71 @@ def final_test(data_loader, model, device, file, output_dir):
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
-def merge(eval_path, num_tasks):
-    dict_feats = {}
-    dict_label = {}
-    dict_pos = {}
-    print("Reading individual output files")
+def save_predictions(file, logits, labels, ids, chunks, splits):
+    """
+    Write the predictions of one rank as a binary ``.npz`` file that ``merge`` reads back.
+    A rank without test batches writes empty arrays.
+    """
+    np.savez(file,
+             logits=np.concatenate(logits) if logits else np.zeros((0, 0), dtype=np.float32),
+             labels=_concat_int(labels),
+             ids=np.asarray(ids, dtype=str),
+             chunks=_concat_int(chunks),
+             splits=_concat_int(splits))
+
+
+def _concat_int(arrays):
+    if not arrays:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(arrays).astype(np.int64)
+
 
+def load_predictions(eval_path, num_tasks):
+    logits, labels, ids, chunks, splits = [], [], [], [], []
     for x in range(num_tasks):
-        file = os.path.join(eval_path, str(x) + '.txt')
-        lines = open(file, 'r').readlines()[1:]
-        for line in lines:
-            line = line.strip()
-            name = line.split('[')[0]
-            label = line.split(']')[1].split(' ')[1]
-            chunk_nb = line.split(']')[1].split(' ')[2]
-            split_nb = line.split(']')[1].split(' ')[3]
-            data = np.fromstring(line.split('[')[1].split(']')[0], dtype=np.float, sep=',')
-            data = softmax(data)
-            if not name in dict_feats:
-                dict_feats[name] = []
-                dict_label[name] = 0
-                dict_pos[name] = []
-            if chunk_nb + split_nb in dict_pos[name]:
-                continue
-            dict_feats[name].append(data)
-            dict_pos[name].append(chunk_nb + split_nb)
-            dict_label[name] = label
-    print("Computing final results")
+        file = os.path.join(eval_path, str(x) + '.npz')
+        with np.load(file) as preds:
+            # the logits of an empty rank have no class dimension
+            if len(preds['logits']) > 0:
+                logits.append(preds['logits'])
+            labels.append(preds['labels'])
+            ids.append(preds['ids'])
+            chunks.append(preds['chunks'])
+            splits.append(preds['splits'])
+    logits = np.concatenate(logits) if logits else np.zeros((0, 0), dtype=np.float32)
+    return (logits, np.concatenate(labels), np.concatenate(ids),
+            np.concatenate(chunks), np.concatenate(splits))
+
+
+def merge(eval_path, num_tasks, task_spec=None):
+    print("Reading individual output files")
+    logits, labels, ids, chunks, splits = load_predictions(eval_path, num_tasks)
 
-    input_lst = []
-    print(len(dict_feats))
-    for i, item in enumerate(dict_feats):
-        input_lst.append([i, item, dict_feats[item], dict_label[item]])
-    from multiprocessing import Pool
-    p = Pool(64)
-    ans = p.map(compute_video, input_lst)
-    top1 = [x[1] for x in ans]
-    top5 = [x[2] for x in ans]
-    pred = [x[0] for x in ans]
-    label = [x[3] for x in ans]
+    print("Computing final results")
+    probs = softmax(logits.astype(np.float64), axis=1)
+    video_names, video_idx = np.unique(ids, return_inverse=True)
+    video_idx = video_idx.reshape(-1)
+    # the distributed sampler pads ranks with repeated clips, count every (video, chunk, split) view once
+    _, keep = np.unique(np.stack([video_idx, chunks, splits], axis=1), axis=0, return_index=True)
+    keep = np.sort(keep)
+    probs, labels, video_idx = probs[keep], labels[keep], video_idx[keep]
+
+    # average the softmax of all views of a video
+    order = np.argsort(video_idx, kind='stable')
+    video_idx = video_idx[order]
+    starts = np.flatnonzero(np.r_[True, video_idx[1:] != video_idx[:-1]])
+    counts = np.diff(np.r_[starts, len(video_idx)])
+    feats = np.add.reduceat(probs[order], starts, axis=0) / counts[:, None]
+    label = labels[order][starts + counts - 1]
+    print(len(video_names))
+
+    pred = np.argmax(feats, axis=1)
+    top1 = (pred == label) * 1.0
+    top5 = (pred == label) * 1.0
+    if task_spec is not None:
+        task_results = multitask.video_task_results(task_spec, pred, label)
+        for name, result in task_results.items():
+            print(f"{name}: Top-1 {result['top1']:.2f}% on {result['num_videos']} videos")
+        multitask.save_task_results(task_results, os.path.join(eval_path, "task_results.json"))
     final_top1 ,final_top5 = np.mean(top1), np.mean(top5)
     return final_top1*100 ,final_top5*100
-
-def compute_video(lst):
-    i, video_id, data, label = lst
-    feat = [x for x in data]
-    feat = np.mean(feat, axis=0)
-    pred = np.argmax(feat)
-    top1 = (int(pred) == int(label)) * 1.0
-    top5 = (int(pred) == int(label)) * 1.0
-    return [pred, top1, top5, int(label)]
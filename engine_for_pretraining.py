@@ -5,34 +5,49 @@ import torch
 import torch.nn as nn
 import utils
 from einops import rearrange
+from optim_factory import set_lr_and_wd
+from precision import PrecisionPolicy
+from step_timing import create_timer
 from timm.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 
 def train_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, loss_scaler, max_norm: float = 0, patch_size: int = 16, 
                     normlize_target: bool = True, log_writer=None, lr_scheduler=None, start_steps=None,
-                    lr_schedule_values=None, wd_schedule_values=None):
+                    lr_schedule_values=None, wd_schedule_values=None, precision=None, step_timing=False,
+                    profiler=None, watchdog=None, flops=None):
     model.train()
+    if precision is None:
+        precision = PrecisionPolicy('auto', device)
+    timer = create_timer(step_timing, device, (
+        'data', 'h2d', 'mask', 'forward', 'backward', 'grad_norm', 'optimizer', 'logging'))
     metric_logger = utils.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     metric_logger.add_meter('min_lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 10
+    if flops is not None:
+        metric_logger.set_flops(flops.train_per_sample, flops.peak_tflops)
 
     loss_func = nn.MSELoss()
 
+    if watchdog is not None:
+        watchdog.arm()
     for step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+        timer.mark('data')
+        if watchdog is not None:
+            watchdog.heartbeat()
         # assign learning rate & weight decay for each step
         it = start_steps + step  # global training iteration
         if lr_schedule_values is not None or wd_schedule_values is not None:
-            for i, param_group in enumerate(optimizer.param_groups):
-                if lr_schedule_values is not None:
-                    param_group["lr"] = lr_schedule_values[it] * param_group["lr_scale"]
-                if wd_schedule_values is not None and param_group["weight_decay"] > 0:
-                    param_group["weight_decay"] = wd_schedule_values[it]
+            set_lr_and_wd(optimizer,
+                          lr_schedule_values[it] if lr_schedule_values is not None else None,
+                          wd_schedule_values[it] if wd_schedule_values is not None else None)
 
         videos, bool_masked_pos = batch
+        metric_logger.add_samples(videos.shape[0])
         videos = videos.to(device, non_blocking=True)
         bool_masked_pos = bool_masked_pos.to(device, non_blocking=True).flatten(1).to(torch.bool)
+        timer.mark('h2d')
 
         with torch.no_grad():
             # calculate the predict label
@@ -51,8 +66,9 @@ def train_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimizer: to
 
             B, _, C = videos_patch.shape
             labels = videos_patch[bool_masked_pos].reshape(B, -1, C)
+        timer.mark('mask')
 
-        with torch.cuda.amp.autocast():
+        with precision.autocast():
             outputs = model(videos, bool_masked_pos)
             loss = loss_func(input=outputs, target=labels)
 
@@ -61,15 +77,17 @@ def train_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimizer: to
         if not math.isfinite(loss_value):
             print("Loss is {}, stopping training".format(loss_value))
             sys.exit(1)
+        timer.mark('forward')
 
         optimizer.zero_grad()
         # this attribute is added by timm on one optimizer (adahessian)
         is_second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
         grad_norm = loss_scaler(loss, optimizer, clip_grad=max_norm,
-                                parameters=model.parameters(), create_graph=is_second_order)
-        loss_scale_value = loss_scaler.state_dict()["scale"]
+                                parameters=model.parameters(), create_graph=is_second_order, timer=timer)
+        timer.mark('optimizer')
+        loss_scale_value = loss_scaler.state_dict().get("scale")
 
-        torch.cuda.synchronize()
+        utils.synchronize(device)
 
         metric_logger.update(loss=loss_value)
         metric_logger.update(loss_scale=loss_scale_value)
@@ -99,7 +117,16 @@ def train_one_epoch(model: torch.nn.Module, data_loader: Iterable, optimizer: to
 
         if lr_scheduler is not None:
             lr_scheduler.step_update(start_steps + step)
+        timer.mark('logging')
+        if profiler is not None:
+            profiler.step()
+    if watchdog is not None:
+        watchdog.disarm()
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats.update(metric_logger.throughput)
+    stats.update(timer.summary())
+    timer.log(log_writer, epoch)
+    return stats
@@ -0,0 +1,421 @@
+"""
+Frozen-backbone feature cache for linear probing.
+
+With a frozen backbone only ``model.head`` is trained, so the backbone features of
+every clip/view can be extracted once into memory-mapped ``.npy`` files and the head
+trained for all epochs from there. ``K`` augmentation draws of the training set can be
+cached; epoch ``e`` then trains on draw ``e % K``.
+
+The same cache holds the token outputs of the frozen lower blocks when only the top
+blocks are fine-tuned (``lower_blocks_forward`` / ``UpperBlocks``). Those are stored in
+fp16 or in int8 with one fp16 absmax scale per token (``*_scale.npy``).
+
+Every cache lives in a ``{key}`` subdirectory of the cache directory, where ``key``
+hashes what the features depend on (model, ``--finetune`` checkpoint, dataset, clip
+size and sampling, cache dtype, world size); the key is also stored in every
+``_meta.npz`` and a cache with another key is extracted again.
+
+Layout of a cache (one set of files per rank):
+    train_draw{k}_rank{r}.npy / train_draw{k}_rank{r}_meta.npz
+    validation_rank{r}.npy    / validation_rank{r}_meta.npz
+    test_rank{r}.npy          / test_rank{r}_meta.npz
+"""
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.utils.checkpoint as checkpoint
+from numpy.lib.format import open_memmap
+
+import utils
+import checkpoint_io
+from precision import PrecisionPolicy
+
+
+class FeatureHead(nn.Module):
+    """
+    The trainable part of a frozen-backbone classifier, applied to cached features.
+    Parameter names are the same as in the full model (``head.weight``, ``head.bias``).
+    """
+    # only part of the full model, saved as a trainable-only checkpoint on its base
+    partial_model = True
+
+    def __init__(self, model):
+        super().__init__()
+        self.fc_dropout = getattr(model, 'fc_dropout', nn.Identity())
+        self.head = model.head
+        self.num_layers = model.get_num_layers()
+
+    def get_num_layers(self):
+        return self.num_layers
+
+    def no_weight_decay(self):
+        return set()
+
+    def forward(self, x):
+        return self.head(self.fc_dropout(x))
+
+
+class FrozenBackboneClassifier(nn.Module):
+    """
+    Training wrapper for a frozen backbone. The backbone runs under ``torch.no_grad()``
+    so no autograd graph is built through it, and only ``head`` (a ``FeatureHead``,
+    possibly wrapped in DDP) takes part in backward and gradient synchronization.
+    ``inference_mode`` is not used because the head has to save its input for backward.
+    Like DDP, the wrapped model is available as ``module``.
+    """
+
+    def __init__(self, model, head):
+        super().__init__()
+        self.module = model
+        self.head = head
+
+    def forward(self, x):
+        with torch.no_grad():
+            features = self.module.forward_features(x)
+        return self.head(features)
+
+
+def lower_blocks_forward(model, num_blocks):
+    """
+    Forward function returning the token outputs ``(B, N, C)`` of the patch embedding
+    and the first ``num_blocks`` blocks of a ViT, as computed in ``forward_features``.
+    """
+    def forward(x):
+        x = model.patch_embed(x)
+        B, _, _ = x.size()
+        if model.pos_embed is not None:
+            x = x + model.pos_embed.expand(B, -1, -1).type_as(x).to(x.device).clone().detach()
+        x = model.pos_drop(x)
+        for blk in model.blocks[:num_blocks]:
+            x = blk(x)
+        return x
+    return forward
+
+
+class UpperBlocks(nn.Module):
+    """
+    The trainable top of a ViT, applied to cached outputs of its lower blocks. ``blocks``
+    is the full block list of the model, so parameter names and layer ids are the same
+    as in the full model; the lower blocks are frozen and skipped in ``forward``.
+    """
+    partial_model = True
+
+    def __init__(self, model, start):
+        super().__init__()
+        self.start = start
+        self.blocks = model.blocks
+        self.norm = model.norm
+        self.fc_norm = model.fc_norm
+        self.fc_dropout = getattr(model, 'fc_dropout', nn.Identity())
+        self.head = model.head
+        self.use_checkpoint = getattr(model, 'use_checkpoint', False)
+        self.num_layers = model.get_num_layers()
+
+    def get_num_layers(self):
+        return self.num_layers
+
+    def no_weight_decay(self):
+        return set()
+
+    def forward(self, x):
+        for blk in self.blocks[self.start:]:
+            if self.use_checkpoint:
+                x = checkpoint.checkpoint(blk, x)
+            else:
+                x = blk(x)
+        x = self.norm(x)
+        if self.fc_norm is not None:
+            x = self.fc_norm(x.mean(1))
+        else:
+            x = x[:, 0]
+        return self.head(self.fc_dropout(x))
+
+
+def _shard_paths(root, name, world_size):
+    paths = [os.path.join(root, '%s_rank%d.npy' % (name, rank)) for rank in range(world_size)]
+    for path in paths:
+        assert os.path.exists(path), "Cached features %s not found" % path
+    return paths
+
+
+def cache_key(args, dtype, precision, extra=None):
+    """
+    Hash of the settings the cached features depend on, ``precision`` is the
+    ``PrecisionPolicy`` of the extraction. Rank 0 hashes the ``--finetune`` checkpoint
+    and broadcasts the key.
+    """
+    key = [None]
+    if utils.is_main_process():
+        config = dict(format=2, model=args.model, dtype=dtype, world_size=utils.get_world_size(),
+                      finetune=checkpoint_io.base_reference(args.finetune) if args.finetune else None,
+                      precision=precision.precision, fp32_modules=list(precision.fp32_modules))
+        for name in ('use_mean_pooling', 'data_set', 'data_path', 'num_frames', 'num_segments', 'sampling_rate',
+                     'input_size', 'short_side_size', 'tubelet_size', 'num_sample', 'test_num_segment',
+                     'test_num_crop'):
+            config[name] = getattr(args, name, None)
+        config.update(extra or {})
+        key[0] = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+    if utils.is_dist_avail_and_initialized():
+        dist.broadcast_object_list(key, src=0)
+    return key[0]
+
+
+def _cached_key(prefix):
+    try:
+        return str(np.load(prefix + '_meta.npz')['config_key'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _scale_path(path):
+    return path[:-len('.npy')] + '_scale.npy'
+
+
+class FeatureStore(torch.utils.data.Dataset):
+    """
+    Dataset over cached features. Items have the same layout as the video datasets:
+    ``train`` -> (feature, label, index, {}), ``validation`` -> (feature, label, id),
+    ``test`` -> (feature, label, id, chunk_nb, split_nb).
+    """
+
+    def __init__(self, root, names, mode, world_size=1):
+        self.root = root
+        self.mode = mode
+        self.names = names
+        self.draw = 0
+        self.shards = [_shard_paths(root, name, world_size) for name in names]
+        self.meta = []
+        for paths in self.shards:
+            metas = [np.load(p[:-len('.npy')] + '_meta.npz') for p in paths]
+            self.meta.append({k: np.concatenate([m[k] for m in metas]) for k in metas[0].files if metas[0][k].ndim > 0})
+        sizes = [len(m['labels']) for m in self.meta]
+        assert len(set(sizes)) == 1, "All cached draws must have the same number of rows"
+        self.offsets = [np.cumsum([0] + [len(np.load(p, mmap_mode='r')) for p in paths]) for paths in self.shards]
+        self.quantized = [os.path.exists(_scale_path(paths[0])) for paths in self.shards]
+        self._features = None
+        self._scales = None
+
+    def set_epoch(self, epoch):
+        if len(self.names) > 1:
+            self.draw = epoch % len(self.names)
+            self._features = None
+            self._scales = None
+
+    def _open(self):
+        # opened lazily so that the store can be passed around without holding file handles
+        if self._features is None:
+            self._features = [np.load(p, mmap_mode='r') for p in self.shards[self.draw]]
+            if self.quantized[self.draw]:
+                self._scales = [np.load(_scale_path(p), mmap_mode='r') for p in self.shards[self.draw]]
+        return self._features
+
+    def __len__(self):
+        return len(self.meta[0]['labels'])
+
+    def __getitem__(self, index):
+        features = self._open()
+        offsets = self.offsets[self.draw]
+        shard = int(np.searchsorted(offsets, index, side='right')) - 1
+        feature = np.asarray(features[shard][index - offsets[shard]], dtype=np.float32)
+        if self._scales is not None:
+            feature *= np.asarray(self._scales[shard][index - offsets[shard]], dtype=np.float32)[..., None]
+        feature = torch.from_numpy(feature)
+        meta = self.meta[self.draw]
+        label = int(meta['labels'][index])
+        if self.mode == 'train':
+            return feature, label, index, {}
+        elif self.mode == 'validation':
+            return feature, label, str(meta['ids'][index])
+        else:
+            return feature, label, str(meta['ids'][index]), int(meta['chunks'][index]), int(meta['splits'][index])
+
+
+def quantize_int8(x):
+    """
+    Symmetric int8 quantization with one absmax scale per vector along the last dim.
+    """
+    scale = x.float().abs().amax(dim=-1).clamp_(min=1e-8) / 127.
+    q = torch.round(x.float() / scale.unsqueeze(-1)).clamp_(-127, 127).to(torch.int8)
+    return q, scale.half()
+
+
+@torch.no_grad()
+def extract_features(model, data_loader, device, prefix, num_rows, mode, forward_fn=None, dtype='fp16',
+                     precision=None, key=''):
+    """
+    Run the backbone (``model.forward_features`` unless ``forward_fn`` is given) over
+    ``data_loader`` once and write the features to ``prefix.npy``, as fp16 or as int8
+    with the scales in ``prefix_scale.npy``.
+    The metadata file is written last, so its presence marks a complete cache.
+    """
+    assert dtype in ('fp16', 'int8'), "Unknown cache dtype %s" % dtype
+    if forward_fn is None:
+        forward_fn = model.forward_features
+    if precision is None:
+        precision = PrecisionPolicy('auto', device)
+    model.eval()
+    metric_logger = utils.MetricLogger(delimiter="  ")
+    header = 'Extract [{}]:'.format(os.path.basename(prefix))
+    features = None
+    scales = None
+    rows = 0
+    labels, ids, chunks, splits = [], [], [], []
+    start_time = time.time()
+    for batch in metric_logger.log_every(data_loader, 10, header):
+        videos = batch[0].to(device, non_blocking=True)
+        with precision.autocast():
+            output = forward_fn(videos)
+        if dtype == 'int8':
+            output, scale = quantize_int8(output)
+            scale = scale.cpu().numpy()
+            if scales is None:
+                scales = open_memmap(_scale_path(prefix + '.npy'), mode='w+', dtype=np.float16,
+                                     shape=(num_rows,) + scale.shape[1:])
+            scales[rows:rows + len(scale)] = scale
+        else:
+            output = output.half()
+        output = output.cpu().numpy()
+        if features is None:
+            features = open_memmap(prefix + '.npy', mode='w+', dtype=output.dtype, shape=(num_rows,) + output.shape[1:])
+        features[rows:rows + len(output)] = output
+        rows += len(output)
+
+        labels.append(np.asarray(batch[1]))
+        batch_ids = batch[2].tolist() if torch.is_tensor(batch[2]) else batch[2]
+        ids.extend(str(i) for i in batch_ids)
+        if mode == 'test':
+            chunks.append(np.asarray(batch[3]))
+            splits.append(np.asarray(batch[4]))
+    assert rows == num_rows, "Expected %d feature rows, extracted %d" % (num_rows, rows)
+    features.flush()
+    del features
+    if scales is not None:
+        scales.flush()
+        del scales
+
+    meta = dict(labels=np.concatenate(labels).astype(np.int64), ids=np.asarray(ids, dtype=str),
+                extract_seconds=np.asarray(time.time() - start_time), config_key=np.asarray(key))
+    if mode == 'test':
+        meta['chunks'] = np.concatenate(chunks).astype(np.int64)
+        meta['splits'] = np.concatenate(splits).astype(np.int64)
+    tmp_file = prefix + '_meta.tmp.npz'
+    np.savez(tmp_file, **meta)
+    os.replace(tmp_file, prefix + '_meta.npz')
+
+
+def build_feature_stores(args, model, device, dataset_train, dataset_val, dataset_test, collate_func=None,
+                         root=None, forward_fn=None, dtype='fp16', precision=None, extra_config=None):
+    """
+    Extract (or reuse) the cached features of the train/validation/test sets and return
+    a dict of ``FeatureStore`` plus, per set, the number of draws and the time the
+    extraction took (in this run or when the cache was written), from the ``_meta.npz``.
+    ``extra_config`` goes into the cache key, e.g. the number of cached blocks.
+    """
+    if root is None:
+        root = args.feature_cache_dir if args.feature_cache_dir else os.path.join(args.output_dir, 'feature_cache')
+    if precision is None:
+        precision = PrecisionPolicy('auto', device)
+    key = cache_key(args, dtype, precision, extra_config)
+    root = os.path.join(root, key)
+    os.makedirs(root, exist_ok=True)
+    num_tasks = utils.get_world_size()
+    global_rank = utils.get_rank()
+
+    stores = {'extract_time': {}, 'draws': {}}
+    for mode, dataset, draws in (('train', dataset_train, args.feature_cache_draws),
+                                 ('validation', dataset_val, 1),
+                                 ('test', dataset_test, 1)):
+        if dataset is None:
+            stores[mode] = None
+            continue
+        sampler = torch.utils.data.DistributedSampler(
+            dataset, num_replicas=num_tasks, rank=global_rank, shuffle=False)
+        data_loader = torch.utils.data.DataLoader(
+            dataset, sampler=sampler,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_mem,
+            drop_last=False,
+            collate_fn=collate_func if mode == 'train' else None,
+        )
+        num_rows = len(sampler) * (args.num_sample if mode == 'train' else 1)
+        names = []
+        for draw in range(draws):
+            name = 'train_draw%d' % draw if mode == 'train' else mode
+            prefix = os.path.join(root, '%s_rank%d' % (name, global_rank))
+            cached_key = _cached_key(prefix)
+            if cached_key == key:
+                print("Reuse cached features %s" % prefix)
+            else:
+                if cached_key is not None:
+                    print("Cached features %s are from another config, extracting again" % prefix)
+                extract_features(model, data_loader, device, prefix, num_rows, mode,
+                                 forward_fn=forward_fn, dtype=dtype, precision=precision, key=key)
+            stores['extract_time'][mode] = stores['extract_time'].get(mode, 0.) + \
+                float(np.load(prefix + '_meta.npz')['extract_seconds'])
+            names.append(name)
+        if utils.is_dist_avail_and_initialized():
+            dist.barrier()
+        stores[mode] = FeatureStore(root, names, mode, num_tasks)
+        stores['draws'][mode] = len(names)
+        print("Feature store %s: %d rows, %d draw(s)" % (mode, len(stores[mode]), len(names)))
+    return stores
+
+
+def build_feature_loaders(args, stores, num_workers=0):
+    """
+    Data loaders over the cached features. A training batch holds ``batch_size * num_sample``
+    rows, the same number of views as a batch of the video loader.
+    """
+    num_tasks = utils.get_world_size()
+    global_rank = utils.get_rank()
+    # pooled features are read from the page cache through memmaps, worker processes would
+    # only add copies; token caches are large enough for the reads to be worth overlapping
+    loaders = []
+    for mode, batch_size, shuffle in (('train', args.batch_size * args.num_sample, True),
+                                      ('validation', int(1.5 * args.batch_size), False),
+                                      ('test', args.batch_size, False)):
+        store = stores[mode]
+        if store is None:
+            loaders.append(None)
+            continue
+        sampler = torch.utils.data.DistributedSampler(
+            store, num_replicas=num_tasks, rank=global_rank, shuffle=shuffle)
+        loaders.append(torch.utils.data.DataLoader(
+            store, sampler=sampler,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            pin_memory=args.pin_mem,
+            drop_last=mode == 'train',
+        ))
+    return loaders
+
+
+def report_speedup(stores, num_epochs, train_time):
+    """
+    Compare the cached run with an estimate of the uncached one over the same epochs;
+    no uncached epoch is run, so the uncached time and the speedup are estimates.
+    ``train_time`` is the measured epoch loop of the cached run (training and validation
+    of the trained part). The uncached run is estimated as the same plus, every epoch, a
+    frozen pass over the training set (one draw) and the validation set, timed during the
+    extraction; the cached run adds the extraction of all draws and the validation set
+    once. The test set is left out of both.
+    """
+    extract_time = stores['extract_time']
+    epoch_pass = extract_time['train'] / stores['draws']['train'] + extract_time.get('validation', 0.)
+    extraction = extract_time['train'] + extract_time.get('validation', 0.)
+    uncached_time = train_time + epoch_pass * num_epochs
+    cached_time = train_time + extraction
+    speedup = uncached_time / max(cached_time, 1e-6)
+    print("Feature cache: frozen pass %.1fs/epoch, extraction %.1fs, cached epochs %.1fs, "
+          "estimated uncached %.1fs vs cached %.1fs, estimated speedup %.2fx over %d epochs" % (
+              epoch_pass, extraction, train_time, uncached_time, cached_time, speedup, num_epochs))
+    return {'feature_cache_extract_time': extraction,
+            'feature_cache_train_time': train_time,
+            'feature_cache_estimated_uncached_time': uncached_time,
+            'feature_cache_estimated_speedup': speedup}
@@ -0,0 +1,125 @@
+"""
+Analytic FLOPs of the VideoMAE ViTs and the peak FLOP/s of the device, for the
+TFLOP/s and MFU (model FLOPs utilization) columns of the training logs.
+
+Counted per sample from the modules of the model as built by ``create_model``: the
+patch embedding convolution over all ``num_frames / tubelet_size * (input_size /
+patch_size) ** 2`` tubes, every Linear of the blocks plus the two attention matmuls,
+the head; for pretraining the encoder only sees the visible tokens, the decoder all
+of them and its head predicts the masked ones. One multiply-add is 2 FLOPs; norms,
+softmax and activations are left out. Training is forward + 2 x forward for every
+part from the first trainable one on; activation checkpointing recompute is not
+model FLOPs and not counted.
+
+The peak is ``--peak_tflops``, either one number or per device type
+(``cuda=312,cpu=2.5``); without it, known GPUs are looked up in ``PEAK_TFLOPS``. MFU
+is only reported with a peak.
+"""
+import torch
+import torch.nn as nn
+
+# dense tensor core TFLOP/s for (fp16 / bf16, fp32), matched on the device name
+PEAK_TFLOPS = [
+    ('H100 PCIe', (756., 51.)),
+    ('H100', (989., 67.)),
+    ('A100', (312., 19.5)),
+    ('L40S', (362., 91.6)),
+    ('A6000', (155., 38.7)),
+    ('RTX 4090', (165., 82.6)),
+    ('RTX 3090', (71., 35.6)),
+    ('V100', (125., 15.7)),
+]
+
+
+def linear_flops(module, tokens):
+    return sum(2 * tokens * m.in_features * m.out_features for m in module.modules() if isinstance(m, nn.Linear))
+
+
+def block_flops(block, tokens):
+    flops = linear_flops(block, tokens)
+    attn = getattr(block, 'attn', None)
+    if attn is not None and hasattr(attn, 'qkv'):
+        # q @ k^T and attn @ v
+        flops += 2 * 2 * tokens * tokens * (attn.qkv.out_features // 3)
+    return flops
+
+
+def patch_embed_flops(patch_embed, tokens):
+    proj = patch_embed.proj
+    return 2 * tokens * proj.weight[0].numel() * proj.out_channels
+
+
+def vit_parts(model, num_masked=0):
+    """
+    Forward FLOPs of one sample per part of the model, as (name, module, flops) in
+    execution order.
+    """
+    encoder = getattr(model, 'encoder', model)
+    tokens = encoder.patch_embed.num_patches
+    visible = tokens - num_masked
+    parts = [('patch_embed', encoder.patch_embed, patch_embed_flops(encoder.patch_embed, tokens))]
+    for i, blk in enumerate(encoder.blocks):
+        parts.append(('blocks.%d' % i, blk, block_flops(blk, visible)))
+    if hasattr(model, 'decoder'):
+        parts.append(('encoder_to_decoder', model.encoder_to_decoder, linear_flops(model.encoder_to_decoder, visible)))
+        for i, blk in enumerate(model.decoder.blocks):
+            parts.append(('decoder.blocks.%d' % i, blk, block_flops(blk, tokens)))
+        parts.append(('decoder.head', model.decoder.head, linear_flops(model.decoder.head, num_masked)))
+    else:
+        # on the pooled token
+        parts.append(('head', encoder.head, linear_flops(encoder.head, 1)))
+    return parts
+
+
+def parse_peak(value, device_type):
+    if not value:
+        return 0.
+    if '=' not in value:
+        return float(value)
+    for item in value.split(','):
+        name, _, peak = item.partition('=')
+        if name.strip() == device_type:
+            return float(peak)
+    return 0.
+
+
+def lookup_peak(device, dtype):
+    device = torch.device(device)
+    if device.type != 'cuda' or not torch.cuda.is_available():
+        return 0.
+    name = torch.cuda.get_device_name(device)
+    for key, (half, single) in PEAK_TFLOPS:
+        if key in name:
+            return half if dtype in (torch.float16, torch.bfloat16) else single
+    return 0.
+
+
+class ModelFlops(object):
+    def __init__(self, parts, first_part=0, peak_tflops=0.):
+        self.parts = parts
+        run = parts[first_part:]
+        self.forward_per_sample = sum(flops for _, _, flops in run)
+        trainable = [i for i, (_, module, _) in enumerate(run)
+                     if any(p.requires_grad for p in module.parameters())]
+        backward = sum(flops for _, _, flops in run[trainable[0]:]) if trainable else 0
+        self.train_per_sample = self.forward_per_sample + 2 * backward
+        self.peak_tflops = peak_tflops
+
+    def __str__(self):
+        return "GFLOPs per sample: %.1f forward, %.1f training, peak %s TFLOP/s" % (
+            self.forward_per_sample / 1e9, self.train_per_sample / 1e9,
+            '%.1f' % self.peak_tflops if self.peak_tflops else 'unknown (no MFU)')
+
+
+def create_flops(args, parts, device, precision_policy, first_part=0):
+    """
+    ``parts`` from ``vit_parts``, ``first_part`` skips the parts that do not run in
+    training, e.g. blocks read from the feature cache. Call after the frozen parameters
+    are set to ``requires_grad=False``.
+    """
+    peak = parse_peak(args.peak_tflops, torch.device(device).type)
+    if not peak:
+        peak = lookup_peak(device, precision_policy.dtype)
+    model_flops = ModelFlops(parts, first_part, peak)
+    print(model_flops)
+    return model_flops
@@ -0,0 +1,244 @@
+"""
+Asynchronous metrics sink, a drop-in for ``utils.TensorboardLogger``.
+
+``update`` only puts ``(head, key, value, step)`` records on a bounded queue; a
+background thread converts them and writes them to every backend:
+
+    tensorboard  tensorboardX event files in ``--log_dir``
+    jsonl        ``--log_dir/metrics.jsonl``, one JSON object per scalar
+    prometheus   ``--log_dir/metrics.prom``, latest value of each scalar in the text
+                 format of the node exporter's textfile collector, replaced atomically
+
+``histogram`` queues an array of values; only the tensorboard backend writes those.
+
+Heads can be sampled (``--log_sample_rates opt=10`` keeps the ``opt`` scalars of every
+10th step). When the queue is full, records are dropped instead of blocking the training
+step; the number of dropped records is logged as ``sink/dropped``.
+"""
+import os
+import re
+import json
+import time
+import queue
+import atexit
+import threading
+import torch
+from tensorboardX import SummaryWriter
+
+
+_HISTOGRAM = object()
+
+
+class TensorboardBackend(object):
+    def __init__(self, log_dir):
+        self.writer = SummaryWriter(logdir=log_dir)
+
+    def write(self, records):
+        for head, key, value, step, wall_time in records:
+            self.writer.add_scalar(head + "/" + key, value, step, walltime=wall_time)
+
+    def write_histogram(self, tag, values, step, wall_time):
+        self.writer.add_histogram(tag, values, step, walltime=wall_time)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+class JsonlBackend(object):
+    def __init__(self, path):
+        self.file = open(path, mode="a", encoding="utf-8")
+
+    def write(self, records):
+        for head, key, value, step, wall_time in records:
+            self.file.write(json.dumps({'tag': head + "/" + key, 'value': value, 'step': step,
+                                        'time': round(wall_time, 3)}) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class PrometheusBackend(object):
+    def __init__(self, path, prefix='surgbench'):
+        self.path = path
+        self.prefix = prefix
+        self.latest = {}
+
+    def name(self, head, key):
+        return re.sub(r'[^a-zA-Z0-9_]', '_', "%s_%s_%s" % (self.prefix, head, key))
+
+    def write(self, records):
+        for head, key, value, step, wall_time in records:
+            self.latest[self.name(head, key)] = value
+
+    def flush(self):
+        lines = []
+        for name, value in sorted(self.latest.items()):
+            lines.append("# TYPE %s gauge\n%s %r\n" % (name, name, float(value)))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, mode="w") as f:
+            f.write("".join(lines))
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        self.flush()
+
+
+def build_backends(names, log_dir):
+    backends = []
+    for name in names:
+        if name == 'tensorboard':
+            backends.append(TensorboardBackend(log_dir))
+        elif name == 'jsonl':
+            backends.append(JsonlBackend(os.path.join(log_dir, 'metrics.jsonl')))
+        elif name == 'prometheus':
+            backends.append(PrometheusBackend(os.path.join(log_dir, 'metrics.prom')))
+        else:
+            raise ValueError("Unknown metrics backend %s" % name)
+    return backends
+
+
+def parse_sample_rates(items):
+    """
+    ``['opt=10', 'loss=2']`` -> ``{'opt': 10, 'loss': 2}``
+    """
+    rates = {}
+    for item in items:
+        head, _, rate = item.partition('=')
+        assert rate.isdigit() and int(rate) > 0, "Sample rate should look like head=N, got %s" % item
+        rates[head] = int(rate)
+    return rates
+
+
+class MetricsSink(object):
+    def __init__(self, backends, sample_rates=None, max_queue=10000, flush_secs=10.):
+        self.backends = backends
+        self.sample_rates = sample_rates or {}
+        self.flush_secs = flush_secs
+        self.step = 0
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+        self.thread = threading.Thread(target=self._worker, name='metrics-sink', daemon=True)
+        self.thread.start()
+
+    def set_step(self, step=None):
+        if step is not None:
+            self.step = step
+        else:
+            self.step += 1
+
+    def update(self, head='scalar', step=None, **kwargs):
+        step = self.step if step is None else step
+        rate = self.sample_rates.get(head, 1)
+        if rate > 1 and step % rate != 0:
+            return
+        wall_time = time.time()
+        for k, v in kwargs.items():
+            if v is None:
+                continue
+            if isinstance(v, torch.Tensor):
+                # read out by the writer thread, so a CUDA value does not sync the step
+                v = v.detach()
+            else:
+                assert isinstance(v, (float, int))
+            self._put((head, k, v, step, wall_time))
+
+    def histogram(self, tag, values, step=None):
+        self._put((_HISTOGRAM, tag, values, self.step if step is None else step, time.time()))
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """
+        Wait until the queued records are written and flush the backends. Does nothing
+        after ``close``, the writer thread is gone.
+        """
+        if self.closed:
+            return
+        event = threading.Event()
+        self.queue.put(event)
+        event.wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def _write(self, records, flush=False):
+        histograms = [r for r in records if r[0] is _HISTOGRAM]
+        records = [(head, key, value.item() if torch.is_tensor(value) else value, step, wall_time)
+                   for head, key, value, step, wall_time in records if head is not _HISTOGRAM]
+        if flush and self.dropped:
+            records.append(('sink', 'dropped', self.dropped, self.step, time.time()))
+        for backend in self.backends:
+            # a failing backend loses its records but must not stop the writer thread
+            try:
+                if records:
+                    backend.write(records)
+                if histograms and hasattr(backend, 'write_histogram'):
+                    for _, tag, values, step, wall_time in histograms:
+                        backend.write_histogram(tag, values, step, wall_time)
+                if flush:
+                    backend.flush()
+            except Exception as e:
+                print("Metrics backend %s failed: %s" % (type(backend).__name__, e))
+
+    def _worker(self):
+        last_flush = time.time()
+        records = []
+        while True:
+            try:
+                item = self.queue.get(timeout=1.)
+            except queue.Empty:
+                item = False
+            if item is None or isinstance(item, threading.Event):
+                self._write(records, flush=True)
+                records = []
+                last_flush = time.time()
+                if item is None:
+                    for backend in self.backends:
+                        backend.close()
+                    return
+                item.set()
+                continue
+            if item is not False:
+                records.append(item)
+            if len(records) >= 256 or (time.time() - last_flush > self.flush_secs):
+                flush = time.time() - last_flush > self.flush_secs
+                self._write(records, flush=flush)
+                records = []
+                if flush:
+                    last_flush = time.time()
+
+
+_SINKS = []
+
+
+def create_sink(args):
+    """
+    The ``log_writer`` of the run scripts: a ``MetricsSink`` writing to ``args.log_dir``.
+    """
+    sink = MetricsSink(build_backends(args.log_backends, args.log_dir),
+                       sample_rates=parse_sample_rates(args.log_sample_rates),
+                       max_queue=args.log_queue_size)
+    _SINKS.append(sink)
+    return sink
+
+
+@atexit.register
+def close_sinks():
+    for sink in _SINKS:
+        sink.close()
@@ -12,19 +12,28 @@ Hacked together by / Copyright 2019, Ross Wightman
 """
 import numpy as np
 import torch
+from torch.utils.data._utils.collate import default_collate
 
 
-def one_hot(x, num_classes, on_value=1., off_value=0., device='cuda'):
+def one_hot(x, num_classes, on_value=1., off_value=0., device=None):
+    device = x.device if device is None else device
     x = x.long().view(-1, 1)
     return torch.full((x.size()[0], num_classes), off_value, device=device).scatter_(1, x, on_value)
 
 
-def mixup_target(target, num_classes, lam=1., smoothing=0.0, device='cuda'):
+def mixup_target(target, num_classes, lam=1., smoothing=0.0, device=None):
+    """ Soft targets of a batch mixed with its flip, lam is a float or a (B, 1) tensor.
+    The on-value weights of both targets are scattered into one off-value tensor.
+    """
+    device = target.device if device is None else device
     off_value = smoothing / num_classes
     on_value = 1. - smoothing + off_value
-    y1 = one_hot(target, num_classes, on_value=on_value, off_value=off_value, device=device)
-    y2 = one_hot(target.flip(0), num_classes, on_value=on_value, off_value=off_value, device=device)
-    return y1 * lam + y2 * (1. - lam)
+    target = target.long().view(-1, 1).to(device)
+    lam = torch.as_tensor(lam, dtype=torch.float32, device=device).reshape(-1, 1).expand(len(target), 1)
+    y = torch.full((len(target), num_classes), off_value, device=device)
+    y.scatter_add_(1, target, lam * (on_value - off_value))
+    y.scatter_add_(1, target.flip(0), (1. - lam) * (on_value - off_value))
+    return y
 
 
 def rand_bbox(img_shape, lam, margin=0., count=None):
@@ -34,14 +43,14 @@ def rand_bbox(img_shape, lam, margin=0., count=None):
 
     Args:
         img_shape (tuple): Image shape as tuple
-        lam (float): Cutmix lambda value
+        lam (float or ndarray): Cutmix lambda value, or one value per bbox
         margin (float): Percentage of bbox dimension to enforce as margin (reduce amount of box outside image)
         count (int): Number of bbox to generate
     """
-    ratio = np.sqrt(1 - lam)
+    ratio = np.sqrt(1 - np.asarray(lam, dtype=np.float64))
     img_h, img_w = img_shape[-2:]
-    cut_h, cut_w = int(img_h * ratio), int(img_w * ratio)
-    margin_y, margin_x = int(margin * cut_h), int(margin * cut_w)
+    cut_h, cut_w = (img_h * ratio).astype(np.int64), (img_w * ratio).astype(np.int64)
+    margin_y, margin_x = (margin * cut_h).astype(np.int64), (margin * cut_w).astype(np.int64)
     cy = np.random.randint(0 + margin_y, img_h - margin_y, size=count)
     cx = np.random.randint(0 + margin_x, img_w - margin_x, size=count)
     yl = np.clip(cy - cut_h // 2, 0, img_h)
@@ -87,6 +96,54 @@ def cutmix_bbox_and_lam(img_shape, lam, ratio_minmax=None, correct_lam=True, cou
     return (yl, yu, xl, xu), lam
 
 
+def cutmix_tube_and_lam(clip_shape, lam, ratio_minmax=None, correct_lam=True, count=None):
+    """ Generate a CutMix tube, a bbox spanning a range of frames of a (..., T, H, W) clip,
+    and apply lambda correction. Without minmax every side is cut by (1 - lam) ** (1/3),
+    so the tube holds 1 - lam of the clip.
+    """
+    img_t = clip_shape[-3]
+    if ratio_minmax is not None:
+        yl, yu, xl, xu = rand_bbox_minmax(clip_shape, ratio_minmax, count=count)
+        cut_min = int(img_t * ratio_minmax[0])
+        cut_t = np.random.randint(cut_min, max(int(img_t * ratio_minmax[1]), cut_min + 1), size=count)
+        tl = np.random.randint(0, img_t - cut_t + 1, size=count)
+        tu = tl + cut_t
+    else:
+        ratio = np.cbrt(1 - np.asarray(lam, dtype=np.float64))
+        # rand_bbox cuts sqrt(1 - lam) of each side
+        yl, yu, xl, xu = rand_bbox(clip_shape, 1 - ratio ** 2, count=count)
+        cut_t = (img_t * ratio).astype(np.int64)
+        ct = np.random.randint(0, img_t, size=count)
+        tl = np.clip(ct - cut_t // 2, 0, img_t)
+        tu = np.clip(ct + cut_t // 2, 0, img_t)
+    if correct_lam or ratio_minmax is not None:
+        tube_volume = (tu - tl) * (yu - yl) * (xu - xl)
+        lam = 1. - tube_volume / float(img_t * clip_shape[-2] * clip_shape[-1])
+    return (tl, tu, yl, yu, xl, xu), lam
+
+
+def mix_with_flipped_(x, weight):
+    """ In place x[i] = lerp(x[i], x[B - 1 - i], weight[i]) over the batch, with one half batch
+    as the only temporary; weight is a scalar or a (B, ...) tensor broadcastable to x. Weights
+    of 0 or 1 give exact copies.
+    """
+    half = len(x) // 2
+    rev = torch.arange(half - 1, -1, -1, device=x.device)
+    # the middle element of an odd batch is its own partner and stays as it is
+    top, bottom = x[:half], x[len(x) - half:]
+    # partners of the first half, then the old first half aligned with them
+    partner = bottom.index_select(0, rev)
+    bottom.copy_(top)
+    if isinstance(weight, torch.Tensor):
+        weight_top, weight_bottom = weight[:half], weight[len(x) - half:].index_select(0, rev)
+    else:
+        weight_top = weight_bottom = weight
+    top.lerp_(partner, weight_top)
+    partner.lerp_(bottom, weight_bottom)
+    bottom.index_copy_(0, rev, partner)
+    return x
+
+
 class Mixup:
     """ Mixup/Cutmix that applies different params to each element or whole batch
 
@@ -120,7 +177,7 @@ class Mixup:
 
     def _params_per_elem(self, batch_size):
         lam = np.ones(batch_size, dtype=np.float32)
-        use_cutmix = np.zeros(batch_size, dtype=np.bool)
+        use_cutmix = np.zeros(batch_size, dtype=bool)
         if self.mixup_enabled:
             if self.mixup_alpha > 0. and self.cutmix_alpha > 0.:
                 use_cutmix = np.random.rand(batch_size) < self.switch_prob
@@ -131,7 +188,7 @@ class Mixup:
             elif self.mixup_alpha > 0.:
                 lam_mix = np.random.beta(self.mixup_alpha, self.mixup_alpha, size=batch_size)
             elif self.cutmix_alpha > 0.:
-                use_cutmix = np.ones(batch_size, dtype=np.bool)
+                use_cutmix = np.ones(batch_size, dtype=bool)
                 lam_mix = np.random.beta(self.cutmix_alpha, self.cutmix_alpha, size=batch_size)
             else:
                 assert False, "One of mixup_alpha > 0., cutmix_alpha > 0., cutmix_minmax not None should be true."
@@ -156,40 +213,39 @@ class Mixup:
             lam = float(lam_mix)
         return lam, use_cutmix
 
+    def _elem_weights(self, x, lam_batch, use_cutmix):
+        """ Per-sample weight of x in the mix, as a float32 (B, 1, ..., H, W) map on the CPU:
+        lam for mixup, 0 inside / 1 outside the box for cutmix. Cutmix lambdas are corrected in place.
+        """
+        batch_size = len(lam_batch)
+        img_h, img_w = x.shape[-2:]
+        weights = torch.from_numpy(lam_batch).view(batch_size, 1, 1).repeat(1, img_h, img_w)
+        cut = np.flatnonzero(use_cutmix & (lam_batch != 1.))
+        if len(cut) > 0:
+            (yl, yh, xl, xh), lam_cut = cutmix_bbox_and_lam(
+                x.shape, lam_batch[cut], ratio_minmax=self.cutmix_minmax, correct_lam=self.correct_lam,
+                count=len(cut))
+            lam_batch[cut] = lam_cut
+            ys, xs = np.arange(img_h), np.arange(img_w)
+            in_y = (ys >= yl[:, None]) & (ys < yh[:, None])
+            in_x = (xs >= xl[:, None]) & (xs < xh[:, None])
+            weights[torch.from_numpy(cut)] = torch.from_numpy(~(in_y[:, :, None] & in_x[:, None, :])).float()
+        return weights.view((batch_size,) + (1,) * (x.dim() - 3) + (img_h, img_w))
+
     def _mix_elem(self, x):
         batch_size = len(x)
         lam_batch, use_cutmix = self._params_per_elem(batch_size)
-        x_orig = x.clone()  # need to keep an unmodified original for mixing source
-        for i in range(batch_size):
-            j = batch_size - i - 1
-            lam = lam_batch[i]
-            if lam != 1.:
-                if use_cutmix[i]:
-                    (yl, yh, xl, xh), lam = cutmix_bbox_and_lam(
-                        x[i].shape, lam, ratio_minmax=self.cutmix_minmax, correct_lam=self.correct_lam)
-                    x[i][..., yl:yh, xl:xh] = x_orig[j][..., yl:yh, xl:xh]
-                    lam_batch[i] = lam
-                else:
-                    x[i] = x[i] * lam + x_orig[j] * (1 - lam)
+        weights = self._elem_weights(x, lam_batch, use_cutmix).to(device=x.device, dtype=x.dtype, non_blocking=True)
+        # x[i] = w[i] * x[i] + (1 - w[i]) * x[B - 1 - i], exact copies where w is 0 or 1
+        mix_with_flipped_(x, 1. - weights)
         return torch.tensor(lam_batch, device=x.device, dtype=x.dtype).unsqueeze(1)
 
     def _mix_pair(self, x):
         batch_size = len(x)
         lam_batch, use_cutmix = self._params_per_elem(batch_size // 2)
-        x_orig = x.clone()  # need to keep an unmodified original for mixing source
-        for i in range(batch_size // 2):
-            j = batch_size - i - 1
-            lam = lam_batch[i]
-            if lam != 1.:
-                if use_cutmix[i]:
-                    (yl, yh, xl, xh), lam = cutmix_bbox_and_lam(
-                        x[i].shape, lam, ratio_minmax=self.cutmix_minmax, correct_lam=self.correct_lam)
-                    x[i][:, yl:yh, xl:xh] = x_orig[j][:, yl:yh, xl:xh]
-                    x[j][:, yl:yh, xl:xh] = x_orig[i][:, yl:yh, xl:xh]
-                    lam_batch[i] = lam
-                else:
-                    x[i] = x[i] * lam + x_orig[j] * (1 - lam)
-                    x[j] = x[j] * lam + x_orig[i] * (1 - lam)
+        weights = self._elem_weights(x, lam_batch, use_cutmix).to(device=x.device, dtype=x.dtype, non_blocking=True)
+        # both elements of a pair share lambda and box
+        mix_with_flipped_(x, 1. - torch.cat((weights, weights.flip(0))))
         lam_batch = np.concatenate((lam_batch, lam_batch[::-1]))
         return torch.tensor(lam_batch, device=x.device, dtype=x.dtype).unsqueeze(1)
 
@@ -200,10 +256,10 @@ class Mixup:
         if use_cutmix:
             (yl, yh, xl, xh), lam = cutmix_bbox_and_lam(
                 x.shape, lam, ratio_minmax=self.cutmix_minmax, correct_lam=self.correct_lam)
-            x[..., yl:yh, xl:xh] = x.flip(0)[..., yl:yh, xl:xh]
+            # swap the boxes of each pair
+            mix_with_flipped_(x[..., yl:yh, xl:xh], 1.)
         else:
-            x_flipped = x.flip(0).mul_(1. - lam)
-            x.mul_(lam).add_(x_flipped)
+            mix_with_flipped_(x, 1. - lam)
         return lam
 
     def __call__(self, x, target):
@@ -314,3 +370,73 @@ class FastCollateMixup(Mixup):
         target = target[:batch_size]
         return output, target
 
+
+
+class VideoCollateMixup(Mixup):
+    """ Mixup/Cutmix of video clips performed while collating the batch in the DataLoader workers.
+
+    Takes the training items of the video datasets, ``(clip, label, index, extra)`` with
+    (C, T, H, W) clips, or with lists of clips/labels/indices under repeated augmentation
+    (flattened like ``multiple_samples_collate``). uint8 clips are mixed in float, rounded
+    and returned as uint8, so only bytes cross to the device, which then normalizes them.
+    With ``temporal_cutmix`` the cutmix box is a tube that also spans a range of frames.
+    Returns ``(clips, soft_targets, indices, extra)``.
+    """
+    def __init__(self, *args, temporal_cutmix=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.temporal_cutmix = temporal_cutmix
+
+    def _elem_weights(self, x, lam_batch, use_cutmix):
+        if not self.temporal_cutmix:
+            return super()._elem_weights(x, lam_batch, use_cutmix)
+        batch_size = len(lam_batch)
+        img_t, img_h, img_w = x.shape[-3:]
+        weights = torch.from_numpy(lam_batch).view(batch_size, 1, 1, 1).repeat(1, img_t, img_h, img_w)
+        cut = np.flatnonzero(use_cutmix & (lam_batch != 1.))
+        if len(cut) > 0:
+            (tl, tu, yl, yu, xl, xu), lam_cut = cutmix_tube_and_lam(
+                x.shape, lam_batch[cut], ratio_minmax=self.cutmix_minmax, correct_lam=self.correct_lam,
+                count=len(cut))
+            lam_batch[cut] = lam_cut
+            ts, ys, xs = np.arange(img_t), np.arange(img_h), np.arange(img_w)
+            in_t = (ts >= tl[:, None]) & (ts < tu[:, None])
+            in_y = (ys >= yl[:, None]) & (ys < yu[:, None])
+            in_x = (xs >= xl[:, None]) & (xs < xu[:, None])
+            in_tube = in_t[:, :, None, None] & in_y[:, None, :, None] & in_x[:, None, None, :]
+            weights[torch.from_numpy(cut)] = torch.from_numpy(~in_tube).float()
+        return weights.view((batch_size,) + (1,) * (x.dim() - 4) + (img_t, img_h, img_w))
+
+    def _mix_weights(self, x):
+        batch_size = len(x)
+        if self.mode == 'elem':
+            lam_batch, use_cutmix = self._params_per_elem(batch_size)
+            weights = self._elem_weights(x, lam_batch, use_cutmix)
+        elif self.mode == 'pair':
+            lam_batch, use_cutmix = self._params_per_elem(batch_size // 2)
+            weights = self._elem_weights(x, lam_batch, use_cutmix)
+            weights = torch.cat((weights, weights.flip(0)))
+            lam_batch = np.concatenate((lam_batch, lam_batch[::-1]))
+        else:
+            lam, use_cutmix = self._params_per_batch()
+            lam_batch = np.full(1, lam, dtype=np.float32)
+            weights = self._elem_weights(x, lam_batch, np.full(1, use_cutmix))
+            weights = weights.expand((batch_size,) + weights.shape[1:])
+            lam_batch = np.repeat(lam_batch, batch_size)
+        return weights, torch.from_numpy(lam_batch).unsqueeze(1)
+
+    def __call__(self, batch, _=None):
+        inputs, labels, video_idx, extra_data = zip(*batch)
+        if isinstance(labels[0], (list, tuple)):
+            inputs = [item for sublist in inputs for item in sublist]
+            labels = [item for sublist in labels for item in sublist]
+            video_idx = [item for sublist in video_idx for item in sublist]
+        x = torch.stack([torch.as_tensor(clip) for clip in inputs])
+        assert len(x) % 2 == 0, 'Batch size should be even when using this'
+        weights, lam = self._mix_weights(x)
+        if x.dtype == torch.uint8:
+            x = mix_with_flipped_(x.float(), 1. - weights).round_().to(torch.uint8)
+        else:
+            mix_with_flipped_(x, (1. - weights).to(x.dtype))
+        target = torch.tensor(labels, dtype=torch.int64)
+        target = mixup_target(target, self.num_classes, lam, self.label_smoothing, device='cpu')
+        return x, target, default_collate(video_idx), default_collate(extra_data)
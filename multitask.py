@@ -0,0 +1,140 @@
+"""
+Multi-task probing of all SurgBench-E tasks in one run.
+
+``SurgBench-E_taxonomy.txt`` groups the 72 classes of the ``all`` data set into tasks
+(``AutoLaparo/surgical_phase``, ``CholecT50/instrument_classification``, ...) and every
+clip belongs to exactly one of them. The classifier head holds one block of rows per
+task. For each clip the logits of the other tasks are masked out, so its softmax, loss
+and prediction only involve the classes of its own task. That is a set of per-task
+linear heads evaluated with a single matmul over the shared backbone features.
+"""
+import re
+import json
+from collections import OrderedDict
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.distributed as dist
+
+import utils
+
+
+def load_taxonomy(path):
+    """
+    Read the task -> class indices mapping from a taxonomy file with lines like
+    ``"AutoLaparo/surgical_phase/preparation": [0, 72]``. The first half of the
+    ids are the class indices of the 72-way label space.
+    """
+    pattern = re.compile(r'^"([^"]+)":\s*\[([\d,\s]+)\]')
+    tasks = OrderedDict()
+    with open(path, 'r') as f:
+        for line in f:
+            match = pattern.match(line.strip())
+            if match is None:
+                continue
+            task = '/'.join(match.group(1).split('/')[:2])
+            ids = [int(i) for i in match.group(2).split(',')]
+            tasks.setdefault(task, []).extend(ids[:len(ids) // 2])
+    return tasks
+
+
+class TaskSpec(object):
+    def __init__(self, tasks, num_classes):
+        self.names = list(tasks.keys())
+        self.task_of_class = torch.full((num_classes,), -1, dtype=torch.long)
+        self.class_mask = torch.zeros(len(self.names), num_classes, dtype=torch.bool)
+        for task_id, classes in enumerate(tasks.values()):
+            self.task_of_class[classes] = task_id
+            self.class_mask[task_id, classes] = True
+        missing = (self.task_of_class < 0).nonzero().flatten().tolist()
+        assert len(missing) == 0, "Classes %s do not belong to any task" % missing
+
+    @classmethod
+    def from_taxonomy(cls, path, num_classes):
+        return cls(load_taxonomy(path), num_classes)
+
+    def __len__(self):
+        return len(self.names)
+
+    def task_ids(self, target):
+        return self.task_of_class.to(target.device)[target]
+
+    def allowed(self, target):
+        return self.class_mask.to(target.device)[self.task_ids(target)]
+
+    def mask_logits(self, output, target):
+        """
+        Keep the logits of the task each sample belongs to, the others get the lowest value.
+        """
+        return output.masked_fill(~self.allowed(target), torch.finfo(output.dtype).min)
+
+
+class MultiTaskCrossEntropy(nn.Module):
+    """
+    Cross entropy over the classes of each sample's task, with label smoothing
+    spread over those classes only.
+    """
+
+    def __init__(self, task_spec, smoothing=0.0):
+        super(MultiTaskCrossEntropy, self).__init__()
+        self.task_spec = task_spec
+        self.smoothing = smoothing
+
+    def per_sample(self, x, target):
+        allowed = self.task_spec.allowed(target)
+        logprobs = F.log_softmax(x.float().masked_fill(~allowed, float('-inf')), dim=-1)
+        nll_loss = -logprobs.gather(dim=-1, index=target.unsqueeze(1)).squeeze(1)
+        smooth_loss = -logprobs.masked_fill(~allowed, 0.).sum(dim=-1) / allowed.sum(dim=-1)
+        return (1. - self.smoothing) * nll_loss + self.smoothing * smooth_loss
+
+    def forward(self, x, target):
+        return self.per_sample(x, target).mean()
+
+
+class TaskMeter(object):
+    """
+    Per-task sums of a per-sample value. They stay on the device during the epoch and
+    are reduced across processes once by ``synchronize_between_processes``.
+    """
+
+    def __init__(self, task_spec, device):
+        self.task_spec = task_spec
+        self.total = torch.zeros(len(task_spec), dtype=torch.float64, device=device)
+        self.count = torch.zeros(len(task_spec), dtype=torch.float64, device=device)
+
+    def update(self, values, target):
+        task = self.task_spec.task_ids(target)
+        self.total.index_add_(0, task, values.detach().to(torch.float64))
+        self.count.index_add_(0, task, torch.ones_like(self.total[task]))
+
+    def synchronize_between_processes(self):
+        if not utils.is_dist_avail_and_initialized():
+            return
+        t = torch.stack([self.total, self.count])
+        dist.all_reduce(t)
+        self.total, self.count = t[0], t[1]
+
+    def summary(self, prefix, scale=1.):
+        total = self.total.tolist()
+        count = self.count.tolist()
+        return {prefix + name: scale * total[i] / count[i]
+                for i, name in enumerate(self.task_spec.names) if count[i] > 0}
+
+
+def video_task_results(task_spec, pred, label):
+    """
+    Per-task top-1 accuracy of video level predictions.
+    """
+    task = task_spec.task_of_class.numpy()[label]
+    results = OrderedDict()
+    for task_id, name in enumerate(task_spec.names):
+        mask = task == task_id
+        if mask.any():
+            results[name] = {'top1': float(np.mean(pred[mask] == label[mask]) * 100), 'num_videos': int(mask.sum())}
+    return results
+
+
+def save_task_results(results, path):
+    with open(path, mode="w", encoding="utf-8") as f:
+        f.write(json.dumps(results, indent=2) + "\n")
@@ -1,3 +1,4 @@
+import inspect
 import torch
 from torch import optim as optim
 
@@ -88,6 +89,44 @@ def get_parameter_groups(model, weight_decay=1e-5, skip_list=(), get_num_layer=N
     return list(parameter_group_vars.values())
 
 
+def get_impl_args(opt_class, impl, params):
+    """
+    ``foreach`` / ``fused`` keyword for a torch optimizer. ``auto`` picks the fused kernels
+    if this torch has them for the device of the parameters (CUDA, and CPU since torch 2.4),
+    else the multi-tensor ones. Optimizers without these options (timm's) keep their own.
+    """
+    if impl == 'default':
+        return {}
+    supported = inspect.signature(opt_class).parameters
+    if impl == 'auto':
+        impl = 'foreach'
+        if 'fused' in supported and len(params) > 0:
+            try:
+                opt_class([torch.zeros(1, device=params[0].device, requires_grad=True)], lr=0.1, fused=True)
+                impl = 'fused'
+            except (RuntimeError, ValueError):
+                pass
+    if impl not in supported:
+        print("%s has no %s implementation, using the default one" % (opt_class.__name__, impl))
+        return {}
+    return {impl: True}
+
+
+def set_lr_and_wd(optimizer, lr=None, weight_decay=None):
+    """
+    Set the scheduled lr, times the ``lr_scale`` of each group, and the weight decay of
+    the groups that decay. A tensor lr (fused / capturable optimizers) is updated in place.
+    """
+    for group in optimizer.param_groups:
+        if lr is not None:
+            if torch.is_tensor(group["lr"]):
+                group["lr"].fill_(lr * group["lr_scale"])
+            else:
+                group["lr"] = lr * group["lr_scale"]
+        if weight_decay is not None and group["weight_decay"] > 0:
+            group["weight_decay"] = weight_decay
+
+
 def create_optimizer(args, model, get_num_layer=None, get_layer_scale=None, filter_bias_and_bn=True, skip_list=None):
     opt_lower = args.opt.lower()
     weight_decay = args.weight_decay
@@ -100,7 +139,12 @@ def create_optimizer(args, model, get_num_layer=None, get_layer_scale=None, filt
         parameters = get_parameter_groups(model, weight_decay, skip, get_num_layer, get_layer_scale)
         weight_decay = 0.
     else:
-        parameters = model.parameters()
+        parameters = list(model.parameters())
+    if isinstance(parameters[0], dict):
+        params = [p for group in parameters for p in group["params"]]
+    else:
+        params = parameters
+    opt_impl = getattr(args, 'opt_impl', 'default')
 
     if 'fused' in opt_lower:
         assert has_apex and torch.cuda.is_available(), 'APEX and CUDA required for fused optimizers'
@@ -117,13 +161,17 @@ def create_optimizer(args, model, get_num_layer=None, get_layer_scale=None, filt
     opt_lower = opt_split[-1]
     if opt_lower == 'sgd' or opt_lower == 'nesterov':
         opt_args.pop('eps', None)
+        opt_args.update(get_impl_args(optim.SGD, opt_impl, params))
         optimizer = optim.SGD(parameters, momentum=args.momentum, nesterov=True, **opt_args)
     elif opt_lower == 'momentum':
         opt_args.pop('eps', None)
+        opt_args.update(get_impl_args(optim.SGD, opt_impl, params))
         optimizer = optim.SGD(parameters, momentum=args.momentum, nesterov=False, **opt_args)
     elif opt_lower == 'adam':
+        opt_args.update(get_impl_args(optim.Adam, opt_impl, params))
         optimizer = optim.Adam(parameters, **opt_args)
     elif opt_lower == 'adamw':
+        opt_args.update(get_impl_args(optim.AdamW, opt_impl, params))
         optimizer = optim.AdamW(parameters, **opt_args)
     # elif opt_lower == 'nadam':
     #     optimizer = Nadam(parameters, **opt_args)
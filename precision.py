@@ -0,0 +1,92 @@
+"""
+Precision policy shared by the training and evaluation loops.
+
+``--precision`` picks the autocast dtype and whether the loss is scaled:
+
+    fp16  autocast to float16, loss scaled by the GradScaler
+    bf16  autocast to bfloat16, no loss scaling needed
+    fp32  no autocast
+    auto  fp16 on CUDA, bf16 on CPU
+
+``--fp32_modules`` names submodules (``head``, ``fc_norm``, ``blocks.11``, ...) that run
+in float32 whatever the policy: their inputs are cast up and autocast is off inside them.
+"""
+import contextlib
+import torch
+
+DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16, 'fp32': torch.float32}
+
+
+def resolve(precision, device):
+    if precision == 'auto':
+        return 'fp16' if torch.device(device).type == 'cuda' else 'bf16'
+    assert precision in DTYPES, "Unknown precision %s" % precision
+    return precision
+
+
+class PrecisionPolicy(object):
+    def __init__(self, precision='auto', device='cuda', fp32_modules=()):
+        self.device_type = torch.device(device).type
+        self.precision = resolve(precision, device)
+        self.dtype = DTYPES[self.precision]
+        self.fp32_modules = list(fp32_modules)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(getattr(args, 'precision', 'auto'), args.device, getattr(args, 'fp32_modules', ()))
+
+    @property
+    def use_scaler(self):
+        return self.precision == 'fp16'
+
+    def autocast(self):
+        if self.precision == 'fp32':
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def apply(self, model):
+        """
+        Make the ``fp32_modules`` of ``model`` run in float32, with a forward pre-hook that
+        casts the inputs up and turns autocast off and a forward hook that turns it back on.
+        Hooks are copied along with the module (EMA) and leave the state dict unchanged.
+        """
+        for name in self.fp32_modules:
+            module = model.get_submodule(name)
+            if getattr(module, '_fp32_hooks', None) is not None:
+                continue
+            hooks = _Fp32Hooks(self.device_type)
+            module.register_forward_pre_hook(hooks.pre, with_kwargs=True)
+            module.register_forward_hook(hooks.post, always_call=True)
+            module._fp32_hooks = hooks
+            print("Keeping %s (%s) in fp32" % (name, type(module).__name__))
+        return model
+
+    def __repr__(self):
+        return "PrecisionPolicy(%s on %s, fp32 modules: %s)" % (self.precision, self.device_type, self.fp32_modules)
+
+
+def _to_float(x):
+    if torch.is_tensor(x) and x.is_floating_point():
+        return x.float()
+    if isinstance(x, (list, tuple)):
+        return type(x)(_to_float(v) for v in x)
+    if isinstance(x, dict):
+        return {k: _to_float(v) for k, v in x.items()}
+    return x
+
+
+class _Fp32Hooks(object):
+    def __init__(self, device_type):
+        self.device_type = device_type
+        # one autocast context per forward call in flight, nested calls included
+        self.contexts = []
+
+    def pre(self, module, args, kwargs):
+        context = torch.autocast(self.device_type, enabled=False)
+        context.__enter__()
+        self.contexts.append(context)
+        return _to_float(args), _to_float(kwargs)
+
+    def post(self, module, args, output):
+        if self.contexts:
+            self.contexts.pop().__exit__(None, None, None)
@@ -0,0 +1,103 @@
+"""
+On-demand torch.profiler windows over training steps.
+
+``--profile_steps 100:110`` profiles the training steps 100 to 109, counted over the
+whole run. ``--profile_signal USR1`` arms the profiler when the process gets that
+signal (``kill -USR1 <pid>``), for the next ``--profile_signal_steps`` steps, as often
+as the signal is sent. CPU activity is always recorded, CUDA / XPU when present.
+
+Each window writes, per rank, into ``output_dir``:
+    profile_rank{r}_steps{a}-{b}.json   Chrome trace (chrome://tracing, Perfetto)
+    profile_rank{r}_steps{a}-{b}.txt    top ops by self time
+"""
+import os
+import signal
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+import utils
+
+
+def parse_steps(value):
+    start, _, end = value.partition(':')
+    assert start.isdigit() and end.isdigit() and int(start) < int(end), \
+        "--profile_steps should look like start:end, got %s" % value
+    return int(start), int(end)
+
+
+def get_activities():
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    if hasattr(ProfilerActivity, 'XPU') and hasattr(torch, 'xpu') and torch.xpu.is_available():
+        activities.append(ProfilerActivity.XPU)
+    return activities
+
+
+class WindowedProfiler(object):
+    def __init__(self, output_dir, steps=None, signal_name=None, signal_steps=20, row_limit=30):
+        self.output_dir = output_dir
+        self.windows = [steps] if steps is not None else []
+        self.signal_steps = signal_steps
+        self.row_limit = row_limit
+        self.step_count = 0
+        self.armed = False
+        self.prof = None
+        self.window = None
+        if signal_name:
+            signal.signal(getattr(signal, 'SIG' + signal_name.upper()), self._on_signal)
+        if self.windows and self.windows[0][0] == 0:
+            self.start(self.windows[0])
+
+    def _on_signal(self, signum, frame):
+        # only set a flag, the profiler is started between steps
+        self.armed = True
+
+    def step(self):
+        """
+        Called at the end of every training step.
+        """
+        self.step_count += 1
+        if self.prof is not None and self.step_count >= self.window[1]:
+            self.stop()
+        if self.prof is None:
+            if self.armed:
+                self.armed = False
+                self.windows.append((self.step_count, self.step_count + self.signal_steps))
+            for window in self.windows:
+                if window[0] == self.step_count:
+                    self.start(window)
+                    break
+
+    def start(self, window):
+        print("Profiling steps %d to %d" % (window[0], window[1] - 1))
+        self.window = window
+        self.prof = profile(activities=get_activities(), record_shapes=True, profile_memory=True)
+        self.prof.__enter__()
+
+    def stop(self):
+        if self.prof is None:
+            return
+        self.prof.__exit__(None, None, None)
+        prefix = os.path.join(self.output_dir, 'profile_rank%d_steps%d-%d' % (
+            utils.get_rank(), self.window[0], self.step_count - 1))
+        self.prof.export_chrome_trace(prefix + '.json')
+        sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        with open(prefix + '.txt', mode="w", encoding="utf-8") as f:
+            f.write(self.prof.key_averages().table(sort_by=sort_by, row_limit=self.row_limit) + "\n")
+        print("Profile written to %s.json / .txt" % prefix)
+        self.prof = None
+        self.window = None
+
+    def close(self):
+        self.stop()
+
+
+def create_profiler(args):
+    if not args.profile_steps and not args.profile_signal:
+        return None
+    os.makedirs(args.output_dir, exist_ok=True)
+    return WindowedProfiler(
+        args.output_dir,
+        steps=parse_steps(args.profile_steps) if args.profile_steps else None,
+        signal_name=args.profile_signal, signal_steps=args.profile_signal_steps)
@@ -15,17 +15,26 @@ from functools import partial
 from pathlib import Path
 from collections import OrderedDict
 from tqdm import tqdm
-from mixup import Mixup
+from mixup import Mixup, VideoCollateMixup
 from timm.models import create_model
 from timm.loss import LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
-from timm.utils import ModelEma
-from optim_factory import create_optimizer, get_parameter_groups, LayerDecayValueAssigner
+from optim_factory import create_optimizer, get_parameter_groups, LayerDecayValueAssigner, get_num_layer_for_vit
 
 from datasets import build_dataset
 from engine_for_finetuning import train_one_epoch, validation_one_epoch, final_test, merge
 from utils import NativeScalerWithGradNormCount as NativeScaler
 from utils import  multiple_samples_collate
 import utils
+import checkpoint_io
+import metrics_sink
+import profiling
+import data_watchdog
+import clip_timing
+import block_profile
+import flops
+import feature_cache
+import precision
+import multitask
 import modeling_finetune
 
 
@@ -47,6 +56,14 @@ def get_args():
     parser.add_argument('--epochs', default=100, type=int)
     parser.add_argument('--update_freq', default=1, type=int)
     parser.add_argument('--save_ckpt_freq', default=120, type=int)
+    parser.add_argument('--async_ckpt', action='store_true', default=False,
+                        help='Write checkpoints from a background thread after copying the state to CPU')
+    parser.add_argument('--ckpt_keep_last', default=0, type=int,
+                        help='Keep only the last N epoch checkpoints, besides the best one (0: keep all)')
+    parser.add_argument('--sharded_ckpt', action='store_true', default=False,
+                        help='Save checkpoints as per-rank shards written in parallel (see checkpoint_io.py)')
+    parser.add_argument('--ckpt_load_mode', default='node', choices=['node', 'rank0', 'all'], type=str,
+                        help='Read checkpoints once per node / on rank 0 and broadcast them, or on every rank')
     # Model parameters
     parser.add_argument('--model', default='vit_base_patch16_224', type=str, metavar='MODEL', help='Name of model to train')
     parser.add_argument('--tubelet_size', type=int, default= 2)
@@ -65,12 +82,19 @@ def get_args():
     parser.add_argument('--model_ema', action='store_true', default=False)
     parser.add_argument('--model_ema_decay', type=float, default=0.9999, help='')
     parser.add_argument('--model_ema_force_cpu', action='store_true', default=False, help='')
+    parser.add_argument('--model_ema_update_interval', type=int, default=1,
+                        help='Update the EMA every k optimizer steps with the decay raised to the power k')
+    parser.add_argument('--model_ema_async', action='store_true', default=False,
+                        help='With --model_ema_force_cpu, average the CPU copy in a background thread')
 
     # Optimizer parameters
     parser.add_argument('--opt', default='adamw', type=str, metavar='OPTIMIZER',
                         help='Optimizer (default: "adamw"')
     parser.add_argument('--opt_eps', default=1e-8, type=float, metavar='EPSILON',
                         help='Optimizer Epsilon (default: 1e-8)')
+    parser.add_argument('--opt_impl', default='auto', choices=['auto', 'default', 'foreach', 'fused'],
+                        help='Implementation of the torch optimizers: fused kernels if available, '
+                             'else multi-tensor foreach (default: auto)')
     parser.add_argument('--opt_betas',default=[0.9, 0.999], type=float, nargs='+', metavar='BETA',
                         help='Optimizer Betas (default: None, use opt default)')
     parser.add_argument('--clip_grad', type=float, default=None, metavar='NORM',
@@ -138,10 +162,19 @@ def get_args():
                         help='Probability of switching to cutmix when both mixup and cutmix enabled')
     parser.add_argument('--mixup_mode', type=str, default='batch',
                         help='How to apply mixup/cutmix params. Per "batch", "pair", or "elem"')
+    parser.add_argument('--collate_mixup', action='store_true', default=False,
+                        help='Mix the clips in the DataLoader workers while collating instead of on the device')
+    parser.add_argument('--temporal_cutmix', action='store_true', default=False,
+                        help='With --collate_mixup, cut tubes spanning a range of frames instead of full-length boxes')
 
     # Finetuning params
 
     parser.add_argument('--finetune', default='', help='finetune from checkpoint')
+    parser.add_argument('--finetune_cache', action='store_true', default=True,
+                        help='Cache the --finetune checkpoint converted for this model on disk')
+    parser.add_argument('--no_finetune_cache', action='store_false', dest='finetune_cache')
+    parser.add_argument('--finetune_cache_dir', default='', type=str,
+                        help='Directory of converted checkpoints (default: converted_checkpoints/ next to --finetune)')
     parser.add_argument('--model_key', default='model|module', type=str)
     parser.add_argument('--model_prefix', default='', type=str)
     parser.add_argument('--init_scale', default=0.001, type=float)
@@ -168,8 +201,44 @@ def get_args():
                         help='path where to save, empty for no saving')
     parser.add_argument('--log_dir', default=None,
                         help='path where to tensorboard log')
+    parser.add_argument('--log_backends', default=['tensorboard'], type=str, nargs='+',
+                        choices=['tensorboard', 'jsonl', 'prometheus'],
+                        help='Where the background metrics writer sends the scalars logged to --log_dir')
+    parser.add_argument('--log_sample_rates', default=[], type=str, nargs='*',
+                        help='Per-head sampling, e.g. opt=10 logs the opt scalars of every 10th step')
+    parser.add_argument('--log_queue_size', default=10000, type=int,
+                        help='Scalars waiting for the writer; more are dropped instead of blocking training')
+    parser.add_argument('--step_timing', action='store_true', default=False,
+                        help='Time the phases of every training step (syncs CUDA at each phase), '
+                             'percentiles go to log.txt and the log writer')
+    parser.add_argument('--profile_steps', default='', type=str,
+                        help='start:end, profile these training steps with torch.profiler into output_dir')
+    parser.add_argument('--profile_signal', default='', type=str,
+                        help='Signal name (e.g. USR1) that starts a profile of the next --profile_signal_steps steps')
+    parser.add_argument('--profile_signal_steps', default=20, type=int)
+    parser.add_argument('--watchdog_timeout', default=0, type=float,
+                        help='Seconds without a training batch before the clips in flight and all '
+                             'stacks are dumped into output_dir, 0 disables the watchdog')
+    parser.add_argument('--watchdog_action', default='log', choices=['log', 'skip', 'abort'],
+                        help='After a dump: only log, skip the stuck clips from then on, or also exit')
+    parser.add_argument('--clip_timing', action='store_true', default=False,
+                        help='Record the load time of every training clip, report the slowest after each epoch')
+    parser.add_argument('--clip_timing_topk', default=20, type=int)
+    parser.add_argument('--retranscode_threshold', default=0, type=float,
+                        help='With --clip_timing, list clips loading slower than this many seconds '
+                             'in output_dir/retranscode.txt, 0 disables the list')
+    parser.add_argument('--block_profile', action='store_true', default=False,
+                        help='Time forward / backward and measure activation memory of every block, '
+                             'written to output_dir/block_profile_epoch{e}.txt')
+    parser.add_argument('--peak_tflops', default='', type=str,
+                        help='Peak TFLOP/s of one device for MFU, a number or per device type '
+                             'like cuda=312,cpu=2.5; known GPUs are looked up when not given')
     parser.add_argument('--device', default='cuda',
-                        help='device to use for training / testing')
+                        help='device to use for training / testing; distributed runs use nccl on cuda, gloo on cpu')
+    parser.add_argument('--precision', default='auto', choices=['auto', 'fp16', 'bf16', 'fp32'],
+                        help='Autocast dtype: fp16 with loss scaling, bf16, or fp32; auto is fp16 on cuda, bf16 on cpu')
+    parser.add_argument('--fp32_modules', default=[], type=str, nargs='*',
+                        help='Submodules kept in fp32 under any precision, e.g. head fc_norm')
     parser.add_argument('--seed', default=0, type=int)
     parser.add_argument('--resume', default='',
                         help='resume from checkpoint')
@@ -184,6 +253,21 @@ def get_args():
     parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
                         help='start epoch')
     parser.add_argument('--frozen_backbone', default=True, type=bool)
+    parser.add_argument('--feature_cache', action='store_true', default=False,
+                        help='Extract frozen backbone features once and train the head from the cache')
+    parser.add_argument('--feature_cache_dir', default='', type=str,
+                        help='Directory of the feature cache (default: output_dir/feature_cache)')
+    parser.add_argument('--feature_cache_draws', default=1, type=int,
+                        help='Number of cached augmentation draws of the training set')
+    parser.add_argument('--block_cache_layers', default=0, type=int,
+                        help='Freeze the layers with id < k (patch embedding and blocks < k-1), cache their '
+                             'token outputs once and fine-tune the upper blocks from the cache (0: disabled)')
+    parser.add_argument('--block_cache_dtype', default='fp16', choices=['fp16', 'int8'], type=str,
+                        help='Storage type of the cached block outputs')
+    parser.add_argument('--multitask', action='store_true', default=False,
+                        help='Train one head per SurgBench-E task of the "all" data set in a single run')
+    parser.add_argument('--taxonomy', default='SurgBench-E_taxonomy.txt', type=str,
+                        help='Taxonomy file that maps the classes to the SurgBench-E tasks')
     parser.add_argument('--eval', action='store_true', default=False,
                         help='Perform evaluation only')
     parser.add_argument('--dist_eval', action='store_true', default=True,
@@ -222,8 +306,86 @@ def get_args():
 # os.environ["RANK"] = "0"
 # os.environ['WORLD_SIZE'] = "8"
 # os.environ['LOCAL_RANK'] = "0"
+def convert_finetune_checkpoint(checkpoint, model, args):
+    """
+    State dict of a pre-training (or fine-tuning) checkpoint converted for ``model``: the
+    ``model_key`` entry, ``backbone.``/``encoder.`` prefixes stripped, a head of another
+    shape dropped and ``pos_embed`` interpolated to the input size.
+    """
+    print("Load ckpt from %s" % args.finetune)
+    checkpoint_model = None
+    for model_key in args.model_key.split('|'):
+        if model_key in checkpoint:
+            checkpoint_model = checkpoint[model_key]
+            print("Load state_dict by model_key = %s" % model_key)
+            break
+    if checkpoint_model is None:
+        checkpoint_model = checkpoint
+    state_dict = model.state_dict()
+    for k in ['head.weight', 'head.bias']:
+        if k in checkpoint_model and checkpoint_model[k].shape != state_dict[k].shape:
+            print(f"Removing key {k} from pretrained checkpoint")
+            del checkpoint_model[k]
+
+    all_keys = list(checkpoint_model.keys())
+    new_dict = OrderedDict()
+    for key in all_keys:
+        if key.startswith('backbone.'):
+            new_dict[key[9:]] = checkpoint_model[key]
+        elif key.startswith('encoder.'):
+            new_dict[key[8:]] = checkpoint_model[key]
+        else:
+            new_dict[key] = checkpoint_model[key]
+    checkpoint_model = new_dict
+
+    # interpolate position embedding
+    if 'pos_embed' in checkpoint_model:
+        pos_embed_checkpoint = checkpoint_model['pos_embed']
+        embedding_size = pos_embed_checkpoint.shape[-1] # channel dim
+        num_patches = model.patch_embed.num_patches # 
+        num_extra_tokens = model.pos_embed.shape[-2] - num_patches # 0/1
+
+        # height (== width) for the checkpoint position embedding 
+        orig_size = int(((pos_embed_checkpoint.shape[-2] - num_extra_tokens)//(args.num_frames // model.patch_embed.tubelet_size)) ** 0.5)
+        # height (== width) for the new position embedding
+        new_size = int((num_patches // (args.num_frames // model.patch_embed.tubelet_size) )** 0.5)
+        # class_token and dist_token are kept unchanged
+        if orig_size != new_size:
+            print("Position interpolate from %dx%d to %dx%d" % (orig_size, orig_size, new_size, new_size))
+            extra_tokens = pos_embed_checkpoint[:, :num_extra_tokens]
+            # only the position tokens are interpolated
+            pos_tokens = pos_embed_checkpoint[:, num_extra_tokens:]
+            # B, L, C -> BT, H, W, C -> BT, C, H, W
+            pos_tokens = pos_tokens.reshape(-1, args.num_frames // model.patch_embed.tubelet_size, orig_size, orig_size, embedding_size)
+            pos_tokens = pos_tokens.reshape(-1, orig_size, orig_size, embedding_size).permute(0, 3, 1, 2)
+            pos_tokens = torch.nn.functional.interpolate(
+                pos_tokens, size=(new_size, new_size), mode='bicubic', align_corners=False)
+            # BT, C, H, W -> BT, H, W, C ->  B, T, H, W, C
+            pos_tokens = pos_tokens.permute(0, 2, 3, 1).reshape(-1, args.num_frames // model.patch_embed.tubelet_size, new_size, new_size, embedding_size) 
+            pos_tokens = pos_tokens.flatten(1, 3) # B, L, C
+            new_pos_embed = torch.cat((extra_tokens, pos_tokens), dim=1)
+            checkpoint_model['pos_embed'] = new_pos_embed
+    return checkpoint_model
+
+
+def finetune_config(model, args):
+    """
+    Everything besides the source checkpoint that the converted state dict depends on.
+    """
+    state_dict = model.state_dict()
+    return {
+        'model_key': args.model_key,
+        'num_frames': args.num_frames,
+        'tubelet_size': model.patch_embed.tubelet_size,
+        'num_patches': model.patch_embed.num_patches,
+        'pos_embed': list(model.pos_embed.shape) if getattr(model, 'pos_embed', None) is not None else None,
+        'head': [list(state_dict[k].shape) for k in ['head.weight', 'head.bias'] if k in state_dict],
+    }
+
+
 def main(args, ds_init):
     
+    args.precision = precision.resolve(args.precision, args.device)
     print(args)
     
     utils.init_distributed_mode(args)
@@ -246,6 +408,8 @@ def main(args, ds_init):
     cudnn.benchmark = True
 
     dataset_train, args.nb_classes = build_dataset(is_train=True, test_mode=False, args=args)
+    dataset_train, clip_timer = clip_timing.create_clip_timer(args, dataset_train)
+    dataset_train, watchdog = data_watchdog.create_watchdog(args, dataset_train)
     # dataset_train = dataset_train[0:100]
     # 子集的数量是5k
     # if utils.get_rank() == 0:
@@ -262,6 +426,10 @@ def main(args, ds_init):
         dataset_val, _ = build_dataset(is_train=False, test_mode=False, args=args)
     dataset_test, _ = build_dataset(is_train=False, test_mode=True, args=args)
     
+    task_spec = None
+    if args.multitask:
+        task_spec = multitask.TaskSpec.from_taxonomy(args.taxonomy, args.nb_classes)
+        print("Multi-task probing over %d tasks: %s" % (len(task_spec), ", ".join(task_spec.names)))
 
     num_tasks = utils.get_world_size()
     global_rank = utils.get_rank()
@@ -284,7 +452,7 @@ def main(args, ds_init):
 
     if global_rank == 0 and args.log_dir is not None:
         os.makedirs(args.log_dir, exist_ok=True)
-        log_writer = utils.TensorboardLogger(log_dir=args.log_dir)
+        log_writer = metrics_sink.create_sink(args)
     else:
         log_writer = None
 
@@ -293,13 +461,30 @@ def main(args, ds_init):
     else:
         collate_func = None
 
+    mixup_fn = None
+    collate_mixup = None
+    mixup_active = args.mixup > 0 or args.cutmix > 0. or args.cutmix_minmax is not None
+    # mixing clips of different tasks has no meaningful target
+    mixup_active = mixup_active and task_spec is None
+    if mixup_active:
+        print("Mixup is activated!")
+        mixup_args = dict(
+            mixup_alpha=args.mixup, cutmix_alpha=args.cutmix, cutmix_minmax=args.cutmix_minmax,
+            prob=args.mixup_prob, switch_prob=args.mixup_switch_prob, mode=args.mixup_mode,
+            label_smoothing=args.smoothing, num_classes=args.nb_classes)
+        if args.collate_mixup:
+            # also flattens the repeated samples like multiple_samples_collate
+            collate_mixup = VideoCollateMixup(temporal_cutmix=args.temporal_cutmix, **mixup_args)
+        else:
+            mixup_fn = Mixup(**mixup_args)
+
     data_loader_train = torch.utils.data.DataLoader(
         dataset_train, sampler=sampler_train,
         batch_size=args.batch_size,
         num_workers=args.num_workers,
         pin_memory=args.pin_mem,
         drop_last=True,
-        collate_fn=collate_func,
+        collate_fn=collate_mixup if collate_mixup is not None else collate_func,
         # newly added
         # persistent_workers=True,
         # multiprocessing_context='spawn'
@@ -333,14 +518,12 @@ def main(args, ds_init):
     else:
         data_loader_test = None
 
-    mixup_fn = None
-    mixup_active = args.mixup > 0 or args.cutmix > 0. or args.cutmix_minmax is not None
-    if mixup_active:
-        print("Mixup is activated!")
-        mixup_fn = Mixup(
-            mixup_alpha=args.mixup, cutmix_alpha=args.cutmix, cutmix_minmax=args.cutmix_minmax,
-            prob=args.mixup_prob, switch_prob=args.mixup_switch_prob, mode=args.mixup_mode,
-            label_smoothing=args.smoothing, num_classes=args.nb_classes)
+    if args.block_cache_layers > 0:
+        # only the lower blocks are frozen, the upper ones are fine-tuned
+        args.frozen_backbone = False
+    if args.frozen_backbone:
+        # nothing is recomputed in backward when the backbone runs without autograd
+        args.use_checkpoint = False
 
     model = create_model(
         args.model,
@@ -363,85 +546,89 @@ def main(args, ds_init):
     args.window_size = (args.num_frames // 2, args.input_size // patch_size[0], args.input_size // patch_size[1])
     args.patch_size = patch_size
     # random initialize
+    if not args.enable_deepspeed:
+        # a delta checkpoint only holds the trained weights, the rest comes from its base checkpoint
+        utils.find_auto_resume(args)
+        checkpoint_io.resolve_delta_base(args, verify=utils.is_main_process())
     # args.finetune = None
     if args.finetune:
         if args.finetune.startswith('https'):
             checkpoint = torch.hub.load_state_dict_from_url(
                 args.finetune, map_location='cpu', check_hash=True)
+            checkpoint_model = convert_finetune_checkpoint(checkpoint, model, args)
+        elif args.finetune_cache:
+            cache_dir = args.finetune_cache_dir if args.finetune_cache_dir else os.path.join(
+                os.path.dirname(os.path.abspath(args.finetune)), 'converted_checkpoints')
+            checkpoint_model = checkpoint_io.cached_conversion(
+                args.finetune, finetune_config(model, args), cache_dir,
+                lambda: convert_finetune_checkpoint(checkpoint_io.load_mmap(args.finetune), model, args),
+                load=partial(checkpoint_io.load_broadcast, mode=args.ckpt_load_mode))
         else:
-            checkpoint = torch.load(args.finetune, map_location='cpu')
-
-        print("Load ckpt from %s" % args.finetune)
-        checkpoint_model = None
-        for model_key in args.model_key.split('|'):
-            if model_key in checkpoint:
-                checkpoint_model = checkpoint[model_key]
-                print("Load state_dict by model_key = %s" % model_key)
-                break
-        if checkpoint_model is None:
-            checkpoint_model = checkpoint
-        state_dict = model.state_dict()
-        for k in ['head.weight', 'head.bias']:
-            if k in checkpoint_model and checkpoint_model[k].shape != state_dict[k].shape:
-                print(f"Removing key {k} from pretrained checkpoint")
-                del checkpoint_model[k]
-
-        all_keys = list(checkpoint_model.keys())
-        new_dict = OrderedDict()
-        for key in all_keys:
-            if key.startswith('backbone.'):
-                new_dict[key[9:]] = checkpoint_model[key]
-            elif key.startswith('encoder.'):
-                new_dict[key[8:]] = checkpoint_model[key]
-            else:
-                new_dict[key] = checkpoint_model[key]
-        checkpoint_model = new_dict
-
-        # interpolate position embedding
-        if 'pos_embed' in checkpoint_model:
-            pos_embed_checkpoint = checkpoint_model['pos_embed']
-            embedding_size = pos_embed_checkpoint.shape[-1] # channel dim
-            num_patches = model.patch_embed.num_patches # 
-            num_extra_tokens = model.pos_embed.shape[-2] - num_patches # 0/1
-
-            # height (== width) for the checkpoint position embedding 
-            orig_size = int(((pos_embed_checkpoint.shape[-2] - num_extra_tokens)//(args.num_frames // model.patch_embed.tubelet_size)) ** 0.5)
-            # height (== width) for the new position embedding
-            new_size = int((num_patches // (args.num_frames // model.patch_embed.tubelet_size) )** 0.5)
-            # class_token and dist_token are kept unchanged
-            if orig_size != new_size:
-                print("Position interpolate from %dx%d to %dx%d" % (orig_size, orig_size, new_size, new_size))
-                extra_tokens = pos_embed_checkpoint[:, :num_extra_tokens]
-                # only the position tokens are interpolated
-                pos_tokens = pos_embed_checkpoint[:, num_extra_tokens:]
-                # B, L, C -> BT, H, W, C -> BT, C, H, W
-                pos_tokens = pos_tokens.reshape(-1, args.num_frames // model.patch_embed.tubelet_size, orig_size, orig_size, embedding_size)
-                pos_tokens = pos_tokens.reshape(-1, orig_size, orig_size, embedding_size).permute(0, 3, 1, 2)
-                pos_tokens = torch.nn.functional.interpolate(
-                    pos_tokens, size=(new_size, new_size), mode='bicubic', align_corners=False)
-                # BT, C, H, W -> BT, H, W, C ->  B, T, H, W, C
-                pos_tokens = pos_tokens.permute(0, 2, 3, 1).reshape(-1, args.num_frames // model.patch_embed.tubelet_size, new_size, new_size, embedding_size) 
-                pos_tokens = pos_tokens.flatten(1, 3) # B, L, C
-                new_pos_embed = torch.cat((extra_tokens, pos_tokens), dim=1)
-                checkpoint_model['pos_embed'] = new_pos_embed
+            checkpoint = checkpoint_io.load_broadcast(args.finetune, args.ckpt_load_mode)
+            checkpoint_model = convert_finetune_checkpoint(checkpoint, model, args)
 
         utils.load_state_dict(model, checkpoint_model, prefix=args.model_prefix)
 
     model.to(device)
+    assert not (args.enable_deepspeed and args.fp32_modules), "DeepSpeed casts all weights, --fp32_modules needs native AMP"
+    precision_policy = precision.PrecisionPolicy.from_args(args)
+    precision_policy.apply(model)
+    print(precision_policy)
     if args.frozen_backbone:
         for param in model.parameters():
             param.requires_grad = False
         if hasattr(model, 'head'):
             for param in model.head.parameters():
                 param.requires_grad = True
+    flop_parts = flops.vit_parts(model)
+    feature_stores = None
+    if args.feature_cache:
+        assert args.frozen_backbone, "The feature cache needs a frozen backbone"
+        feature_stores = feature_cache.build_feature_stores(
+            args, model, device, dataset_train, dataset_val, dataset_test, collate_func=collate_func,
+            precision=precision_policy)
+        data_loader_train, data_loader_val, data_loader_test = feature_cache.build_feature_loaders(args, feature_stores)
+        # mixup/cutmix work on pixels, the cached augmentation draws replace them
+        mixup_fn = None
+        collate_mixup = None
+        model = feature_cache.FeatureHead(model)
+    elif args.block_cache_layers > 0:
+        num_layers = model.get_num_layers()
+        assert args.block_cache_layers <= num_layers, \
+            "Cannot freeze %d layers of a model with %d blocks" % (args.block_cache_layers, num_layers)
+        for name, param in model.named_parameters():
+            if get_num_layer_for_vit(name, num_layers + 2) < args.block_cache_layers:
+                param.requires_grad = False
+        num_frozen_blocks = args.block_cache_layers - 1
+        cache_dir = args.feature_cache_dir if args.feature_cache_dir else os.path.join(
+            args.output_dir, 'block_cache_%d_%s' % (args.block_cache_layers, args.block_cache_dtype))
+        feature_stores = feature_cache.build_feature_stores(
+            args, model, device, dataset_train, dataset_val, dataset_test, collate_func=collate_func,
+            root=cache_dir, forward_fn=feature_cache.lower_blocks_forward(model, num_frozen_blocks),
+            precision=precision_policy,
+            dtype=args.block_cache_dtype, extra_config={'block_cache_layers': args.block_cache_layers})
+        data_loader_train, data_loader_val, data_loader_test = feature_cache.build_feature_loaders(
+            args, feature_stores, num_workers=args.num_workers)
+        mixup_fn = None
+        collate_mixup = None
+        model = feature_cache.UpperBlocks(model, num_frozen_blocks)
+    first_part = 0
+    if args.feature_cache:
+        first_part = len(flop_parts) - 1
+    elif args.block_cache_layers > 0:
+        first_part = 1 + num_frozen_blocks
+    model_flops = flops.create_flops(args, flop_parts, device, precision_policy, first_part)
     model_ema = None
     if args.model_ema:
-        model_ema = ModelEma(
+        model_ema = utils.MultiTensorModelEma(
             model,
             decay=args.model_ema_decay,
             device='cpu' if args.model_ema_force_cpu else '',
-            resume='')
+            resume='',
+            update_interval=args.model_ema_update_interval,
+            async_copy=args.model_ema_async)
         print("Using EMA with decay = %.8f" % args.model_ema_decay)
+    block_profiler = block_profile.create_block_profiler(args, model, device)
 
     model_without_ddp = model
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -486,15 +673,24 @@ def main(args, ds_init):
         print("model.gradient_accumulation_steps() = %d" % model.gradient_accumulation_steps())
         assert model.gradient_accumulation_steps() == args.update_freq
     else:
-        if args.distributed:
-            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=False)
+        if args.frozen_backbone and not args.feature_cache:
+            # only the head is trained, so only the head is synchronized
+            head = feature_cache.FeatureHead(model)
+            if args.distributed:
+                head = torch.nn.parallel.DistributedDataParallel(
+                    head, device_ids=[args.gpu] if device.type == 'cuda' else None, find_unused_parameters=False)
+            model = feature_cache.FrozenBackboneClassifier(model, head)
+            model_without_ddp = model.module
+        elif args.distributed:
+            model = torch.nn.parallel.DistributedDataParallel(
+                model, device_ids=[args.gpu] if device.type == 'cuda' else None, find_unused_parameters=False)
             model_without_ddp = model.module
 
         optimizer = create_optimizer(
             args, model_without_ddp, skip_list=skip_weight_decay_list,
             get_num_layer=assigner.get_layer_id if assigner is not None else None, 
             get_layer_scale=assigner.get_scale if assigner is not None else None)
-        loss_scaler = NativeScaler()
+        loss_scaler = NativeScaler(enabled=precision_policy.use_scaler, device=device.type)
 
     print("Use step level LR scheduler!")
     lr_schedule_values = utils.cosine_scheduler(
@@ -507,7 +703,9 @@ def main(args, ds_init):
         args.weight_decay, args.weight_decay_end, args.epochs, num_training_steps_per_epoch)
     print("Max WD = %.7f, Min WD = %.7f" % (max(wd_schedule_values), min(wd_schedule_values)))
 
-    if mixup_fn is not None:
+    if task_spec is not None:
+        criterion = multitask.MultiTaskCrossEntropy(task_spec, smoothing=args.smoothing)
+    elif mixup_fn is not None or collate_mixup is not None:
         # smoothing is handled with mixup label transform
         criterion = SoftTargetCrossEntropy()
     elif args.smoothing > 0.:
@@ -522,12 +720,13 @@ def main(args, ds_init):
         optimizer=optimizer, loss_scaler=loss_scaler, model_ema=model_ema)
 
     if args.eval:
-        preds_file = os.path.join(args.output_dir, str(global_rank) + '.txt')
-        test_stats = final_test(data_loader_test, model, device, preds_file, args.output_dir)
+        preds_file = os.path.join(args.output_dir, str(global_rank) + '.npz')
+        test_stats = final_test(data_loader_test, model, device, preds_file, args.output_dir, task_spec=task_spec,
+                                precision=precision_policy)
         torch.distributed.barrier()
         if global_rank == 0:
             print("Start merging results...")
-            final_top1 ,final_top5 = merge(args.output_dir, num_tasks)
+            final_top1 ,final_top5 = merge(args.output_dir, num_tasks, task_spec=task_spec)
             print(f"Accuracy of the network on the {len(dataset_test)} test videos: Top-1: {final_top1:.2f}%, Top-5: {final_top5:.2f}%")
             log_stats = {'Final top-1': final_top1,
                         'Final Top-5': final_top5}
@@ -537,20 +736,31 @@ def main(args, ds_init):
         exit(0)
 
     print(f"Start training for {args.epochs} epochs")
+    profiler = profiling.create_profiler(args)
     start_time = time.time()
     max_accuracy = 0.0
     for epoch in tqdm(range(args.start_epoch, args.epochs)):
         if args.distributed:
             data_loader_train.sampler.set_epoch(epoch)
+        if feature_stores is not None:
+            feature_stores['train'].set_epoch(epoch)
         if log_writer is not None:
             log_writer.set_step(epoch * num_training_steps_per_epoch * args.update_freq)
+        if clip_timer is not None:
+            clip_timer.set_epoch(epoch)
         train_stats = train_one_epoch(
             model, criterion, data_loader_train, optimizer,
             device, epoch, loss_scaler, args.clip_grad, model_ema, mixup_fn,
             log_writer=log_writer, start_steps=epoch * num_training_steps_per_epoch,
             lr_schedule_values=lr_schedule_values, wd_schedule_values=wd_schedule_values,
             num_training_steps_per_epoch=num_training_steps_per_epoch, update_freq=args.update_freq,
+            task_spec=task_spec, precision=precision_policy, step_timing=args.step_timing,
+            profiler=profiler, watchdog=watchdog, flops=model_flops,
         )
+        if clip_timer is not None:
+            train_stats.update(clip_timer.report(epoch, log_writer))
+        if block_profiler is not None:
+            block_profiler.report(args.output_dir, epoch)
         # 重新构造一个dataloader
         # del data_loader_train
         # torch.cuda.empty_cache()
@@ -572,7 +782,8 @@ def main(args, ds_init):
                     args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
                     loss_scaler=loss_scaler, epoch=epoch, model_ema=model_ema)
         if data_loader_val is not None:
-            test_stats = validation_one_epoch(data_loader_val, model, device, epoch, args.output_dir)
+            test_stats = validation_one_epoch(data_loader_val, model, device, epoch, args.output_dir,
+                                              task_spec=task_spec, precision=precision_policy)
             print(f"Accuracy of the network on the {len(dataset_val)} val videos: {test_stats['acc1']:.1f}%")
             if max_accuracy < test_stats["acc1"]:
                 max_accuracy = test_stats["acc1"]
@@ -613,12 +824,20 @@ def main(args, ds_init):
             with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
                 f.write(json.dumps(log_stats) + "\n")
 
-    preds_file = os.path.join(args.output_dir, str(global_rank) + '.txt')
-    test_stats = final_test(data_loader_test, model, device, preds_file, args.output_dir)
+    if feature_stores is not None:
+        log_stats = feature_cache.report_speedup(
+            feature_stores, args.epochs - args.start_epoch, time.time() - start_time)
+        if args.output_dir and utils.is_main_process():
+            with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
+                f.write(json.dumps(log_stats) + "\n")
+
+    preds_file = os.path.join(args.output_dir, str(global_rank) + '.npz')
+    test_stats = final_test(data_loader_test, model, device, preds_file, args.output_dir, task_spec=task_spec,
+                            precision=precision_policy)
     # torch.distributed.barrier()
     if global_rank == 0:
         print("Start merging results...")
-        final_top1 ,final_top5 = merge(args.output_dir, num_tasks)
+        final_top1 ,final_top5 = merge(args.output_dir, num_tasks, task_spec=task_spec)
         print(f"Accuracy of the network on the {len(dataset_test)} test videos: Top-1: {final_top1:.2f}%, Top-5: {final_top5:.2f}%")
         log_stats = {'Final top-1': final_top1,
                     'Final Top-5': final_top5}
@@ -627,6 +846,10 @@ def main(args, ds_init):
                 f.write(json.dumps(log_stats) + "\n")
 
 
+    if profiler is not None:
+        profiler.close()
+    checkpoint_io.close_writers()
+    metrics_sink.close_sinks()
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
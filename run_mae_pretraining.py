@@ -13,6 +13,14 @@ from datasets import build_pretraining_dataset
 from engine_for_pretraining import train_one_epoch
 from utils import NativeScalerWithGradNormCount as NativeScaler
 import utils
+import checkpoint_io
+import metrics_sink
+import profiling
+import data_watchdog
+import clip_timing
+import block_profile
+import flops
+import precision
 import modeling_pretrain
 
 
@@ -21,6 +29,14 @@ def get_args():
     parser.add_argument('--batch_size', default=64, type=int)
     parser.add_argument('--epochs', default=800, type=int)
     parser.add_argument('--save_ckpt_freq', default=50, type=int)
+    parser.add_argument('--async_ckpt', action='store_true', default=False,
+                        help='Write checkpoints from a background thread after copying the state to CPU')
+    parser.add_argument('--ckpt_keep_last', default=0, type=int,
+                        help='Keep only the last N epoch checkpoints, besides the best one (0: keep all)')
+    parser.add_argument('--sharded_ckpt', action='store_true', default=False,
+                        help='Save checkpoints as per-rank shards written in parallel (see checkpoint_io.py)')
+    parser.add_argument('--ckpt_load_mode', default='node', choices=['node', 'rank0', 'all'], type=str,
+                        help='Read checkpoints once per node / on rank 0 and broadcast them, or on every rank')
 
     # Model parameters
     parser.add_argument('--model', default='pretrain_videomae_base_patch16_224', type=str, metavar='MODEL',
@@ -49,6 +65,9 @@ def get_args():
                         help='Optimizer (default: "adamw"')
     parser.add_argument('--opt_eps', default=1e-8, type=float, metavar='EPSILON',
                         help='Optimizer Epsilon (default: 1e-8)')
+    parser.add_argument('--opt_impl', default='auto', choices=['auto', 'default', 'foreach', 'fused'],
+                        help='Implementation of the torch optimizers: fused kernels if available, '
+                             'else multi-tensor foreach (default: auto)')
     parser.add_argument('--opt_betas', default=None, type=float, nargs='+', metavar='BETA',
                         help='Optimizer Betas (default: None, use opt default)')
     parser.add_argument('--clip_grad', type=float, default=None, metavar='NORM',
@@ -91,8 +110,44 @@ def get_args():
                         help='path where to save, empty for no saving')
     parser.add_argument('--log_dir', default=None,
                         help='path where to tensorboard log')
+    parser.add_argument('--log_backends', default=['tensorboard'], type=str, nargs='+',
+                        choices=['tensorboard', 'jsonl', 'prometheus'],
+                        help='Where the background metrics writer sends the scalars logged to --log_dir')
+    parser.add_argument('--log_sample_rates', default=[], type=str, nargs='*',
+                        help='Per-head sampling, e.g. opt=10 logs the opt scalars of every 10th step')
+    parser.add_argument('--log_queue_size', default=10000, type=int,
+                        help='Scalars waiting for the writer; more are dropped instead of blocking training')
+    parser.add_argument('--step_timing', action='store_true', default=False,
+                        help='Time the phases of every training step (syncs CUDA at each phase), '
+                             'percentiles go to log.txt and the log writer')
+    parser.add_argument('--profile_steps', default='', type=str,
+                        help='start:end, profile these training steps with torch.profiler into output_dir')
+    parser.add_argument('--profile_signal', default='', type=str,
+                        help='Signal name (e.g. USR1) that starts a profile of the next --profile_signal_steps steps')
+    parser.add_argument('--profile_signal_steps', default=20, type=int)
+    parser.add_argument('--watchdog_timeout', default=0, type=float,
+                        help='Seconds without a training batch before the clips in flight and all '
+                             'stacks are dumped into output_dir, 0 disables the watchdog')
+    parser.add_argument('--watchdog_action', default='log', choices=['log', 'skip', 'abort'],
+                        help='After a dump: only log, skip the stuck clips from then on, or also exit')
+    parser.add_argument('--clip_timing', action='store_true', default=False,
+                        help='Record the load time of every training clip, report the slowest after each epoch')
+    parser.add_argument('--clip_timing_topk', default=20, type=int)
+    parser.add_argument('--retranscode_threshold', default=0, type=float,
+                        help='With --clip_timing, list clips loading slower than this many seconds '
+                             'in output_dir/retranscode.txt, 0 disables the list')
+    parser.add_argument('--block_profile', action='store_true', default=False,
+                        help='Time forward / backward and measure activation memory of every block, '
+                             'written to output_dir/block_profile_epoch{e}.txt')
+    parser.add_argument('--peak_tflops', default='', type=str,
+                        help='Peak TFLOP/s of one device for MFU, a number or per device type '
+                             'like cuda=312,cpu=2.5; known GPUs are looked up when not given')
     parser.add_argument('--device', default='cuda',
-                        help='device to use for training / testing')
+                        help='device to use for training / testing; distributed runs use nccl on cuda, gloo on cpu')
+    parser.add_argument('--precision', default='auto', choices=['auto', 'fp16', 'bf16', 'fp32'],
+                        help='Autocast dtype: fp16 with loss scaling, bf16, or fp32; auto is fp16 on cuda, bf16 on cpu')
+    parser.add_argument('--fp32_modules', default=[], type=str, nargs='*',
+                        help='Submodules kept in fp32 under any precision, e.g. head fc_norm')
     parser.add_argument('--seed', default=0, type=int)
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('--auto_resume', action='store_true')
@@ -133,6 +188,7 @@ def get_model(args):
 
 def main(args):
     utils.init_distributed_mode(args)
+    args.precision = precision.resolve(args.precision, args.device)
 
     print(args)
 
@@ -153,6 +209,8 @@ def main(args):
 
     # get dataset
     dataset_train = build_pretraining_dataset(args)
+    dataset_train, clip_timer = clip_timing.create_clip_timer(args, dataset_train)
+    dataset_train, watchdog = data_watchdog.create_watchdog(args, dataset_train)
 
 
     num_tasks = utils.get_world_size()
@@ -170,7 +228,7 @@ def main(args):
 
     if global_rank == 0 and args.log_dir is not None:
         os.makedirs(args.log_dir, exist_ok=True)
-        log_writer = utils.TensorboardLogger(log_dir=args.log_dir)
+        log_writer = metrics_sink.create_sink(args)
     else:
         log_writer = None
 
@@ -184,6 +242,12 @@ def main(args):
     )
 
     model.to(device)
+    precision_policy = precision.PrecisionPolicy.from_args(args)
+    precision_policy.apply(model)
+    block_profiler = block_profile.create_block_profiler(args, model, device)
+    num_masked = args.window_size[0] * int(args.mask_ratio * args.window_size[1] * args.window_size[2])
+    model_flops = flops.create_flops(args, flops.vit_parts(model, num_masked), device, precision_policy)
+    print(precision_policy)
     model_without_ddp = model
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
 
@@ -199,12 +263,13 @@ def main(args):
     print("Number of training examples per epoch = %d" % (total_batch_size * num_training_steps_per_epoch))
 
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=False)
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=[args.gpu] if device.type == 'cuda' else None, find_unused_parameters=False)
         model_without_ddp = model.module
 
     optimizer = create_optimizer(
         args, model_without_ddp)
-    loss_scaler = NativeScaler()
+    loss_scaler = NativeScaler(enabled=precision_policy.use_scaler, device=device.type)
 
     print("Use step level LR & WD scheduler!")
     lr_schedule_values = utils.cosine_scheduler(
@@ -221,12 +286,15 @@ def main(args):
         args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer, loss_scaler=loss_scaler)
     torch.cuda.empty_cache()
     print(f"Start training for {args.epochs} epochs")
+    profiler = profiling.create_profiler(args)
     start_time = time.time()
     for epoch in range(args.start_epoch, args.epochs):
         if args.distributed:
             data_loader_train.sampler.set_epoch(epoch)
         if log_writer is not None:
             log_writer.set_step(epoch * num_training_steps_per_epoch)
+        if clip_timer is not None:
+            clip_timer.set_epoch(epoch)
         train_stats = train_one_epoch(
             model, data_loader_train,
             optimizer, device, epoch, loss_scaler,
@@ -236,7 +304,14 @@ def main(args):
             wd_schedule_values=wd_schedule_values,
             patch_size=patch_size[0],
             normlize_target=args.normlize_target,
+            precision=precision_policy,
+            step_timing=args.step_timing,
+            profiler=profiler, watchdog=watchdog, flops=model_flops,
         )
+        if clip_timer is not None:
+            train_stats.update(clip_timer.report(epoch, log_writer))
+        if block_profiler is not None:
+            block_profiler.report(args.output_dir, epoch)
         if args.output_dir:
             if (epoch + 1) % args.save_ckpt_freq == 0 or epoch + 1 == args.epochs:
                 utils.save_model(
@@ -252,6 +327,10 @@ def main(args):
             with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
                 f.write(json.dumps(log_stats) + "\n")
 
+    if profiler is not None:
+        profiler.close()
+    checkpoint_io.close_writers()
+    metrics_sink.close_sinks()
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
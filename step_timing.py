@@ -0,0 +1,73 @@
+"""
+Per-step phase timing of the training loops (``--step_timing``).
+
+The loop calls ``timer.mark(phase)`` at the end of each phase; the time since the
+previous mark is recorded for that phase. On CUDA every mark synchronizes the device,
+so kernels are charged to the phase that queued them. Without ``--step_timing`` the
+engines get ``NullTimer`` whose ``mark`` does nothing.
+
+At the end of the epoch ``summary`` gives mean / p50 / p90 / p99 in ms per phase for
+``log.txt`` and ``log`` writes them, and the full histograms, to the log writer.
+"""
+import time
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+class NullTimer(object):
+    def mark(self, phase):
+        pass
+
+    def restart(self):
+        pass
+
+    def summary(self, prefix='time_'):
+        return {}
+
+    def log(self, log_writer, step):
+        pass
+
+
+class StepTimer(object):
+    def __init__(self, device, phases=()):
+        self.cuda = torch.device(device).type == 'cuda'
+        self.times = OrderedDict((phase, []) for phase in phases)
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        if self.cuda:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.times.setdefault(phase, []).append(now - self.last)
+        self.last = now
+
+    def restart(self):
+        """
+        Start timing from now without charging the elapsed time to a phase.
+        """
+        self.last = time.perf_counter()
+
+    def summary(self, prefix='time_'):
+        stats = OrderedDict()
+        for phase, values in self.times.items():
+            if len(values) == 0:
+                continue
+            ms = np.asarray(values) * 1000.
+            stats[prefix + phase + '_mean'] = float(ms.mean())
+            for q in (50, 90, 99):
+                stats[prefix + phase + '_p%d' % q] = float(np.percentile(ms, q))
+        return stats
+
+    def log(self, log_writer, step):
+        if log_writer is None:
+            return
+        log_writer.update(head="step_time", step=step, **self.summary(prefix=''))
+        if hasattr(log_writer, 'histogram'):
+            for phase, values in self.times.items():
+                if len(values) > 0:
+                    log_writer.histogram("step_time/" + phase, np.asarray(values) * 1000., step)
+
+
+def create_timer(enabled, device, phases=()):
+    return StepTimer(device, phases) if enabled else NullTimer()
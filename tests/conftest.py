@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the training code is a flat set of top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# checkpoints hold args namespaces and sharding metadata, loaded like the training code
+# does with torch < 2.6
+os.environ.setdefault('TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD', '1')
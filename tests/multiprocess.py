@@ -0,0 +1,31 @@
+"""
+Run a test function on several gloo CPU processes.
+"""
+import os
+import socket
+
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _run(rank, world_size, port, fn, args):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def spawn(fn, world_size, *args):
+    """
+    ``fn(rank, world_size, *args)`` on every rank; a failing rank fails the test.
+    ``fn`` has to be a module-level function.
+    """
+    mp.spawn(_run, args=(world_size, _free_port(), fn, args), nprocs=world_size)
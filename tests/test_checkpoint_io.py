@@ -0,0 +1,72 @@
+import os
+
+import pytest
+import torch
+import torch.nn as nn
+
+import checkpoint_io
+from multiprocess import spawn
+
+
+def _checkpoint():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(8, 16), nn.LayerNorm(16), nn.Linear(16, 3))
+    optimizer = torch.optim.AdamW(model.parameters())
+    model(torch.randn(4, 8)).sum().backward()
+    optimizer.step()
+    return {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': 3, 'scaler': {},
+            'trainable_only': True, 'base_checkpoint': {'path': '/base.pth', 'sha256': None}}
+
+
+def _assert_same(a, b):
+    assert type(a) == type(b)
+    if torch.is_tensor(a):
+        assert a.dtype == b.dtype and torch.equal(a, b)
+    elif isinstance(a, dict):
+        assert list(a) == list(b)
+        for k in a:
+            _assert_same(a[k], b[k])
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            _assert_same(x, y)
+    else:
+        assert a == b
+
+
+def _save(rank, world_size, path):
+    checkpoint_io.save_sharded(_checkpoint(), path, rank, world_size)
+
+
+def _load(rank, world_size, path):
+    _assert_same(checkpoint_io.load_sharded(path, rank, world_size), _checkpoint())
+
+
+def test_single_process_roundtrip(tmp_path):
+    path = str(tmp_path / 'checkpoint-3')
+    checkpoint_io.save_sharded(_checkpoint(), path, 0, 1)
+    assert checkpoint_io.is_sharded(path)
+    assert not os.path.exists(path + '.tmp')
+    _assert_same(checkpoint_io.load_sharded(path), _checkpoint())
+    checkpoint_io.consolidate(path, str(tmp_path / 'checkpoint-3.pth'))
+    _assert_same(torch.load(str(tmp_path / 'checkpoint-3.pth')), _checkpoint())
+
+
+@pytest.mark.parametrize('save_world_size,load_world_size', [(3, 1), (3, 2), (2, 3), (1, 2)])
+def test_reshard(tmp_path, save_world_size, load_world_size):
+    path = str(tmp_path / 'checkpoint-3')
+    if save_world_size == 1:
+        _save(0, 1, path)
+    else:
+        spawn(_save, save_world_size, path)
+    shards = [checkpoint_io.load_mmap(os.path.join(path, checkpoint_io._shard_name(r, save_world_size)))
+              for r in range(save_world_size)]
+    keys = [key for shard in shards for key in shard]
+    # every tensor is in exactly one shard, and every shard has some
+    assert len(keys) == len(set(keys))
+    assert set(keys) == set(torch.load(os.path.join(path, 'metadata.pth'))['owners'])
+    assert all(len(shard) > 0 for shard in shards)
+    if load_world_size == 1:
+        _load(0, 1, path)
+    else:
+        spawn(_load, load_world_size, path)
@@ -0,0 +1,138 @@
+import argparse
+import os
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+import checkpoint_io
+import feature_cache
+from precision import PrecisionPolicy
+
+
+class TinyBackbone(nn.Module):
+    def __init__(self, dim=4):
+        super().__init__()
+        self.proj = nn.Linear(6, dim)
+
+    def forward_features(self, x):
+        return self.proj(x)
+
+
+class Clips(torch.utils.data.Dataset):
+    def __init__(self, n=6):
+        self.x = torch.randn(n, 6, generator=torch.Generator().manual_seed(0))
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        return self.x[index], index % 3, 'clip%d' % index
+
+
+def _args(tmp_path, **kwargs):
+    args = argparse.Namespace(
+        feature_cache_dir=str(tmp_path / 'cache'), output_dir='', feature_cache_draws=1, batch_size=4,
+        num_workers=0, pin_mem=False, num_sample=1, model='vit_base_patch16_224', finetune='',
+        use_mean_pooling=True, data_set='SurgBench', data_path='/data', num_frames=16, num_segments=1,
+        sampling_rate=4, input_size=224, short_side_size=224, tubelet_size=2, test_num_segment=5,
+        test_num_crop=3)
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+def _key(args, dtype='fp16', precision='bf16', fp32_modules=(), extra=None):
+    return feature_cache.cache_key(args, dtype, PrecisionPolicy(precision, 'cpu', fp32_modules), extra)
+
+
+def _build(args, model, extra_config=None):
+    return feature_cache.build_feature_stores(args, model, torch.device('cpu'), Clips(), Clips(4), None,
+                                              precision=PrecisionPolicy('fp32', 'cpu'), extra_config=extra_config)
+
+
+@pytest.fixture
+def extractions(monkeypatch):
+    calls = []
+    extract = feature_cache.extract_features
+
+    def counted(model, data_loader, device, prefix, *args, **kwargs):
+        calls.append(os.path.basename(prefix))
+        return extract(model, data_loader, device, prefix, *args, **kwargs)
+    monkeypatch.setattr(feature_cache, 'extract_features', counted)
+    return calls
+
+
+def test_cache_key_covers_the_config(tmp_path):
+    args = _args(tmp_path)
+    key = _key(args)
+    assert key == _key(_args(tmp_path))
+    changed = [
+        _key(_args(tmp_path, model='vit_small_patch16_224')),
+        _key(_args(tmp_path, use_mean_pooling=False)),
+        _key(_args(tmp_path, input_size=160)),
+        _key(_args(tmp_path, num_frames=8)),
+        _key(_args(tmp_path, data_path='/other')),
+        _key(args, dtype='int8'),
+        _key(args, precision='fp32'),
+        _key(args, fp32_modules=['head']),
+        _key(args, extra={'block_cache_layers': 4}),
+    ]
+    assert key not in changed
+    assert len(set(changed)) == len(changed)
+
+
+def test_cache_key_hashes_the_finetune_checkpoint(tmp_path, monkeypatch):
+    path = str(tmp_path / 'base.pth')
+    keys = []
+    for mtime, value in ((1e9, 0.), (2e9, 1.)):
+        # the same file rewritten in place, in a new process
+        monkeypatch.setattr(checkpoint_io, '_base_references', {})
+        torch.save({'model': {'w': torch.full((2,), value)}}, path)
+        os.utime(path, (mtime, mtime))
+        keys.append(_key(_args(tmp_path, finetune=path)))
+    assert keys[0] != keys[1]
+
+
+def test_reuse_and_reextract(tmp_path, extractions):
+    args = _args(tmp_path)
+    model = TinyBackbone()
+    stores = _build(args, model)
+    assert sorted(extractions) == ['train_draw0_rank0', 'validation_rank0']
+    assert len(stores['train']) == 6 and len(stores['validation']) == 4
+    assert stores['test'] is None
+
+    del extractions[:]
+    _build(args, model)
+    assert extractions == []
+
+    # another setting goes to another directory
+    _build(_args(tmp_path, use_mean_pooling=False), model)
+    assert sorted(extractions) == ['train_draw0_rank0', 'validation_rank0']
+    assert len(os.listdir(args.feature_cache_dir)) == 2
+
+    # a meta written under another key in the same directory is extracted again
+    del extractions[:]
+    prefix = os.path.join(args.feature_cache_dir, _key(args, precision='fp32'), 'validation_rank0')
+    meta = dict(np.load(prefix + '_meta.npz'))
+    meta['config_key'] = np.asarray('stale')
+    np.savez(prefix + '_meta.npz', **meta)
+    _build(args, model)
+    assert extractions == ['validation_rank0']
+
+
+def test_stale_shards_of_a_larger_world_are_ignored(tmp_path):
+    args = _args(tmp_path)
+    stores = _build(args, TinyBackbone())
+    root = stores['validation'].root
+    for suffix in ('.npy', '_meta.npz'):
+        os.link(os.path.join(root, 'validation_rank0' + suffix), os.path.join(root, 'validation_rank1' + suffix))
+    assert len(_build(args, TinyBackbone())['validation']) == 4
+
+
+def test_missing_shard_fails(tmp_path):
+    args = _args(tmp_path)
+    root = _build(args, TinyBackbone())['validation'].root
+    with pytest.raises(AssertionError):
+        feature_cache.FeatureStore(root, ['validation'], 'validation', world_size=2)
@@ -0,0 +1,62 @@
+from collections import deque
+
+import numpy as np
+import pytest
+
+import utils
+from multiprocess import spawn
+
+
+def test_smoothed_value_window():
+    rng = np.random.RandomState(0)
+    meter = utils.SmoothedValue(window_size=5)
+    window = deque(maxlen=5)
+    total, count = 0., 0
+    for _ in range(23):
+        value, n = float(rng.randn()), int(rng.randint(1, 4))
+        meter.update(value, n=n)
+        window.append(value)
+        total += value * n
+        count += n
+        values = np.array(window)
+        assert meter.median == sorted(values)[(len(values) - 1) // 2]
+        assert np.isclose(meter.avg, values.mean())
+        assert meter.max == values.max()
+        assert meter.value == value
+        assert np.isclose(meter.global_avg, total / count)
+
+
+def test_synchronize_without_distributed():
+    logger = utils.MetricLogger()
+    logger.update(loss=2., acc=1.)
+    logger.synchronize_between_processes()
+    assert logger.meters['loss'].count == 1 and logger.meters['loss'].total == 2.
+
+
+def _synchronize(rank, world_size):
+    logger = utils.MetricLogger()
+    # the same meters, created in a different order on every rank
+    names = ['loss', 'acc1', 'lr']
+    for name in names[rank % 3:] + names[:rank % 3]:
+        for step in range(rank + 1):
+            logger.update(**{name: float(10 * rank + step)})
+    logger.add_meter('wd', utils.SmoothedValue(window_size=1))
+    logger.meters['wd'].update(float(rank), n=2)
+    logger.synchronize_between_processes()
+    for name in names:
+        meter = logger.meters[name]
+        assert meter.count == sum(r + 1 for r in range(world_size))
+        assert meter.total == sum(10 * r + s for r in range(world_size) for s in range(r + 1))
+    assert logger.meters['wd'].count == 2 * world_size
+    assert logger.meters['wd'].total == 2. * sum(range(world_size))
+    # the window stays local
+    assert logger.meters['loss'].value == float(10 * rank + rank)
+
+    mismatched = utils.MetricLogger()
+    mismatched.update(**{'loss' if rank == 0 else 'other': 1.})
+    with pytest.raises(AssertionError):
+        mismatched.synchronize_between_processes()
+
+
+def test_synchronize_between_processes():
+    spawn(_synchronize, 3)
@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+import torch
+
+from mixup import Mixup, VideoCollateMixup, cutmix_tube_and_lam, mix_with_flipped_, mixup_target
+
+
+def _reference(x, weight):
+    return torch.lerp(x, x.flip(0), weight)
+
+
+@pytest.mark.parametrize('batch_size', [2, 6, 7])
+def test_mix_with_flipped_matches_lerp(batch_size):
+    torch.manual_seed(0)
+    x = torch.randn(batch_size, 3, 4, 5, dtype=torch.float64)
+    for weight in (0.3, torch.rand(batch_size, 1, 1, 1, dtype=torch.float64),
+                   torch.rand(batch_size, 1, 4, 5, dtype=torch.float64)):
+        expected = _reference(x, weight)
+        out = mix_with_flipped_(x.clone(), weight)
+        assert torch.allclose(out, expected)
+
+
+def test_mix_with_flipped_exact_copies():
+    torch.manual_seed(0)
+    x = torch.randn(4, 3, 8, 8)
+    weight = (torch.rand(4, 1, 8, 8) > 0.5).float()
+    out = mix_with_flipped_(x.clone(), weight)
+    assert torch.equal(out, torch.where(weight.bool(), x.flip(0), x))
+    assert torch.equal(mix_with_flipped_(x.clone(), 1.), x.flip(0))
+
+
+def test_mix_with_flipped_on_a_view():
+    x = torch.arange(4 * 6 * 6, dtype=torch.float32).view(4, 1, 6, 6)
+    out = x.clone()
+    mix_with_flipped_(out[..., 1:3, 2:5], 1.)
+    expected = x.clone()
+    expected[..., 1:3, 2:5] = x.flip(0)[..., 1:3, 2:5]
+    assert torch.equal(out, expected)
+
+
+def test_mixup_target():
+    target = torch.tensor([0, 1, 2, 3])
+    lam = torch.tensor([[0.1], [0.2], [0.8], [0.9]])
+    y = mixup_target(target, 5, lam, smoothing=0.1)
+    assert torch.allclose(y.sum(1), torch.ones(4))
+    assert torch.allclose(y[0, 0], torch.tensor(0.02 + 0.9 * 0.1))
+    assert torch.allclose(y[0, 3], torch.tensor(0.02 + 0.9 * 0.9))
+    assert torch.allclose(y[0, 4], torch.tensor(0.02))
+
+
+def _mix_weights(out, x):
+    """
+    Per-element weight w of x in out = w * x + (1 - w) * x.flip(0).
+    """
+    return (out - x.flip(0)) / (x - x.flip(0))
+
+
+@pytest.mark.parametrize('mode', ['elem', 'pair', 'batch'])
+def test_mixup_weights_match_targets(mode):
+    batch_size = 8
+    mixup = Mixup(mixup_alpha=1., cutmix_alpha=1., switch_prob=0.5, mode=mode, label_smoothing=0.,
+                  num_classes=batch_size)
+    target = torch.arange(batch_size)
+    for seed in range(10):
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        x = torch.randn(batch_size, 3, 2, 16, 16, dtype=torch.float64)
+        out, y = mixup(x.clone(), target)
+        lam = y[target, target].double()
+        w = _mix_weights(out, x)
+        # the weight of a sample is its lambda, constant for mixup, a 0 / 1 box for cutmix
+        assert torch.allclose(w.mean(dim=(1, 2, 3, 4)), lam, atol=1e-6)
+        for i in range(batch_size):
+            constant = float(w[i].max() - w[i].min()) < 1e-6
+            assert constant or torch.allclose(w[i].round(), w[i], atol=1e-6)
+        if mode == 'pair':
+            assert torch.allclose(lam, lam.flip(0))
+        if mode == 'batch':
+            assert torch.allclose(lam, lam[:1].expand(batch_size))
+
+
+def test_cutmix_tube_and_lam():
+    np.random.seed(0)
+    shape = (8, 3, 16, 32, 24)
+    lam = np.random.beta(1., 1., size=200)
+    (tl, tu, yl, yu, xl, xu), lam_cut = cutmix_tube_and_lam(shape, lam, count=len(lam))
+    assert ((0 <= tl) & (tl <= tu) & (tu <= 16)).all()
+    assert ((0 <= yl) & (yl <= yu) & (yu <= 32)).all()
+    assert ((0 <= xl) & (xl <= xu) & (xu <= 24)).all()
+    volume = (tu - tl) * (yu - yl) * (xu - xl)
+    assert np.allclose(lam_cut, 1. - volume / (16 * 32 * 24))
+    # clipped at the borders, the tube holds at most 1 - lam of the clip
+    assert (lam_cut >= lam - 1e-6).all()
+
+
+def test_cutmix_tube_minmax():
+    np.random.seed(0)
+    (tl, tu, yl, yu, xl, xu), lam = cutmix_tube_and_lam((2, 3, 10, 20, 20), None, ratio_minmax=(0.2, 0.6),
+                                                        count=100)
+    assert ((tu - tl >= 2) & (tu - tl < 6)).all()
+    assert ((yu - yl >= 4) & (yu - yl < 12)).all()
+    assert ((xu - xl >= 4) & (xu - xl < 12)).all()
+
+
+def _clips(batch_size, dtype=torch.float32, repeats=None):
+    torch.manual_seed(0)
+    items = []
+    for i in range(batch_size):
+        if dtype == torch.uint8:
+            clip = torch.randint(0, 256, (3, 4, 8, 8), dtype=torch.uint8)
+        else:
+            clip = torch.randn(3, 4, 8, 8, dtype=dtype)
+        if repeats:
+            items.append(([clip] * repeats, [i] * repeats, [i] * repeats, {}))
+        else:
+            items.append((clip, i, i, {}))
+    return items
+
+
+def test_video_collate_temporal_cutmix():
+    batch_size = 6
+    collate = VideoCollateMixup(mixup_alpha=0., cutmix_alpha=1., mode='elem', label_smoothing=0.,
+                                num_classes=batch_size, temporal_cutmix=True)
+    batch = _clips(batch_size, torch.float64)
+    x = torch.stack([item[0] for item in batch])
+    for seed in range(5):
+        np.random.seed(seed)
+        out, target, index, _ = collate(batch)
+        assert index.tolist() == list(range(batch_size))
+        w = _mix_weights(out, x)
+        assert torch.allclose(w.round(), w, atol=1e-6)
+        lam = target[torch.arange(batch_size), torch.arange(batch_size)].double()
+        assert torch.allclose(w.mean(dim=(1, 2, 3, 4)), lam, atol=1e-6)
+        # the same tube in every channel
+        assert torch.equal(w[:, :1].expand_as(w), w)
+
+
+def test_video_collate_uint8_and_repeated_augmentation():
+    collate = VideoCollateMixup(mixup_alpha=1., cutmix_alpha=0., mode='pair', label_smoothing=0., num_classes=4)
+    batch = _clips(2, torch.uint8, repeats=2)
+    np.random.seed(0)
+    out, target, index, _ = collate(batch)
+    assert out.dtype == torch.uint8 and out.shape == (4, 3, 4, 8, 8)
+    assert index.tolist() == [0, 0, 1, 1]
+    x = torch.stack([clip for item in batch for clip in item[0]]).float()
+    lam = target[torch.arange(4), torch.tensor([0, 0, 1, 1])].view(4, 1, 1, 1, 1)
+    expected = torch.lerp(x, x.flip(0), 1. - lam).round()
+    assert torch.equal(out.float(), expected)
@@ -0,0 +1,86 @@
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from precision import PrecisionPolicy
+
+
+class Net(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.body = nn.Linear(8, 8)
+        self.head = nn.Linear(8, 3)
+
+    def forward(self, x):
+        return self.head(self.body(x))
+
+
+def _record(module, args):
+    module.seen.append((args[0].dtype, torch.is_autocast_enabled('cpu')))
+
+
+def test_resolve():
+    assert PrecisionPolicy('auto', 'cpu').precision == 'bf16'
+    assert PrecisionPolicy('auto', 'cuda').precision == 'fp16'
+    assert PrecisionPolicy('fp16', 'cuda').use_scaler
+    assert not PrecisionPolicy('bf16', 'cpu').use_scaler
+    with PrecisionPolicy('fp32', 'cpu').autocast():
+        assert not torch.is_autocast_enabled('cpu')
+    with pytest.raises(AssertionError):
+        PrecisionPolicy('fp8', 'cpu')
+
+
+def test_fp32_module():
+    net = Net()
+    keys = list(net.state_dict())
+    policy = PrecisionPolicy('bf16', 'cpu', ['head'])
+    policy.apply(net)
+    net.head.seen = []
+    net.head.register_forward_pre_hook(_record)
+    with policy.autocast():
+        out = net(torch.randn(2, 8))
+        assert torch.is_autocast_enabled('cpu')
+    # the head sees float32 inputs with autocast off, the rest runs in bfloat16
+    assert net.head.seen == [(torch.float32, False)]
+    assert out.dtype == torch.float32
+    assert type(net.head) is nn.Linear
+    assert list(net.state_dict()) == keys
+
+    out.sum().backward()
+    assert net.body.weight.grad is not None and net.head.weight.grad.dtype == torch.float32
+
+
+def test_fp32_module_without_policy_is_bf16():
+    net = Net()
+    with PrecisionPolicy('bf16', 'cpu').autocast():
+        assert net(torch.randn(2, 8)).dtype == torch.bfloat16
+
+
+def test_apply_twice_and_copies():
+    net = Net()
+    policy = PrecisionPolicy('bf16', 'cpu', ['head'])
+    policy.apply(net)
+    policy.apply(net)
+    assert len(net.head._forward_pre_hooks) == 1 and len(net.head._forward_hooks) == 1
+    ema = copy.deepcopy(net)
+    with policy.autocast():
+        assert ema(torch.randn(2, 8)).dtype == torch.float32
+        assert torch.is_autocast_enabled('cpu')
+
+
+class Failing(nn.Module):
+    def forward(self, x):
+        raise RuntimeError('failed')
+
+
+def test_autocast_restored_after_an_exception():
+    net = nn.Sequential(nn.Linear(8, 8), Failing())
+    policy = PrecisionPolicy('bf16', 'cpu', ['1'])
+    policy.apply(net)
+    with policy.autocast():
+        with pytest.raises(RuntimeError):
+            net(torch.randn(2, 8))
+        assert torch.is_autocast_enabled('cpu')
+        assert net[0](torch.randn(2, 8)).dtype == torch.bfloat16
@@ -0,0 +1,66 @@
+import numpy as np
+
+from engine_for_finetuning import save_predictions, load_predictions, merge
+
+
+def _save_rank(path, rank, views):
+    """
+    ``views`` is a list of (logits, label, video id, chunk, split), one per test view.
+    """
+    if not views:
+        save_predictions(str(path / ('%d.npz' % rank)), [], [], [], [], [])
+        return
+    logits, labels, ids, chunks, splits = zip(*views)
+    save_predictions(str(path / ('%d.npz' % rank)), [np.asarray(logits, dtype=np.float32)],
+                     [np.asarray(labels)], list(ids), [np.asarray(chunks)], [np.asarray(splits)])
+
+
+def test_save_load_roundtrip(tmp_path):
+    _save_rank(tmp_path, 0, [([1., 2., 3.], 2, 'a', 0, 1), ([3., 2., 1.], 0, 'b', 1, 0)])
+    _save_rank(tmp_path, 1, [([0., 5., 0.], 1, 'c', 0, 0)])
+    logits, labels, ids, chunks, splits = load_predictions(str(tmp_path), 2)
+    assert logits.shape == (3, 3) and logits.dtype == np.float32
+    assert labels.tolist() == [2, 0, 1] and labels.dtype == np.int64
+    assert ids.tolist() == ['a', 'b', 'c']
+    assert chunks.tolist() == [0, 1, 0]
+    assert splits.tolist() == [1, 0, 0]
+
+
+def test_empty_rank(tmp_path):
+    _save_rank(tmp_path, 0, [([1., 2., 3.], 2, 'a', 0, 0)])
+    _save_rank(tmp_path, 1, [])
+    logits, labels, ids, chunks, splits = load_predictions(str(tmp_path), 2)
+    assert logits.shape == (1, 3)
+    assert len(labels) == len(ids) == len(chunks) == len(splits) == 1
+    assert merge(str(tmp_path), 2)[0] == 100.
+
+
+def test_merge_averages_views_and_drops_padding(tmp_path):
+    # video a: the softmax average of its two views picks class 0; counting the padded
+    # copy of view (0, 0) twice would pick class 1
+    _save_rank(tmp_path, 0, [([0., 3., 0.], 0, 'a', 0, 0), ([0., 0., 5.], 2, 'b', 0, 0)])
+    _save_rank(tmp_path, 1, [([4., 0., 0.], 0, 'a', 1, 0), ([0., 3., 0.], 0, 'a', 0, 0)])
+    assert merge(str(tmp_path), 2)[0] == 100.
+
+
+def test_merge_matches_per_video_loop(tmp_path):
+    rng = np.random.RandomState(0)
+    num_videos, num_classes = 20, 4
+    video_labels = rng.randint(num_classes, size=num_videos)
+    views = [(rng.randn(num_classes) * 2, video_labels[v], 'v%02d' % v, chunk, split)
+             for v in range(num_videos) for chunk in range(2) for split in range(3)]
+    order = rng.permutation(len(views))
+    ranks = [[views[i] for i in order[r::3]] for r in range(3)]
+    # the distributed sampler pads the last ranks with views of the first one
+    ranks[1].append(ranks[0][0])
+    ranks[2].append(ranks[0][1])
+    for rank, rank_views in enumerate(ranks):
+        _save_rank(tmp_path, rank, rank_views)
+
+    correct = []
+    for v in range(num_videos):
+        logits = np.array([view[0] for view in views if view[2] == 'v%02d' % v])
+        probs = np.exp(logits - logits.max(1, keepdims=True))
+        probs /= probs.sum(1, keepdims=True)
+        correct.append(np.argmax(probs.mean(0)) == video_labels[v])
+    assert np.isclose(merge(str(tmp_path), 3)[0], 100. * np.mean(correct))
@@ -3,10 +3,10 @@ import os
 import math
 import time
 import json
-from collections import defaultdict, deque
+from collections import defaultdict
 import datetime
 import numpy as np
-from timm.utils import get_state_dict
+from timm.utils import get_state_dict, ModelEma
 from torch.utils.data._utils.collate import default_collate
 from pathlib import Path
 import subprocess
@@ -14,36 +14,45 @@ import torch
 import torch.distributed as dist
 from torch import inf
 import random
+import zlib
+import resource
+import queue
+import threading
 
 from tensorboardX import SummaryWriter
 
+import checkpoint_io
+
 
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
-    window or the global series average.
+    window or the global series average. The window is a fixed ring buffer.
     """
 
     def __init__(self, window_size=20, fmt=None):
         if fmt is None:
             fmt = "{median:.4f} ({global_avg:.4f})"
-        self.deque = deque(maxlen=window_size)
+        self.window = np.zeros(window_size, dtype=np.float64)
+        self.filled = 0
+        self.next = 0
         self.total = 0.0
         self.count = 0
         self.fmt = fmt
 
     def update(self, value, n=1):
-        self.deque.append(value)
+        self.window[self.next] = value
+        self.next = (self.next + 1) % len(self.window)
+        self.filled = min(self.filled + 1, len(self.window))
         self.count += n
         self.total += value * n
 
     def synchronize_between_processes(self):
         """
-        Warning: does not synchronize the deque!
+        Warning: does not synchronize the window!
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
-        dist.barrier()
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=get_dist_device())
         dist.all_reduce(t)
         t = t.tolist()
         self.count = int(t[0])
@@ -51,13 +60,13 @@ class SmoothedValue(object):
 
     @property
     def median(self):
-        d = torch.tensor(list(self.deque))
-        return d.median().item()
+        # lower median, as torch.median
+        k = (self.filled - 1) // 2
+        return float(np.partition(self.window[:self.filled], k)[k])
 
     @property
     def avg(self):
-        d = torch.tensor(list(self.deque), dtype=torch.float32)
-        return d.mean().item()
+        return float(self.window[:self.filled].mean())
 
     @property
     def global_avg(self):
@@ -65,11 +74,11 @@ class SmoothedValue(object):
 
     @property
     def max(self):
-        return max(self.deque)
+        return float(self.window[:self.filled].max())
 
     @property
     def value(self):
-        return self.deque[-1]
+        return float(self.window[self.next - 1])
 
     def __str__(self):
         return self.fmt.format(
@@ -84,6 +93,10 @@ class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        self.num_samples = 0
+        self.flops_per_sample = 0
+        self.peak_tflops = 0.
+        self.throughput = {}
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
@@ -111,17 +124,61 @@ class MetricLogger(object):
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
-        for meter in self.meters.values():
-            meter.synchronize_between_processes()
+        """
+        Sum the (count, total) of all meters over the processes with one all_reduce.
+        Every process must hold the same meters; a checksum of their names is reduced along.
+        """
+        if not is_dist_avail_and_initialized():
+            return
+        names = sorted(self.meters.keys())
+        checksum = float(zlib.crc32(",".join(names).encode()))
+        packed = [checksum]
+        for name in names:
+            packed.extend([self.meters[name].count, self.meters[name].total])
+        t = torch.tensor(packed, dtype=torch.float64, device=get_dist_device())
+        dist.all_reduce(t)
+        t = t.tolist()
+        assert t[0] == checksum * get_world_size(), "Processes log different meters: %s" % names
+        for i, name in enumerate(names):
+            self.meters[name].count = int(t[1 + 2 * i])
+            self.meters[name].total = t[2 + 2 * i]
 
     def add_meter(self, name, meter):
         self.meters[name] = meter
 
+    def add_samples(self, n):
+        self.num_samples += n
+
+    def set_flops(self, flops_per_sample, peak_tflops=0.):
+        """
+        Training FLOPs of one sample, log_every then prints TFLOP/s and, with a peak, MFU.
+        """
+        self.flops_per_sample = flops_per_sample
+        self.peak_tflops = peak_tflops
+
+    def rates(self, samples, seconds):
+        rates = {'samples_per_s': samples / max(seconds, 1e-9)}
+        if self.flops_per_sample:
+            rates['tflops'] = rates['samples_per_s'] * self.flops_per_sample / 1e12
+            if self.peak_tflops:
+                rates['mfu'] = rates['tflops'] / self.peak_tflops
+        return rates
+
+    def rates_str(self, rates):
+        out = ['samples/s: {:.2f}'.format(rates['samples_per_s'])]
+        if 'tflops' in rates:
+            out.append('TFLOP/s: {:.2f}'.format(rates['tflops']))
+        if 'mfu' in rates:
+            out.append('MFU: {:.1%}'.format(rates['mfu']))
+        return self.delimiter.join(out)
+
     def log_every(self, iterable, print_freq, header=None):
         i = 0
         if not header:
             header = ''
         start_time = time.time()
+        start_samples = last_samples = self.num_samples
+        last_time = start_time
         end = time.time()
         iter_time = SmoothedValue(fmt='{avg:.4f}')
         data_time = SmoothedValue(fmt='{avg:.4f}')
@@ -134,10 +191,8 @@ class MetricLogger(object):
             'time: {time}',
             'data: {data}'
         ]
-        if torch.cuda.is_available():
-            log_msg.append('max mem: {memory:.0f}')
+        log_msg.append('max mem: {memory:.0f}')
         log_msg = self.delimiter.join(log_msg)
-        MB = 1024.0 * 1024.0
         for obj in iterable:
             data_time.update(time.time() - end)
             yield obj
@@ -145,23 +200,26 @@ class MetricLogger(object):
             if i % print_freq == 0 or i == len(iterable) - 1:
                 eta_seconds = iter_time.global_avg * (len(iterable) - i)
                 eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
-                if torch.cuda.is_available():
-                    print(log_msg.format(
-                        i, len(iterable), eta=eta_string,
-                        meters=str(self),
-                        time=str(iter_time), data=str(data_time),
-                        memory=torch.cuda.max_memory_allocated() / MB))
-                else:
-                    print(log_msg.format(
-                        i, len(iterable), eta=eta_string,
-                        meters=str(self),
-                        time=str(iter_time), data=str(data_time)))
+                msg = log_msg.format(
+                    i, len(iterable), eta=eta_string,
+                    meters=str(self),
+                    time=str(iter_time), data=str(data_time),
+                    memory=max_memory_mb())
+                if self.num_samples > last_samples:
+                    # over the iterations since the last print
+                    now = time.time()
+                    msg += self.delimiter + self.rates_str(self.rates(self.num_samples - last_samples, now - last_time))
+                    last_samples, last_time = self.num_samples, now
+                print(msg)
             i += 1
             end = time.time()
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         print('{} Total time: {} ({:.4f} s / it)'.format(
             header, total_time_str, total_time / len(iterable)))
+        if self.num_samples > start_samples:
+            self.throughput = self.rates(self.num_samples - start_samples, total_time)
+            print('{} {}'.format(header, self.rates_str(self.throughput)))
 
 
 class TensorboardLogger(object):
@@ -202,6 +260,102 @@ def _load_checkpoint_for_ema(model_ema, checkpoint):
     model_ema._load_checkpoint(mem_file)
 
 
+class MultiTensorModelEma(ModelEma):
+    """
+    ``timm.utils.ModelEma`` updated with multi-tensor ``torch._foreach_*`` ops.
+
+    With ``update_interval`` k only every k-th call of ``update`` does work, with the
+    decay raised to the power k. With ``async_copy`` and an EMA on another device
+    (``--model_ema_force_cpu``) the weights are copied into pinned buffers without
+    blocking and averaged there by a background thread; ``synchronize`` waits for it.
+    The EMA model and its checkpoints are the same as for ``ModelEma``.
+    """
+
+    def __init__(self, model, decay=0.9999, device='', resume='', update_interval=1, async_copy=False):
+        super().__init__(model, decay=decay, device=device, resume=resume)
+        self.update_interval = update_interval
+        self.async_copy = async_copy and bool(device)
+        self.num_updates = 0
+        self._pairs = None
+        self._error = None
+        if self.async_copy:
+            self._queue = queue.Queue(maxsize=1)
+            threading.Thread(target=self._worker, name='model-ema', daemon=True).start()
+
+    def _build(self, model):
+        # state dict tensors share storage with the parameters and buffers, so the lists stay valid
+        needs_module = hasattr(model, 'module') and not self.ema_has_module
+        msd = model.state_dict()
+        ema_tensors, model_tensors = [], []
+        for k, ema_v in self.ema.state_dict().items():
+            ema_tensors.append(ema_v)
+            model_tensors.append(msd['module.' + k if needs_module else k].detach())
+        staging = None
+        if self.device:
+            pin = self.async_copy and torch.cuda.is_available()
+            staging = [torch.empty(t.shape, dtype=t.dtype, device=self.device, pin_memory=pin) for t in model_tensors]
+        self._pairs = (ema_tensors, model_tensors, staging)
+
+    def _average(self, ema_tensors, model_tensors, decay):
+        ema_float = [e for e in ema_tensors if e.is_floating_point()]
+        model_float = [m for e, m in zip(ema_tensors, model_tensors) if e.is_floating_point()]
+        torch._foreach_mul_(ema_float, decay)
+        torch._foreach_add_(ema_float, model_float, alpha=1. - decay)
+        for e, m in zip(ema_tensors, model_tensors):
+            if not e.is_floating_point():
+                e.copy_(m)
+
+    def _worker(self):
+        while True:
+            event, decay = self._queue.get()
+            try:
+                if event is not None:
+                    event.synchronize()
+                ema_tensors, _, staging = self._pairs
+                with torch.no_grad():
+                    self._average(ema_tensors, staging, decay)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def synchronize(self):
+        """
+        Wait until all submitted updates are applied to ``ema``.
+        """
+        if self.async_copy:
+            self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("EMA update failed") from error
+
+    def update(self, model):
+        self.num_updates += 1
+        if self.num_updates % self.update_interval != 0:
+            return
+        decay = self.decay ** self.update_interval
+        if self._pairs is None:
+            self._build(model)
+        ema_tensors, model_tensors, staging = self._pairs
+        with torch.no_grad():
+            if staging is None:
+                self._average(ema_tensors, model_tensors, decay)
+            elif not self.async_copy:
+                for s, m in zip(staging, model_tensors):
+                    s.copy_(m)
+                self._average(ema_tensors, staging, decay)
+            else:
+                # the staging buffers are reused, the previous update has to be done with them
+                self.synchronize()
+                for s, m in zip(staging, model_tensors):
+                    s.copy_(m, non_blocking=True)
+                event = None
+                if any(m.is_cuda for m in model_tensors):
+                    event = torch.cuda.Event()
+                    event.record()
+                self._queue.put((event, decay))
+
+
 def setup_for_distributed(is_master):
     """
     This function disables printing when not in master process
@@ -217,6 +371,32 @@ def setup_for_distributed(is_master):
     __builtin__.print = print
 
 
+def get_dist_device():
+    """
+    Device of the tensors given to collectives: the current GPU for nccl, else the CPU.
+    """
+    if is_dist_avail_and_initialized() and dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def synchronize(device):
+    """
+    Wait for the kernels queued on a CUDA device, nothing to wait for on CPU.
+    """
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def max_memory_mb():
+    """
+    Peak memory in MB: allocated by torch on the GPU once CUDA is used, else the peak RSS of the process.
+    """
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch.cuda.max_memory_allocated() / (1024. * 1024.)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
 def is_dist_avail_and_initialized():
     if not dist.is_available():
         return False
@@ -280,10 +460,14 @@ def init_distributed_mode(args):
 
     args.distributed = True
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = 'nccl'
-    print('| distributed init (rank {}): {}, gpu {}'.format(
-        args.rank, args.dist_url, args.gpu), flush=True)
+    # nccl with one GPU per process, gloo for processes on CPU cores or CPU-only nodes
+    if torch.device(getattr(args, 'device', 'cuda')).type == 'cuda':
+        torch.cuda.set_device(args.gpu)
+        args.dist_backend = 'nccl'
+    else:
+        args.dist_backend = 'gloo'
+    print('| distributed init (rank {}): {}, gpu {}, backend {}'.format(
+        args.rank, args.dist_url, args.gpu, args.dist_backend), flush=True)
     torch.distributed.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
                                          world_size=args.world_size, rank=args.rank)
     torch.distributed.barrier()
@@ -342,12 +526,16 @@ def load_state_dict(model, state_dict, prefix='', ignore_missing="relative_posit
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
+    def __init__(self, enabled=True, device='cuda'):
         # self._scaler = torch.cuda.amp.GradScaler()
-        self._scaler = torch.amp.GradScaler()
+        # bf16 and fp32 need no loss scaling, a disabled scaler just runs backward and step
+        self._scaler = torch.amp.GradScaler(device, enabled=enabled)
 
-    def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
+    def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True,
+                 timer=None):
         self._scaler.scale(loss).backward(create_graph=create_graph)
+        if timer is not None:
+            timer.mark('backward')
         if update_grad:
             if clip_grad is not None:
                 assert parameters is not None
@@ -356,6 +544,8 @@ class NativeScalerWithGradNormCount:
             else:
                 self._scaler.unscale_(optimizer)
                 norm = get_grad_norm_(parameters)
+            if timer is not None:
+                timer.mark('grad_norm')
             self._scaler.step(optimizer)
             self._scaler.update()
         else:
@@ -368,6 +558,9 @@ class NativeScalerWithGradNormCount:
     def load_state_dict(self, state_dict):
         self._scaler.load_state_dict(state_dict)
 
+    def is_enabled(self):
+        return self._scaler.is_enabled()
+
 
 def get_grad_norm_(parameters, norm_type: float = 2.0) -> torch.Tensor:
     if isinstance(parameters, torch.Tensor):
@@ -379,6 +572,10 @@ def get_grad_norm_(parameters, norm_type: float = 2.0) -> torch.Tensor:
     device = parameters[0].grad.device
     if norm_type == inf:
         total_norm = max(p.grad.detach().abs().max().to(device) for p in parameters)
+    elif hasattr(torch, '_foreach_norm'):
+        # one multi-tensor kernel per device and dtype instead of one norm per parameter
+        norms = torch._foreach_norm([p.grad.detach() for p in parameters], norm_type)
+        total_norm = torch.norm(torch.stack([n.to(device) for n in norms]), norm_type)
     else:
         total_norm = torch.norm(torch.stack([torch.norm(p.grad.detach(), norm_type).to(device) for p in parameters]), norm_type)
     return total_norm
@@ -404,9 +601,25 @@ def cosine_scheduler(base_value, final_value, epochs, niter_per_ep, warmup_epoch
     return schedule
 
 
+def trainable_state_dict(model, state_dict=None):
+    """
+    Restrict a state dict to the parameters of ``model`` that require grad.
+    """
+    if state_dict is None:
+        state_dict = model.state_dict()
+    trainable = set(name for name, param in model.named_parameters() if param.requires_grad)
+    return type(state_dict)((k, v) for k, v in state_dict.items() if k in trainable)
+
+
 def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler, model_ema=None):
     output_dir = Path(args.output_dir)
     epoch_name = str(epoch)
+    if model_ema is not None and hasattr(model_ema, 'synchronize'):
+        model_ema.synchronize()
+    # frozen weights are the same in every checkpoint, keep only what is trained; the
+    # feature cache models hold only the trained part, under the full model's names
+    trainable_only = getattr(model_without_ddp, 'partial_model', False) or \
+        any(not p.requires_grad for p in model_without_ddp.parameters())
     if loss_scaler is not None:
         checkpoint_paths = [output_dir / ('checkpoint-%s.pth' % epoch_name)]
         for checkpoint_path in checkpoint_paths:
@@ -421,7 +634,25 @@ def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler, mo
             if model_ema is not None:
                 to_save['model_ema'] = get_state_dict(model_ema)
 
-            save_on_master(to_save, checkpoint_path)
+            if trainable_only:
+                to_save['model'] = trainable_state_dict(model_without_ddp)
+                if model_ema is not None:
+                    to_save['model_ema'] = trainable_state_dict(model_without_ddp, to_save['model_ema'])
+                to_save['trainable_only'] = True
+                if getattr(args, 'finetune', ''):
+                    # hashed on rank 0 only, the other ranks need it only for sharded checkpoints
+                    base = [checkpoint_io.base_reference(args.finetune) if is_main_process() else None]
+                    if getattr(args, 'sharded_ckpt', False) and is_dist_avail_and_initialized():
+                        dist.broadcast_object_list(base, src=0)
+                    to_save['base_checkpoint'] = base[0]
+
+            if getattr(args, 'sharded_ckpt', False):
+                checkpoint_dir = output_dir / ('checkpoint-%s' % epoch_name)
+                checkpoint_io.save_sharded(to_save, checkpoint_dir, get_rank(), get_world_size())
+                if is_main_process():
+                    checkpoint_io.get_writer(args).record(checkpoint_dir.name, epoch)
+            elif is_main_process():
+                checkpoint_io.get_writer(args).save(to_save, checkpoint_path.name, epoch)
     else:
         client_state = {'epoch': epoch}
         if model_ema is not None:
@@ -429,11 +660,18 @@ def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler, mo
         model.save_checkpoint(save_dir=args.output_dir, tag="checkpoint-%s" % epoch_name, client_state=client_state)
 
 
-def auto_load_model(args, model, model_without_ddp, optimizer, loss_scaler, model_ema=None):
+def find_auto_resume(args):
+    """
+    With ``--auto_resume`` and no ``--resume``, set ``args.resume`` to the latest checkpoint
+    of the output directory. Calling it again once ``args.resume`` is set does nothing.
+    """
     output_dir = Path(args.output_dir)
-    if loss_scaler is not None:
-        # torch.amp
-        if args.auto_resume and len(args.resume) == 0:
+    if args.auto_resume and len(args.resume) == 0:
+        latest = checkpoint_io.latest_checkpoint(output_dir)
+        if latest is not None:
+            args.resume = latest
+        elif checkpoint_io.load_manifest(output_dir) is None:
+            # output directory written before the manifest existed
             import glob
             all_checkpoints = glob.glob(os.path.join(output_dir, 'checkpoint-*.pth'))
             latest_ckpt = -1
@@ -443,22 +681,39 @@ def auto_load_model(args, model, model_without_ddp, optimizer, loss_scaler, mode
                     latest_ckpt = max(int(t), latest_ckpt)
             if latest_ckpt >= 0:
                 args.resume = os.path.join(output_dir, 'checkpoint-%d.pth' % latest_ckpt)
-            print("Auto resume checkpoint: %s" % args.resume)
+        print("Auto resume checkpoint: %s" % args.resume)
+
+
+def auto_load_model(args, model, model_without_ddp, optimizer, loss_scaler, model_ema=None):
+    output_dir = Path(args.output_dir)
+    if loss_scaler is not None:
+        # torch.amp
+        find_auto_resume(args)
 
         if args.resume:
             if args.resume.startswith('https'):
                 checkpoint = torch.hub.load_state_dict_from_url(
                     args.resume, map_location='cpu', check_hash=True)
+            elif checkpoint_io.is_sharded(args.resume):
+                checkpoint = checkpoint_io.load_sharded(args.resume, get_rank(), get_world_size())
+            else:
+                checkpoint = checkpoint_io.load_broadcast(args.resume, getattr(args, 'ckpt_load_mode', 'all'))
+            if checkpoint.get('trainable_only', False):
+                # a delta checkpoint, the frozen weights were already loaded from its base checkpoint
+                msg = model_without_ddp.load_state_dict(checkpoint['model'], strict=False)
+                assert len(msg.unexpected_keys) == 0, msg
             else:
-                checkpoint = torch.load(args.resume, map_location='cpu')
-            model_without_ddp.load_state_dict(checkpoint['model'])
+                model_without_ddp.load_state_dict(checkpoint['model'])
             print("Resume checkpoint %s" % args.resume)
-            if 'optimizer' in checkpoint and 'epoch' in checkpoint:
+            # --eval needs the weights only, the optimizer may be over other parameters
+            # (a trainable-only checkpoint evaluated with the full model)
+            if 'optimizer' in checkpoint and 'epoch' in checkpoint and not getattr(args, 'eval', False):
                 optimizer.load_state_dict(checkpoint['optimizer'])
                 args.start_epoch = checkpoint['epoch'] + 1
                 if hasattr(args, 'model_ema') and args.model_ema:
                     _load_checkpoint_for_ema(model_ema, checkpoint['model_ema'])
-                if 'scaler' in checkpoint:
+                # a disabled scaler (bf16 / fp32) saves an empty state and cannot load one
+                if checkpoint.get('scaler') and loss_scaler.is_enabled():
                     loss_scaler.load_state_dict(checkpoint['scaler'])
                 print("With optim & sched!")
     else:
@@ -503,10 +758,13 @@ def create_ds_config(args):
                 }
             },
             "fp16": {
-                "enabled": True,
+                "enabled": getattr(args, 'precision', 'fp16') == 'fp16',
                 "loss_scale": 0,
                 "initial_scale_power": 7,
                 "loss_scale_window": 128
+            },
+            "bf16": {
+                "enabled": getattr(args, 'precision', 'fp16') == 'bf16'
             }
         }
 